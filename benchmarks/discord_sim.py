@@ -0,0 +1,312 @@
+"""Cold start and tick cost at production scale against a simulated Discord.
+
+    python -m benchmarks.discord_sim --guilds 1000 --members 100 --profile
+
+Generates a settings.json, loads it through the configured storage backend
+and brings ProviderCog and SubscriberCog up through their on_ready path with
+an in-process bot whose guilds, members and channels come from the
+settings. Message sends and edits take a simulated latency and are recorded.
+Provider APIs are served by benchmarks.fakes.FakeApis.
+"""
+import argparse
+import asyncio
+import cProfile
+import itertools
+import json
+import logging
+import os
+import pstats
+import random
+import resource
+import tempfile
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+import discord
+
+import mixins.store
+from benchmarks.fakes import FakeApis, SERVICES
+from benchmarks.load import LoadRun, generate_settings, percentile, quiet
+from mixins.storage import JsonStorage, SqliteStorage, WriteBehind
+from mixins.store import ConfigStore
+
+log = logging.getLogger(__name__)
+
+
+class FakeResponse:
+    def __init__(self, status: int, reason: str):
+        self.status = status
+        self.reason = reason
+
+
+class DiscordBehaviour:
+    """Simulated latency of message writes and the share of them rejected with 429"""
+
+    def __init__(self, latency: float = 0.05, rate_limited: float = 0.0, samples: int = 100_000):
+        self.latency = latency
+        self.rate_limited = rate_limited
+        self.latencies = deque(maxlen=samples)
+        self.sent = 0
+        self.edited = 0
+        self.rejected = 0
+
+    async def write(self):
+        start = time.perf_counter()
+        if self.latency:
+            await asyncio.sleep(random.uniform(0.5, 1.5) * self.latency)
+        if random.random() < self.rate_limited:
+            self.rejected += 1
+            error = discord.HTTPException(FakeResponse(429, 'Too Many Requests'), {'message': 'You are being rate limited.'})
+            error.retry_after = 0.5
+            raise error
+        self.latencies.append(time.perf_counter() - start)
+
+
+class FakeMessage:
+    __slots__ = ('id', 'channel', 'embed')
+
+    def __init__(self, message_id: int, channel: 'FakeChannel', embed: Optional[discord.Embed]):
+        self.id = message_id
+        self.channel = channel
+        self.embed = embed
+
+
+class FakePartialMessage:
+    __slots__ = ('id', 'channel')
+
+    def __init__(self, message_id: int, channel: 'FakeChannel'):
+        self.id = message_id
+        self.channel = channel
+
+    async def edit(self, *, embed: discord.Embed) -> FakeMessage:
+        channel = self.channel
+        await channel.guild.bot.behaviour.write()
+        message = channel.messages.get(self.id)
+        if message is None:
+            raise discord.NotFound(FakeResponse(404, 'Not Found'), {'message': 'Unknown Message', 'code': 10008})
+        message.embed = embed
+        channel.guild.bot.behaviour.edited += 1
+        return message
+
+
+class FakeChannel:
+    def __init__(self, channel_id: int, guild: 'FakeGuild'):
+        self.id = channel_id
+        self.guild = guild
+        self.name = f"channel-{channel_id}"
+        self.messages: Dict[int, FakeMessage] = {}
+
+    def get_partial_message(self, message_id: int) -> FakePartialMessage:
+        return FakePartialMessage(message_id, self)
+
+    async def send(self, *, embed: discord.Embed) -> FakeMessage:
+        bot = self.guild.bot
+        await bot.behaviour.write()
+        message = FakeMessage(next(bot.message_ids), self, embed)
+        self.messages[message.id] = message
+        bot.behaviour.sent += 1
+        return message
+
+
+class FakeMember:
+    __slots__ = ('id', 'guild', 'name')
+
+    def __init__(self, member_id: int, guild: 'FakeGuild'):
+        self.id = member_id
+        self.guild = guild
+        self.name = f"member-{member_id}"
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int, bot: 'FakeBot'):
+        self.id = guild_id
+        self.bot = bot
+        self.name = f"guild-{guild_id}"
+        self.members: Dict[int, FakeMember] = {}
+        self.channels: Dict[int, FakeChannel] = {}
+
+    def get_member(self, member_id: int) -> Optional[FakeMember]:
+        return self.members.get(member_id)
+
+    def get_channel(self, channel_id: int) -> Optional[FakeChannel]:
+        return self.channels.get(channel_id)
+
+
+class FakeBot:
+    """The parts of commands.Bot the cogs use: guild lookup and event dispatch"""
+
+    def __init__(self, behaviour: DiscordBehaviour):
+        self.behaviour = behaviour
+        self.guilds: Dict[int, FakeGuild] = {}
+        self.cogs: List[Any] = []
+        self.message_ids = itertools.count(600000000000000000)
+        self._events: List[asyncio.Task] = []
+
+    @classmethod
+    def from_settings(cls, displays: Dict[str, Any], behaviour: DiscordBehaviour) -> 'FakeBot':
+        """Creates every guild, member and channel named in the SubscriberCog settings"""
+        bot = cls(behaviour)
+        for guild_str, members in displays.items():
+            guild = bot.guilds[int(guild_str)] = FakeGuild(int(guild_str), bot)
+            for member_str, settings in members.items():
+                guild.members[int(member_str)] = FakeMember(int(member_str), guild)
+                for display in settings.get('provider_settings', {}).values():
+                    channel_id = int(display['channel_id'])
+                    if channel_id not in guild.channels:
+                        guild.channels[channel_id] = FakeChannel(channel_id, guild)
+        return bot
+
+    def get_guild(self, guild_id: int) -> Optional[FakeGuild]:
+        return self.guilds.get(guild_id)
+
+    def dispatch(self, event: str, *args: Any):
+        for cog in self.cogs:
+            listener = getattr(cog, f"on_{event}", None)
+            if listener is not None:
+                self._events.append(asyncio.ensure_future(listener(*args)))
+
+    async def ready(self):
+        """Fires on_ready like the gateway would and waits for every event it caused"""
+        self.dispatch('ready')
+        while self._events:
+            events, self._events = self._events, []
+            await asyncio.gather(*events)
+
+
+def profiled(enabled: bool):
+    profile = cProfile.Profile()
+    if enabled:
+        profile.enable()
+    return profile
+
+
+def report_profile(profile: cProfile.Profile, title: str, enabled: bool, limit: int = 20):
+    if not enabled:
+        return
+    profile.disable()
+    print(f"\n--- {title} (top {limit} by cumulative time) ---")
+    pstats.Stats(profile).sort_stats('cumulative').print_stats(limit)
+
+
+async def sweep(load: LoadRun, concurrency: int) -> float:
+    """Runs one tick for every polled target, returning the wall time"""
+    cog = load.subscriber_cog
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def tick(key):
+        provider = cog.provider_for_key(key)
+        if provider is None:
+            return
+        async with semaphore:
+            try:
+                await cog.task_callback(key, provider)
+            except Exception as e:
+                log.debug(f"Tick for {key} failed: {e}")
+
+    start = time.perf_counter()
+    await asyncio.gather(*(tick(key) for key in list(cog.index.keys())))
+    return time.perf_counter() - start
+
+
+async def drain(load: LoadRun, timeout: float) -> float:
+    publisher = load.subscriber_cog.publisher
+    start = time.perf_counter()
+    while publisher.workers and time.perf_counter() - start < timeout:
+        await asyncio.sleep(0.05)
+    return time.perf_counter() - start
+
+
+async def run(args: argparse.Namespace):
+    apis = FakeApis(latency=args.api_latency)
+    await apis.start()
+    apis.point_providers()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        settings_path = args.settings or os.path.join(workdir, 'settings.json')
+        if not args.settings:
+            providers, displays = generate_settings(
+                args.guilds * args.members, args.members, args.targets, args.credentials, args.interval,
+                args.services.split(','), channels=args.channels,
+            )
+            with open(settings_path, 'w') as f:
+                json.dump({'ProviderCog': providers, 'SubscriberCog': displays}, f)
+        print(f"settings.json     : {os.path.getsize(settings_path) / 2 ** 20:.1f} MiB")
+
+        if args.backend == 'sqlite':
+            storage = SqliteStorage(os.path.join(workdir, 'settings.db'), json_path=settings_path)
+        else:
+            storage = JsonStorage(settings_path)
+        mixins.store._store = ConfigStore(storage, WriteBehind(storage))
+
+        behaviour = DiscordBehaviour(latency=args.discord_latency, rate_limited=args.rate_limited)
+
+        profile = profiled(args.profile)
+        start = time.perf_counter()
+        # Building the bot reads SubscriberCog settings, which is the config load a real start pays too
+        bot = FakeBot.from_settings(mixins.store._store.namespace('SubscriberCog'), behaviour)
+        loaded = time.perf_counter()
+        load = LoadRun(bot, apis, workdir)
+        load.subscriber_cog.publisher.rate = args.publish_rate
+        bot.cogs = [load.provider_cog, load.subscriber_cog]
+        await load.start()
+        await bot.ready()
+        cold_start = time.perf_counter() - start
+        report_profile(profile, "cold start", args.profile)
+
+        subscriptions = len(load.subscriber_cog.index)
+        print(f"subscriptions     : {subscriptions} in {len(bot.guilds)} guilds, {len(load.subscriber_cog.index.keys())} targets")
+        print(f"cold start        : {cold_start:.2f}s (settings {loaded - start:.2f}s, "
+              f"on_ready {cold_start - (loaded - start):.2f}s)")
+
+        # Polls were scheduled with jitter by on_ready, sweeps drive ticks directly instead
+        await load.subscriber_cog.scheduler.stop()
+        for number in range(1, args.sweeps + 1):
+            profile = profiled(args.profile)
+            tick_start = len(load.tick_seconds)
+            seconds = await sweep(load, args.concurrency)
+            report_profile(profile, f"sweep {number}", args.profile)
+            ticks = load.tick_seconds[tick_start:]
+            drained = await drain(load, args.drain_timeout)
+            print(f"sweep {number}           : {seconds:.2f}s, {seconds / max(subscriptions, 1) * 1e6:.0f}us/subscription, "
+                  f"tick p50 {percentile(ticks, 0.5) * 1000:.1f}ms p99 {percentile(ticks, 0.99) * 1000:.1f}ms, "
+                  f"publisher drained in {drained:.2f}s (depth {load.subscriber_cog.publisher.depth})")
+
+        latencies = list(behaviour.latencies)
+        print(f"discord writes    : sent {behaviour.sent}, edited {behaviour.edited}, 429 {behaviour.rejected}, "
+              f"p50 {percentile(latencies, 0.5) * 1000:.1f}ms p99 {percentile(latencies, 0.99) * 1000:.1f}ms")
+        print(f"publisher         : {load.subscriber_cog.publisher.stats}")
+        print(f"upstream requests : {sum(apis.requests.values())}")
+        print(f"max rss           : {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB")
+        await load.stop()
+        storage.close()
+    await apis.stop()
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--guilds', type=int, default=1000)
+    parser.add_argument('--members', type=int, default=100, help="members per guild, one display each")
+    parser.add_argument('--channels', type=int, default=10, help="display channels per guild")
+    parser.add_argument('--targets', type=int, default=10_000, help="distinct accounts per service")
+    parser.add_argument('--credentials', type=int, default=10, help="distinct API credentials per service")
+    parser.add_argument('--services', default=','.join(SERVICES))
+    parser.add_argument('--interval', default='5m')
+    parser.add_argument('--settings', help="use an existing settings.json instead of generating one")
+    parser.add_argument('--backend', choices=('json', 'sqlite'), default='json')
+    parser.add_argument('--sweeps', type=int, default=2, help="full ticks over every target")
+    parser.add_argument('--concurrency', type=int, default=256, help="ticks in flight during a sweep")
+    parser.add_argument('--api-latency', type=float, default=0.02)
+    parser.add_argument('--discord-latency', type=float, default=0.05)
+    parser.add_argument('--rate-limited', type=float, default=0.0, help="share of Discord writes answered with 429")
+    parser.add_argument('--publish-rate', type=int, default=5, help="writes per channel per 5s")
+    parser.add_argument('--drain-timeout', type=float, default=30.0)
+    parser.add_argument('--profile', action='store_true', help="print cProfile stats for each phase")
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args(argv)
+    quiet(args.log_level)
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+"""Local stand-ins for the provider APIs, used by the load benchmarks."""
+import asyncio
+import random
+import time
+import uuid
+import zlib
+from collections import Counter
+from typing import Dict, Optional
+
+from aiohttp import web
+
+from bot.social.providers import YouTubeProvider, RedditProvider, TwitchProvider, TwitterProvider
+
+SERVICES = ('youtube', 'reddit', 'twitch', 'twitter')
+
+
+class ServiceBehaviour:
+    """How a fake service misbehaves: mean latency in seconds, share of requests
+    failing with a 500 and requests per second allowed before answering 429"""
+
+    def __init__(self, latency: float = 0.05, error_rate: float = 0.0, rate_limit: float = 0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self._tokens = rate_limit
+        self._refilled = time.monotonic()
+
+    def take_token(self) -> bool:
+        if self.rate_limit <= 0:
+            return True
+        now = time.monotonic()
+        self._tokens = min(self.rate_limit, self._tokens + (now - self._refilled) * self.rate_limit)
+        self._refilled = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+
+class FakeApis:
+    """One aiohttp server answering the YouTube, Reddit, Twitch (with OAuth) and
+    Twitter endpoints the providers call. Counts grow slowly over time so
+    displays actually change while a benchmark runs. Successful responses carry
+    an ETag and are answered with 304 when it still matches. With
+    ``youtube_quota`` each API key gets that many channels.list calls before
+    quotaExceeded."""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, growth: float = 0.1, youtube_quota: int = 0, **behaviour: float):
+        self.host = host
+        self.port = port
+        self.growth = growth
+        self.youtube_quota = youtube_quota
+        self.quota_spent: Counter = Counter()
+        self.behaviour: Dict[str, ServiceBehaviour] = {name: ServiceBehaviour(**behaviour) for name in SERVICES}
+        self.requests: Counter = Counter()
+        self.statuses: Counter = Counter()
+        self.targets: Counter = Counter()
+        self.tokens: Dict[str, float] = {}
+        self.started = time.monotonic()
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def count(self, target: str) -> int:
+        base = zlib.crc32(target.encode()) % 1_000_000
+        return base + int((time.monotonic() - self.started) * self.growth * (1 + base % 7))
+
+    async def start(self):
+        app = web.Application(middlewares=[self._misbehave])
+        app.router.add_get('/youtube/v3/channels', self.youtube_channels)
+        app.router.add_get('/reddit/r/{name}/about.json', self.reddit_about)
+        app.router.add_get('/reddit/api/info.json', self.reddit_info)
+        app.router.add_post('/twitch/oauth2/token', self.twitch_token)
+        app.router.add_get('/twitch/helix/users/follows', self.twitch_follows)
+        app.router.add_get('/twitter/2/users', self.twitter_users)
+        app.router.add_get('/twitter/2/users/{id}', self.twitter_user)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self.port = self._runner.addresses[0][1]
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def point_providers(self):
+        """Sends every provider's requests to this server"""
+        YouTubeProvider.api_url = f"{self.url}/youtube/v3"
+        RedditProvider.api_url = f"{self.url}/reddit"
+        TwitchProvider.api_url = f"{self.url}/twitch/helix"
+        TwitchProvider.token_url = f"{self.url}/twitch/oauth2/token"
+        TwitterProvider.api_url = f"{self.url}/twitter/2"
+
+    @web.middleware
+    async def _misbehave(self, request: web.Request, handler) -> web.StreamResponse:
+        service = request.path.split('/')[1]
+        behaviour = self.behaviour[service]
+        self.requests[service] += 1
+        if behaviour.latency:
+            await asyncio.sleep(random.uniform(0.5, 1.5) * behaviour.latency)
+        if not behaviour.take_token():
+            response = web.json_response({'message': 'Too Many Requests'}, status=429, headers={'Retry-After': '1'})
+        elif random.random() < behaviour.error_rate:
+            response = web.json_response({'message': 'Internal Server Error'}, status=500)
+        else:
+            response = self._validate(request, await handler(request))
+        self.statuses[f"{service} {response.status}"] += 1
+        return response
+
+    @staticmethod
+    def _validate(request: web.Request, response: web.Response) -> web.Response:
+        if response.status != 200 or response.body is None:
+            return response
+        etag = f'"{zlib.crc32(response.body):08x}"'
+        if request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304, headers={'ETag': etag})
+        response.headers['ETag'] = etag
+        return response
+
+    def _ids(self, request: web.Request, name: str):
+        ids = [i for i in request.query.get(name, '').split(',') if i]
+        self.targets.update(ids)
+        return ids
+
+    async def youtube_channels(self, request: web.Request) -> web.Response:
+        key = request.query.get('key')
+        if not key:
+            return web.json_response({'error': {'code': 403}}, status=403)
+        self.quota_spent[key] += 1
+        if self.youtube_quota and self.quota_spent[key] > self.youtube_quota:
+            error = {'code': 403, 'message': 'quota exceeded', 'errors': [{'reason': 'quotaExceeded'}]}
+            return web.json_response({'error': error}, status=403)
+        items = [{'id': i, 'statistics': {'subscriberCount': str(self.count(i))}} for i in self._ids(request, 'id')]
+        return web.json_response({'items': items})
+
+    async def reddit_about(self, request: web.Request) -> web.Response:
+        name = request.match_info['name']
+        self.targets[name.lower()] += 1
+        return web.json_response({'kind': 't5', 'data': {'display_name': name, 'subscribers': self.count(name.lower())}})
+
+    async def reddit_info(self, request: web.Request) -> web.Response:
+        children = [
+            {'kind': 't5', 'data': {'display_name': name, 'subscribers': self.count(name.lower())}}
+            for name in self._ids(request, 'sr_name')
+        ]
+        return web.json_response({'kind': 'Listing', 'data': {'children': children}})
+
+    async def twitch_token(self, request: web.Request) -> web.Response:
+        form = await request.post()
+        if not form.get('client_id') or not form.get('client_secret'):
+            return web.json_response({'status': 400, 'message': 'missing client credentials'}, status=400)
+        token = uuid.uuid4().hex
+        self.tokens[token] = time.monotonic() + 3600
+        return web.json_response({'access_token': token, 'expires_in': 3600, 'token_type': 'bearer'})
+
+    async def twitch_follows(self, request: web.Request) -> web.Response:
+        token = request.headers.get('Authorization', '').replace('Bearer ', '')
+        if self.tokens.get(token, 0) < time.monotonic():
+            return web.json_response({'status': 401, 'message': 'Invalid OAuth token'}, status=401)
+        user_id = request.query.get('to_id', '')
+        self.targets[user_id] += 1
+        return web.json_response({'total': self.count(user_id), 'data': []})
+
+    async def twitter_users(self, request: web.Request) -> web.Response:
+        users = [{'id': i, 'public_metrics': {'followers_count': self.count(i)}} for i in self._ids(request, 'ids')]
+        return web.json_response({'data': users})
+
+    async def twitter_user(self, request: web.Request) -> web.Response:
+        user_id = request.match_info['id']
+        self.targets[user_id] += 1
+        return web.json_response({'data': {'id': user_id, 'public_metrics': {'followers_count': self.count(user_id)}}})
@@ -0,0 +1,219 @@
+"""Polling throughput against local fake provider APIs.
+
+    python -m benchmarks.load --subscriptions 10000 --duration 30 --latency 0.05
+
+Runs the real providers, ProviderCog fetch path and SubscriberCog polling
+loop against benchmarks.fakes.FakeApis, with settings kept in a temporary
+directory. Without a Discord connection members are not found, so ticks end
+after the count is fetched and recorded.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import resource
+import tempfile
+import time
+import tracemalloc
+from datetime import timedelta
+from functools import wraps
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import sentry_sdk
+
+import metrics
+import mixins.store
+from benchmarks.fakes import FakeApis, SERVICES
+from mixins.storage import SqliteStorage, WriteBehind
+from mixins.store import ConfigStore
+
+Settings = Dict[str, Any]
+
+
+def use_temporary_store(path: str) -> ConfigStore:
+    """Points every ConfigMixin at a fresh database so real settings are never touched"""
+    storage = SqliteStorage(os.path.join(path, 'settings.db'), json_path=None)
+    mixins.store._store = ConfigStore(storage, WriteBehind(storage))
+    return mixins.store._store
+
+
+def payload_for(service: str, target: int, credential: int) -> Dict[str, str]:
+    if service == 'youtube':
+        return {'api_key': f"key-{credential}", 'channel_id': f"UC{target:022d}"}
+    if service == 'reddit':
+        return {'subreddit': f"sub{target}"}
+    if service == 'twitch':
+        return {'user_id': str(target), 'client_id': f"client-{credential}", 'client_secret': f"secret-{credential}"}
+    return {'user_id': str(10_000_000 + target), 'app_bearer_token': f"bearer-{credential}"}
+
+
+def generate_settings(
+        subscriptions: int,
+        members: int,
+        targets: int,
+        credentials: int,
+        interval: str,
+        services: Sequence[str] = SERVICES,
+        channels: int = 1,
+) -> Tuple[Settings, Settings]:
+    """ProviderCog and SubscriberCog namespaces with one display per member.
+    Members are spread over guilds of ``members``, posting to ``channels`` channels
+    per guild, and share ``targets`` accounts per service. An ``interval`` of
+    ``10s-5m`` makes every display adaptive."""
+    interval, _, max_interval = interval.partition('-')
+    providers, displays = {}, {}
+    for n in range(subscriptions):
+        guild_str = str(700000000000000000 + n // members)
+        member_str = str(800000000000000000 + n)
+        service = services[n % len(services)]
+        payload = payload_for(service, (n // len(services)) % targets, n % credentials)
+        providers.setdefault(guild_str, {})[member_str] = {'providers': {service: {'payload': payload}}}
+        displays.setdefault(guild_str, {})[member_str] = {'provider_settings': {service: {
+            'text': '{count} subscribers',
+            'banner_url': 'https://example.com/banner.png',
+            'channel_id': str(900000000000000000 + n // members * channels + n % channels),
+            'interval': interval,
+            'max_interval': max_interval,
+            'heartbeat': '',
+            'message_id': None,
+        }}}
+    return providers, displays
+
+
+def quiet(level: str):
+    """Keeps benchmark output readable and stops error reporting from skewing timings"""
+    logging.getLogger().setLevel(level)
+    sentry_sdk.init(dsn=None)
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+class HeadlessBot:
+    """Just enough of commands.Bot for the cogs to run without a gateway"""
+
+    def get_guild(self, guild_id: int):
+        return None
+
+    def dispatch(self, event: str, *args: Any):
+        pass
+
+
+class LoadRun:
+    def __init__(self, bot, apis: FakeApis, workdir: str):
+        from bot.social.history import HistoryStore
+        from bot.social.provider_cog import ProviderCog, default_provider_definitions
+        from bot.social.subscriber_cog import SubscriberCog
+
+        self.bot = bot
+        self.apis = apis
+        self.provider_cog = ProviderCog(bot, default_provider_definitions())
+        self.subscriber_cog = SubscriberCog(bot, self.provider_cog)
+        self.subscriber_cog.history_store = HistoryStore(os.path.join(workdir, 'history'))
+        self.tick_seconds: List[float] = []
+        self.polled = 0
+        self._instrument_ticks()
+
+    def _instrument_ticks(self):
+        cog = self.subscriber_cog
+        callback = cog.task_callback
+
+        @wraps(callback)
+        async def timed(key, provider):
+            start = time.perf_counter()
+            try:
+                return await callback(key, provider)
+            finally:
+                self.tick_seconds.append(time.perf_counter() - start)
+                self.polled += len(cog.index.subscriptions(key))
+
+        cog.task_callback = timed
+
+    def load(self, providers: Settings, displays: Settings):
+        provider_cog, subscriber_cog = self.provider_cog, self.subscriber_cog
+        provider_cog.config_settings.update(providers)
+        subscriber_cog.config_settings.update(displays)
+        for guild_str, members in providers.items():
+            for member_str in members:
+                for credentials in provider_cog.load_member_credentials(guild_str, member_str):
+                    provider_cog.load_provider(*credentials.key)
+                for display in subscriber_cog.load_member_displays(guild_str, member_str):
+                    subscriber_cog.register_subscription(*display.key)
+
+    async def start(self):
+        await self.provider_cog.cog_load()
+        await self.subscriber_cog.cog_load()
+
+    async def stop(self):
+        await self.subscriber_cog.cog_unload()
+        await self.provider_cog.cog_unload()
+
+
+async def run(args: argparse.Namespace):
+    apis = FakeApis(latency=args.latency, error_rate=args.error_rate, rate_limit=args.rate_limit)
+    await apis.start()
+    apis.point_providers()
+    if args.cache_ttl is not None:
+        from bot.social.providers import BaseProvider, YouTubeProvider, RedditProvider, InstagramProvider, TikTokProvider
+        for provider in (BaseProvider, YouTubeProvider, RedditProvider, InstagramProvider, TikTokProvider):
+            provider.cache_ttl = timedelta(seconds=args.cache_ttl)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        use_temporary_store(workdir)
+        providers, displays = generate_settings(
+            args.subscriptions, args.members, args.targets, args.credentials, args.interval, args.services.split(','),
+        )
+        tracemalloc.start()
+        setup_start = time.perf_counter()
+        load = LoadRun(HeadlessBot(), apis, workdir)
+        load.load(providers, displays)
+        setup_seconds = time.perf_counter() - setup_start
+        setup_bytes, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        await load.start()
+        run_start = time.perf_counter()
+        await asyncio.sleep(args.duration)
+        elapsed = time.perf_counter() - run_start
+        await load.stop()
+    await apis.stop()
+
+    upstream = sum(apis.requests.values())
+    print(f"subscriptions     : {args.subscriptions} ({len(load.subscriber_cog.index.keys())} distinct targets)")
+    print(f"setup             : {setup_seconds:.2f}s, {setup_bytes / args.subscriptions:.0f} B/subscription")
+    print(f"ticks             : {len(load.tick_seconds)} in {elapsed:.1f}s")
+    print(f"throughput        : {load.polled / elapsed:.1f} subscription updates/s")
+    print(f"tick latency      : p50 {percentile(load.tick_seconds, 0.5) * 1000:.1f}ms "
+          f"p99 {percentile(load.tick_seconds, 0.99) * 1000:.1f}ms")
+    print(f"upstream requests : {upstream} ({upstream / max(load.polled, 1):.3f} per subscription update)")
+    print(f"upstream statuses : {', '.join(f'{k}={v}' for k, v in sorted(apis.statuses.items()))}")
+    print(f"max rss           : {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB")
+    for line in metrics.summary():
+        print(f"  {line}")
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--subscriptions', type=int, default=10_000)
+    parser.add_argument('--members', type=int, default=100, help="members per guild")
+    parser.add_argument('--targets', type=int, default=2_500, help="distinct accounts per service")
+    parser.add_argument('--credentials', type=int, default=10, help="distinct API credentials per service")
+    parser.add_argument('--services', default=','.join(SERVICES))
+    parser.add_argument('--interval', default='10s', help="display update interval, 10s-5m to adapt")
+    parser.add_argument('--duration', type=float, default=30.0, help="seconds to poll for")
+    parser.add_argument('--cache-ttl', type=float, default=None, help="override every provider's cache_ttl (seconds)")
+    parser.add_argument('--latency', type=float, default=0.05, help="mean upstream latency (seconds)")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of upstream requests failing with 500")
+    parser.add_argument('--rate-limit', type=float, default=0.0, help="upstream requests/s per service before 429, 0 for none")
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args(argv)
+    quiet(args.log_level)
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
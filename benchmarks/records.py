@@ -0,0 +1,88 @@
+"""Memory and lookup cost per subscription: nested config dicts vs slotted records.
+
+    python -m benchmarks.records --guilds 1000 --members 100
+"""
+import argparse
+import random
+import timeit
+import tracemalloc
+from typing import Any, Callable, Dict, List, Tuple
+
+from bot.social.models import DisplaySettings
+
+PROVIDERS = ('youtube', 'reddit', 'twitch', 'twitter')
+
+
+def generate_config(guilds: int, members: int) -> Dict[str, Any]:
+    """Settings shaped like the SubscriberCog namespace of settings.json"""
+    config = {}
+    for g in range(guilds):
+        guild_id = 700000000000000000 + g
+        config[str(guild_id)] = {
+            str(800000000000000000 + g * members + m): {
+                'provider_settings': {
+                    name: {
+                        'text': 'We have {count} subscribers!',
+                        'banner_url': 'https://example.com/banner.png',
+                        'channel_id': str(900000000000000000 + g),
+                        'interval': '5m',
+                        'heartbeat': '',
+                        'message_id': 600000000000000000 + g * members + m,
+                    }
+                    for name in PROVIDERS[:1 + m % len(PROVIDERS)]
+                }
+            }
+            for m in range(members)
+        }
+    return config
+
+
+def build_records(config: Dict[str, Any]) -> Dict[Tuple[int, int, str], DisplaySettings]:
+    return {
+        (int(guild_str), int(member_str), name): DisplaySettings.from_config(guild_str, member_str, name, data)
+        for guild_str, members in config.items()
+        for member_str, member in members.items()
+        for name, data in member['provider_settings'].items()
+    }
+
+
+def measure(build: Callable[[], Any]) -> Tuple[Any, int]:
+    tracemalloc.start()
+    result = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, size
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--guilds', type=int, default=1000)
+    parser.add_argument('--members', type=int, default=100)
+    parser.add_argument('--lookups', type=int, default=200_000)
+    args = parser.parse_args(argv)
+
+    config, config_bytes = measure(lambda: generate_config(args.guilds, args.members))
+    records, record_bytes = measure(lambda: build_records(config))
+    count = len(records)
+    keys = random.sample(list(records.keys()), min(args.lookups, count))
+
+    def nested_lookup():
+        for guild_id, member_id, name in keys:
+            settings = config[str(guild_id)][str(member_id)]['provider_settings'][name]
+            int(settings['channel_id']), settings['message_id'] and int(settings['message_id'])
+
+    def record_lookup():
+        for key in keys:
+            display = records[key]
+            display.channel_id, display.message_id
+
+    nested_seconds = min(timeit.repeat(nested_lookup, number=1, repeat=3))
+    record_seconds = min(timeit.repeat(record_lookup, number=1, repeat=3))
+
+    print(f"subscriptions: {count}")
+    print(f"nested dicts : {config_bytes / count:8.0f} B/subscription  {nested_seconds / len(keys) * 1e9:6.0f} ns/lookup")
+    print(f"slot records : {record_bytes / count:8.0f} B/subscription  {record_seconds / len(keys) * 1e9:6.0f} ns/lookup")
+
+
+if __name__ == '__main__':
+    main()
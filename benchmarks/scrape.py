@@ -0,0 +1,166 @@
+"""Scraping throughput and event loop stalls for InstagramProvider and TikTokProvider.
+
+    python -m benchmarks.scrape --pages 200 --page-kb 2048 --json-kb 256
+
+Serves large synthetic profile pages locally and scrapes them with the
+providers (``stream``) or the way they used to, reading the whole page and
+parsing it on the event loop (``baseline``). A probe task sleeping in a loop
+measures how late the event loop wakes it, which is what the gateway
+heartbeat and every other poll would see.
+"""
+import argparse
+import asyncio
+import json
+import re
+import time
+from typing import Callable, List, Optional
+
+from aiohttp import web
+from bs4 import BeautifulSoup
+
+import metrics
+from benchmarks.load import percentile, quiet
+from bot.social.http import HttpClient
+from bot.social.providers import InstagramProvider, TikTokProvider
+from bot.social.scraping import scraper
+
+
+def instagram_page(page_kb: int, json_kb: int, position: float) -> bytes:
+    user = {'edge_followed_by': {'count': 123456}, 'biography': 'x' * (json_kb * 1024)}
+    shared = {'entry_data': {'ProfilePage': [{'graphql': {'user': user}}]}}
+    padding = '<div class="filler">' + 'y' * 1000 + '</div>\n'
+    filler = padding * max(page_kb, 1)
+    split = int(len(filler) * position)
+    script = f'<script type="text/javascript">window._sharedData = {json.dumps(shared)};</script>\n'
+    return f"<html><body>{filler[:split]}{script}{filler[split:]}</body></html>".encode()
+
+
+def tiktok_page(page_kb: int, position: float) -> bytes:
+    padding = '<div class="filler"><span>' + 'z' * 1000 + '</span></div>\n'
+    filler = padding * max(page_kb, 1)
+    split = int(len(filler) * position)
+    element = '<strong title="Followers" data-e2e="followers-count">1.2M</strong>\n'
+    return f"<html><body>{filler[:split]}{element}{filler[split:]}</body></html>".encode()
+
+
+class FakePages:
+    def __init__(self, instagram: bytes, tiktok: bytes):
+        self.pages = {'instagram': instagram, 'tiktok': tiktok}
+        self.port = 0
+        self._runner: Optional[web.AppRunner] = None
+
+    async def page(self, request: web.Request) -> web.Response:
+        return web.Response(body=self.pages[request.match_info['service']], content_type='text/html')
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/{service}/{name}', self.page)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+        InstagramProvider.page_url = f"http://127.0.0.1:{self.port}/instagram"
+        TikTokProvider.page_url = f"http://127.0.0.1:{self.port}/tiktok"
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+
+async def baseline_instagram(http: HttpClient, name: str) -> int:
+    html = await http.get_text(f"{InstagramProvider.page_url}/{name}")
+    data = json.loads(re.findall(r'window\._sharedData = (.*);', html)[0])
+    return data['entry_data']['ProfilePage'][0]['graphql']['user']['edge_followed_by']['count']
+
+
+async def baseline_tiktok(http: HttpClient, name: str) -> int:
+    html = await http.get_text(f"{TikTokProvider.page_url}/{name}")
+    soup = BeautifulSoup(html, 'html.parser')
+    return len(soup("strong", {"data-e2e": "followers-count"}))
+
+
+class LagProbe:
+    """Records how late a task sleeping ``interval`` seconds at a time wakes up"""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.lags: List[float] = []
+        self._task: Optional[asyncio.Task] = None
+
+    async def _probe(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lags.append(time.perf_counter() - start - self.interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self._probe())
+
+    async def stop(self):
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+
+async def scrape_all(fetch: Callable, pages: int, concurrency: int) -> float:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(n: int):
+        async with semaphore:
+            await fetch(f"user{n}")
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(n) for n in range(pages)))
+    return time.perf_counter() - start
+
+
+async def run(args: argparse.Namespace):
+    pages = FakePages(
+        instagram_page(args.page_kb, args.json_kb, args.position),
+        tiktok_page(args.page_kb, args.position),
+    )
+    await pages.start()
+    print(f"page sizes        : instagram {len(pages.pages['instagram']) / 1024:.0f} KiB, "
+          f"tiktok {len(pages.pages['tiktok']) / 1024:.0f} KiB")
+    http = HttpClient()
+    for service in args.services.split(','):
+        if args.mode == 'baseline':
+            baseline = baseline_instagram if service == 'instagram' else baseline_tiktok
+            fetch = lambda name, baseline=baseline: baseline(http, name)
+        else:
+            provider = InstagramProvider if service == 'instagram' else TikTokProvider
+            fetch = lambda name, provider=provider: provider(name, http=http).subscriber_count()
+        # Warm up the connection pool and process pool outside the measurement
+        await fetch('warmup')
+        probe = LagProbe()
+        probe.start()
+        seconds = await scrape_all(fetch, args.pages, args.concurrency)
+        await probe.stop()
+        print(f"{service:<9} {args.mode:<8}: {args.pages / seconds:.1f} pages/s, event loop lag "
+              f"p50 {percentile(probe.lags, 0.5) * 1000:.1f}ms p99 {percentile(probe.lags, 0.99) * 1000:.1f}ms "
+              f"max {max(probe.lags, default=0) * 1000:.1f}ms")
+    if args.mode == 'stream':
+        for line in metrics.summary():
+            if line.startswith('scraping'):
+                print(f"  {line}")
+    await http.close()
+    scraper.close()
+    await pages.stop()
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mode', choices=('stream', 'baseline'), default='stream')
+    parser.add_argument('--services', default='instagram,tiktok')
+    parser.add_argument('--pages', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--page-kb', type=int, default=2048, help="HTML around the marked fragment")
+    parser.add_argument('--json-kb', type=int, default=256, help="size of the Instagram profile JSON")
+    parser.add_argument('--position', type=float, default=0.1, help="where in the page the fragment is, 0 to 1")
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args(argv)
+    quiet(args.log_level)
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,14 @@
+import os
 import textwrap
+from typing import Optional
 
 from discord.ext import commands
 from discord import app_commands, Interaction
 import discord
 import logging
 
+import metrics
+
 log = logging.getLogger(__name__)
 APP_COMMANDS_GUILDS = (
     discord.Object(id=734183623707721874),
@@ -15,6 +19,18 @@ APP_COMMANDS_GUILDS = (
 class CoreCog(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
+        self.metrics_server: Optional[metrics.MetricsServer] = None
+
+    async def cog_load(self):
+        port = os.environ.get('METRICS_PORT')
+        if port:
+            self.metrics_server = metrics.MetricsServer(port=int(port))
+            await self.metrics_server.start()
+
+    async def cog_unload(self):
+        if self.metrics_server is not None:
+            await self.metrics_server.stop()
+            self.metrics_server = None
 
     @app_commands.command(name='help', description="See the commands that this bot has to offer")
     async def help_cmd(self, itx: Interaction):
@@ -41,6 +57,11 @@ class CoreCog(commands.Cog):
             await self.bot.tree.sync(guild=o)
         await ctx.send("Commands synced", delete_after=5)
 
+    @commands.command(name='stats')
+    @commands.is_owner()
+    async def stats_text(self, ctx: commands.Context):
+        await ctx.send("```\n" + "\n".join(metrics.summary()) + "\n```")
+
 
 async def setup(bot: commands.Bot):
     await bot.add_cog(CoreCog(bot))
\ No newline at end of file
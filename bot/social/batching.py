@@ -0,0 +1,137 @@
+import asyncio
+import logging
+from functools import partial
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, TypeVar, Hashable, Iterable, Set
+
+from bot.social.limits import UpstreamLimits
+from bot.social.providers import BaseProvider, ProviderError, QuotaExceeded
+from bot.social.quota import QuotaPlanner
+from bot.social.resilience import Resilience
+from metrics import FETCH_SECONDS, FETCH_FAILURES
+
+log = logging.getLogger(__name__)
+
+T = TypeVar('T')
+Pending = List[Tuple[BaseProvider, asyncio.Future]]
+
+
+class BatchCollector:
+    """Groups concurrent subscriber count requests into batched upstream calls.
+
+    Requests for providers sharing a ``batch_key`` (same provider type and
+    credentials) are held for a short window and then issued as one
+    ``subscriber_counts()`` call per ``batch_limit`` targets. Results are
+    split back out to every waiting caller. Every upstream call runs within
+    the concurrency budgets of ``limits``, is charged to ``quota`` and is
+    retried or short-circuited by ``resilience``.
+    """
+
+    def __init__(
+            self,
+            window: float = 0.05,
+            limits: Optional[UpstreamLimits] = None,
+            quota: Optional[QuotaPlanner] = None,
+            resilience: Optional[Resilience] = None,
+    ):
+        self.window = window
+        self.limits = limits if limits is not None else UpstreamLimits()
+        self.quota = quota if quota is not None else QuotaPlanner()
+        self.resilience = resilience if resilience is not None else Resilience()
+        self._pending: Dict[Hashable, Pending] = {}
+        self._timers: Dict[Hashable, asyncio.TimerHandle] = {}
+        self._fetches: Set[asyncio.Task] = set()
+
+    async def subscriber_count(self, provider: BaseProvider) -> int:
+        key = provider.batch_key
+        if key is None:
+            return await self._timed(provider, provider.subscriber_count)
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        pending = self._pending.setdefault(key, [])
+        pending.append((provider, future))
+        if len(pending) >= provider.batch_limit:
+            self._flush(key)
+        elif key not in self._timers:
+            self._timers[key] = loop.call_later(self.window, self._flush, key)
+        return await future
+
+    async def collect(self, providers: Iterable[BaseProvider]) -> Dict[BaseProvider, int]:
+        """Fetches every provider at once, leaving failed ones out of the result"""
+        providers = list(providers)
+        results = await asyncio.gather(*(self.subscriber_count(p) for p in providers), return_exceptions=True)
+        counts = {}
+        for provider, result in zip(providers, results):
+            if isinstance(result, BaseException):
+                log.error(f"Batched fetch failed for {provider!r}: {result}")
+                continue
+            counts[provider] = result
+        return counts
+
+    async def close(self):
+        """Cancels batches still being collected or fetched, and the callers waiting on them"""
+        for key in list(self._timers):
+            self._timers.pop(key).cancel()
+        for pending in self._pending.values():
+            for _, future in pending:
+                future.cancel()
+        self._pending.clear()
+        for task in list(self._fetches):
+            task.cancel()
+        await asyncio.gather(*self._fetches, return_exceptions=True)
+
+    async def _timed(self, provider: BaseProvider, request: Callable[[], Awaitable[T]], targets: int = 1) -> T:
+        name = provider.__class__.__name__
+
+        async def attempt() -> T:
+            async with self.limits.slot(provider):
+                self.quota.charge(provider, targets)
+                with FETCH_SECONDS.time(provider=name):
+                    return await request()
+
+        try:
+            self.quota.check(provider)
+            return await self.resilience.call(provider, attempt)
+        except Exception as e:
+            if isinstance(e, QuotaExceeded):
+                self.quota.exhaust(provider)
+            FETCH_FAILURES.inc(provider=name, error=e.__class__.__name__)
+            raise
+
+    def _flush(self, key: Hashable):
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        pending = self._pending.pop(key, [])
+        if not pending:
+            return
+        task = asyncio.create_task(self._fetch(pending))
+        self._fetches.add(task)
+        task.add_done_callback(self._fetches.discard)
+
+    async def _fetch(self, pending: Pending):
+        first = pending[0][0]
+        # Sorted so the same targets always make the same URL and its validators match
+        targets = sorted({p.batch_target for p, _ in pending})
+        log.debug(f"Fetching batch of {len(targets)} targets for {first.__class__.__name__}")
+        try:
+            counts = await self._timed(first, partial(first.subscriber_counts, targets), len(targets))
+        except Exception as e:
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        except BaseException:
+            # Cancelled, callers would otherwise wait forever for a count
+            for _, future in pending:
+                future.cancel()
+            raise
+
+        for provider, future in pending:
+            if future.done():
+                continue
+            count = counts.get(provider.batch_target)
+            if count is None:
+                future.set_exception(ProviderError(f"No subscriber count returned for {provider.batch_target}"))
+            else:
+                future.set_result(count)
@@ -0,0 +1,64 @@
+import logging
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Dict, Hashable, Optional, Tuple
+
+from metrics import COUNT_CACHE_EVICTIONS, COUNT_CACHE_HITS, COUNT_CACHE_MISSES
+
+log = logging.getLogger(__name__)
+
+
+class CountCache:
+    """Bounded LRU cache of the last fetched subscriber count per provider target.
+
+    Each entry is a small tuple, so ``max_entries`` caps memory at roughly
+    ``max_entries * 200`` bytes. Freshness is decided by the caller on lookup,
+    which lets each provider type use its own TTL.
+    """
+
+    def __init__(self, max_entries: int = 50_000):
+        self.max_entries = max_entries
+        self._entries: 'OrderedDict[Hashable, Tuple[float, int]]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: Hashable, ttl: timedelta) -> Optional[int]:
+        entry = self._entries.get(key)
+        if entry is None or time.monotonic() - entry[0] > ttl.total_seconds():
+            self.misses += 1
+            COUNT_CACHE_MISSES.inc()
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        COUNT_CACHE_HITS.inc()
+        return entry[1]
+
+    def stale(self, key: Hashable) -> Optional[int]:
+        """The last fetched count however old it is"""
+        entry = self._entries.get(key)
+        return entry[1] if entry is not None else None
+
+    def put(self, key: Hashable, count: int):
+        self._entries[key] = (time.monotonic(), count)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+            COUNT_CACHE_EVICTIONS.inc()
+
+    def invalidate(self, key: Hashable):
+        self._entries.pop(key, None)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
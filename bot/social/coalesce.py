@@ -0,0 +1,59 @@
+import asyncio
+import logging
+import time
+from functools import partial
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple, TypeVar
+
+log = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+
+class SingleFlight:
+    """Collapses concurrent calls for the same key into one.
+
+    Every caller that arrives while a call for its key is in flight awaits that
+    same call. Results stay shareable for ``freshness`` seconds after it
+    finishes, so callers arriving just after it also reuse it.
+    """
+
+    def __init__(self, freshness: float = 0.0):
+        self.freshness = freshness
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self._recent: Dict[Hashable, Tuple[float, Any]] = {}
+        self.shared = 0
+        self.calls = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]], freshness: Optional[float] = None) -> T:
+        freshness = self.freshness if freshness is None else freshness
+        recent = self._recent.get(key)
+        if recent is not None and time.monotonic() - recent[0] <= freshness:
+            self.shared += 1
+            return recent[1]
+
+        future = self._inflight.get(key)
+        if future is None:
+            self.calls += 1
+            future = asyncio.ensure_future(fn())
+            self._inflight[key] = future
+            future.add_done_callback(partial(self._finished, key))
+        else:
+            self.shared += 1
+        # One caller giving up must not cancel the call for everyone else
+        return await asyncio.shield(future)
+
+    def forget(self, key: Hashable):
+        self._recent.pop(key, None)
+
+    def _finished(self, key: Hashable, future: asyncio.Future):
+        self._inflight.pop(key, None)
+        if future.cancelled() or future.exception() is not None:
+            return
+        if self.freshness > 0:
+            if len(self._recent) > 1024:
+                self._prune()
+            self._recent[key] = (time.monotonic(), future.result())
+
+    def _prune(self):
+        cutoff = time.monotonic() - self.freshness
+        self._recent = {k: v for k, v in self._recent.items() if v[0] >= cutoff}
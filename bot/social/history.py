@@ -0,0 +1,404 @@
+import asyncio
+import logging
+import mmap
+import os
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import islice
+from typing import Dict, List, NamedTuple, Optional, Sequence, Set, Tuple
+from urllib.parse import quote, unquote
+
+BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../', 'static', 'history'))
+
+log = logging.getLogger(__name__)
+
+# (provider name, target id)
+SeriesKey = Tuple[str, str]
+# column name -> values, all columns the same length
+Columns = Dict[str, array]
+
+RAW_COLUMNS = ('ts', 'cnt')
+ROLLUP_COLUMNS = ('ts', 'min', 'max', 'last')
+# Marks the rewritten columns of a tier as complete, see HistoryStore._rewrite
+COMMIT_SUFFIX = '.commit'
+
+HOUR = 3600
+DAY = 24 * HOUR
+
+
+class Tier(NamedTuple):
+    name: str
+    width: int  # bucket width in seconds, 0 for raw points
+    retention: Optional[int]  # seconds kept, None to keep forever
+
+
+DEFAULT_TIERS = (
+    Tier('raw', 0, 7 * DAY),
+    Tier('hourly', HOUR, 90 * DAY),
+    Tier('daily', DAY, 3650 * DAY),
+)
+
+
+class Bucket(NamedTuple):
+    timestamp: int
+    min: int
+    max: int
+    last: int
+
+
+class Series:
+    """Points appended since the last flush, one array per column"""
+    __slots__ = ('timestamps', 'counts')
+
+    def __init__(self):
+        self.timestamps = array('q')
+        self.counts = array('q')
+
+    def __len__(self):
+        return len(self.timestamps)
+
+
+def _escape(value: str) -> str:
+    # Dots separate the parts of a file name
+    return quote(value, safe='').replace('.', '%2E')
+
+
+def _as_rollup(raw: Columns) -> Columns:
+    counts = raw['cnt']
+    return {'ts': raw['ts'], 'min': counts, 'max': counts, 'last': counts}
+
+
+def _concat(first: Columns, second: Columns) -> Columns:
+    return {column: first[column] + second[column] for column in ROLLUP_COLUMNS}
+
+
+def roll_up(rows: Columns, width: int, lo: int = 0, hi: Optional[int] = None) -> Columns:
+    """Folds rows[lo:hi] (sorted, rollup shaped) into buckets of width seconds"""
+    hi = len(rows['ts']) if hi is None else hi
+    out = {column: array('q') for column in ROLLUP_COLUMNS}
+    timestamps, mins, maxs, lasts = (rows[c] for c in ROLLUP_COLUMNS)
+    for i in range(lo, hi):
+        bucket = timestamps[i] - timestamps[i] % width
+        if out['ts'] and out['ts'][-1] == bucket:
+            out['min'][-1] = min(out['min'][-1], mins[i])
+            out['max'][-1] = max(out['max'][-1], maxs[i])
+            out['last'][-1] = lasts[i]
+        else:
+            out['ts'].append(bucket)
+            out['min'].append(mins[i])
+            out['max'].append(maxs[i])
+            out['last'].append(lasts[i])
+    return out
+
+
+class HistoryStore:
+    """Append-only subscriber count history with rollup tiers.
+
+    Each series is stored as int64 columns, one file per column. New points
+    are appended to in-memory arrays and flushed to the raw tier. A background
+    pass, a slice of the series at a time, folds finished hours and days into
+    min/max/last rollups and drops rows past each tier's retention. Files are
+    memory-mapped for range queries.
+    """
+
+    def __init__(
+            self,
+            path: str = BASE_DIR,
+            flush_interval: float = 60.0,
+            tiers: Sequence[Tier] = DEFAULT_TIERS,
+            compact_batch: int = 100,
+    ):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.tiers = tuple(tiers)
+        self.compact_batch = compact_batch
+        self._pending: Dict[SeriesKey, Series] = {}
+        self._last: Dict[SeriesKey, int] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._lock = threading.Lock()
+        self._cursor: Optional[SeriesKey] = None
+        self.points = 0
+        os.makedirs(self.path, exist_ok=True)
+        self._recover()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._maintain())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    def append(self, key: SeriesKey, count: int, timestamp: Optional[int] = None):
+        timestamp = int(time.time()) if timestamp is None else timestamp
+        if timestamp < self._last.get(key, timestamp):
+            # Columns must stay sorted for range queries
+            return
+        series = self._pending.get(key)
+        if series is None:
+            series = self._pending[key] = Series()
+        series.timestamps.append(timestamp)
+        series.counts.append(count)
+        self._last[key] = timestamp
+        self.points += 1
+
+    def pick_tier(self, key: SeriesKey, start: int, end: int, max_points: int, now: Optional[int] = None) -> Tier:
+        """The finest tier still holding start that answers within max_points"""
+        now = int(time.time()) if now is None else now
+        covering = [t for t in self.tiers if t.retention is None or start >= now - t.retention]
+        for tier in covering:
+            if tier.width:
+                estimate = (end - start) // tier.width + 1
+            else:
+                estimate = self._count(key, tier, start, end)
+            if estimate <= max_points:
+                return tier
+        return covering[-1] if covering else self.tiers[-1]
+
+    def query(self, key: SeriesKey, start: int, end: int, max_points: int = 1000) -> List[Bucket]:
+        """Buckets with start <= timestamp <= end, oldest first, from the cheapest tier covering the range"""
+        return self.query_tier(key, self.pick_tier(key, start, end, max_points), start, end)
+
+    def query_tier(self, key: SeriesKey, tier: Tier, start: int, end: int) -> List[Bucket]:
+        tail = None
+        with self._lock:
+            rows = self._read(key, tier, start, end)
+            if tier.width:
+                # Recent buckets may not be compacted yet, fill them in from raw points
+                covered = rows['ts'][-1] + tier.width if rows['ts'] else start
+                tail = _as_rollup(self._read(key, self.tiers[0], covered, end))
+            else:
+                rows = _as_rollup(rows)
+        series = self._pending.get(key)
+        if series is not None:
+            lo = bisect_left(series.timestamps, start)
+            hi = bisect_right(series.timestamps, end)
+            pending = _as_rollup({'ts': series.timestamps[lo:hi], 'cnt': series.counts[lo:hi]})
+            if tail is None:
+                rows = _concat(rows, pending)
+            else:
+                tail = _concat(tail, pending)
+        if tail is not None and tail['ts']:
+            rows = _concat(rows, roll_up(tail, tier.width))
+        return [Bucket(*row) for row in zip(*(rows[c] for c in ROLLUP_COLUMNS))]
+
+    async def flush(self):
+        pending, self._pending = self._pending, {}
+        if pending:
+            await asyncio.get_running_loop().run_in_executor(None, self._write, pending)
+
+    async def compact(self, now: Optional[int] = None):
+        """Rolls up and expires the next slice of series"""
+        await self.flush()
+        now = int(time.time()) if now is None else now
+        await asyncio.get_running_loop().run_in_executor(None, self._compact_batch, now)
+
+    def series_keys(self) -> List[SeriesKey]:
+        return sorted(self._stored_keys() | set(self._pending))
+
+    def _stored_keys(self) -> Set[SeriesKey]:
+        keys = set()
+        for filename in os.listdir(self.path):
+            if filename.endswith('.ts'):
+                name, target = filename.split('.')[:2]
+                keys.add((unquote(name), unquote(target)))
+        return keys
+
+    def _columns(self, tier: Tier) -> Tuple[str, ...]:
+        return ROLLUP_COLUMNS if tier.width else RAW_COLUMNS
+
+    def _prefix(self, key: SeriesKey, tier: Tier) -> str:
+        name, target = key
+        prefix = f"{_escape(name)}.{_escape(target)}"
+        if tier.width:
+            prefix = f"{prefix}.{tier.name}"
+        return os.path.join(self.path, prefix)
+
+    def _file(self, key: SeriesKey, tier: Tier, column: str) -> str:
+        return f"{self._prefix(key, tier)}.{column}"
+
+    def _recover(self):
+        """Settles every rewrite a crash interrupted before the store was opened"""
+        prefixes = set()
+        for filename in os.listdir(self.path):
+            if filename.endswith(COMMIT_SUFFIX):
+                prefixes.add(filename[:-len(COMMIT_SUFFIX)])
+            elif filename.endswith('.tmp'):
+                prefixes.add(filename.rsplit('.', 2)[0])
+        for prefix in prefixes:
+            self._settle(os.path.join(self.path, prefix))
+
+    def _settle(self, prefix: str):
+        """Rolls a rewrite of the columns at prefix forward if it was committed, back if not"""
+        marker = f"{prefix}{COMMIT_SUFFIX}"
+        committed = os.path.exists(marker)
+        for column in dict.fromkeys(RAW_COLUMNS + ROLLUP_COLUMNS):
+            path = f"{prefix}.{column}"
+            if os.path.exists(f"{path}.tmp"):
+                if committed:
+                    os.replace(f"{path}.tmp", path)
+                else:
+                    os.remove(f"{path}.tmp")
+        if committed:
+            os.remove(marker)
+
+    def _rewrite(self, key: SeriesKey, tier: Tier, rows: Columns):
+        """Replaces whole columns of the tier. Every new column is written out before
+        the commit marker, so a crash leaves either all of them replaced or none"""
+        prefix = self._prefix(key, tier)
+        for column, values in rows.items():
+            with open(f"{prefix}.{column}.tmp", 'wb') as f:
+                values.tofile(f)
+        open(f"{prefix}{COMMIT_SUFFIX}", 'wb').close()
+        self._settle(prefix)
+
+    def _align(self, key: SeriesKey, tier: Tier):
+        """Brings the tier's columns back to the rows every one of them holds in full.
+
+        Appends write timestamps last, so a crash part way through leaves the other
+        columns with extra rows at the end, which are cut off. Columns shorter than
+        the timestamps lost rows from the front in an interrupted trim, so the
+        others are trimmed to match."""
+        self._settle(self._prefix(key, tier))
+        columns = self._columns(tier)
+        paths = {column: self._file(key, tier, column) for column in columns}
+        sizes = {column: os.path.getsize(path) if os.path.exists(path) else 0 for column, path in paths.items()}
+        itemsize = array('q').itemsize
+        rows = min(sizes.values()) // itemsize
+        if rows < sizes['ts'] // itemsize:
+            trimmed = {}
+            for column, values in self._load(key, tier).items():
+                if len(values) > rows:
+                    log.warning(f"Trimming {os.path.basename(paths[column])} from {len(values)} to its last {rows} rows after a torn trim")
+                    trimmed[column] = values[len(values) - rows:]
+            self._rewrite(key, tier, trimmed)
+            return
+        for column, path in paths.items():
+            if sizes[column] != rows * itemsize:
+                log.warning(f"Truncating {os.path.basename(path)} from {sizes[column] // itemsize} to {rows} rows after a torn write")
+                os.truncate(path, rows * itemsize)
+
+    def _write(self, pending: Dict[SeriesKey, Series]):
+        start = time.perf_counter()
+        raw_tier = self.tiers[0]
+        with self._lock:
+            for key, series in pending.items():
+                self._align(key, raw_tier)
+                # Counts first so a crash in between never leaves timestamps without counts
+                with open(self._file(key, raw_tier, 'cnt'), 'ab') as f:
+                    series.counts.tofile(f)
+                with open(self._file(key, raw_tier, 'ts'), 'ab') as f:
+                    series.timestamps.tofile(f)
+        log.debug(f"Flushed history for {len(pending)} series in {time.perf_counter() - start:.4f}s")
+
+    def _count(self, key: SeriesKey, tier: Tier, start: int, end: int) -> int:
+        with self._lock:
+            count = len(self._read(key, tier, start, end, columns=('ts',))['ts'])
+        series = self._pending.get(key)
+        if series is not None and not tier.width:
+            count += bisect_right(series.timestamps, end) - bisect_left(series.timestamps, start)
+        return count
+
+    def _read(self, key: SeriesKey, tier: Tier, start: int, end: int, columns: Optional[Sequence[str]] = None) -> Columns:
+        """Memory-maps the tier's timestamps and copies out the rows in [start, end]"""
+        columns = columns or self._columns(tier)
+        rows = {column: array('q') for column in columns}
+        try:
+            ts_file = open(self._file(key, tier, 'ts'), 'rb')
+        except FileNotFoundError:
+            return rows
+        with ts_file:
+            size = os.fstat(ts_file.fileno()).st_size
+            if size == 0:
+                return rows
+            with mmap.mmap(ts_file.fileno(), size, access=mmap.ACCESS_READ) as ts_map:
+                view = memoryview(ts_map).cast('q')
+                try:
+                    lo = bisect_left(view, start)
+                    hi = bisect_right(view, end)
+                finally:
+                    view.release()
+        if lo == hi:
+            return rows
+        for column, values in rows.items():
+            with open(self._file(key, tier, column), 'rb') as f:
+                f.seek(lo * values.itemsize)
+                values.frombytes(f.read((hi - lo) * values.itemsize))
+        return rows
+
+    def _load(self, key: SeriesKey, tier: Tier) -> Columns:
+        rows = {}
+        for column in self._columns(tier):
+            values = array('q')
+            try:
+                with open(self._file(key, tier, column), 'rb') as f:
+                    values.frombytes(f.read())
+            except FileNotFoundError:
+                pass
+            rows[column] = values
+        return rows
+
+    def _compact_batch(self, now: int):
+        start = time.perf_counter()
+        keys = sorted(self._stored_keys())
+        if self._cursor is not None:
+            split = bisect_right(keys, self._cursor)
+            keys = keys[split:] + keys[:split]
+        batch = list(islice(keys, self.compact_batch))
+        for key in batch:
+            with self._lock:
+                self._compact_series(key, now)
+        self._cursor = batch[-1] if batch else None
+        log.debug(f"Compacted history for {len(batch)} series in {time.perf_counter() - start:.4f}s")
+
+    def _compact_series(self, key: SeriesKey, now: int):
+        for tier in self.tiers:
+            self._align(key, tier)
+        for source, tier in zip(self.tiers, self.tiers[1:]):
+            rows = self._load(key, source)
+            if not source.width:
+                rows = _as_rollup(rows)
+            done = self._read(key, tier, 0, now, columns=('ts',))['ts']
+            first = done[-1] + tier.width if done else 0
+            lo = bisect_left(rows['ts'], first)
+            # Only buckets that have finished
+            hi = bisect_left(rows['ts'], now - now % tier.width)
+            if lo < hi:
+                buckets = roll_up(rows, tier.width, lo, hi)
+                for column in reversed(ROLLUP_COLUMNS):
+                    with open(self._file(key, tier, column), 'ab') as f:
+                        buckets[column].tofile(f)
+        for i, tier in enumerate(self.tiers):
+            if tier.retention is None:
+                continue
+            cutoff = now - tier.retention
+            if i + 1 < len(self.tiers):
+                # Never drop rows the next tier has not absorbed yet
+                coarser = self.tiers[i + 1].width
+                cutoff = min(cutoff, now - now % coarser)
+            self._expire(key, tier, cutoff)
+
+    def _expire(self, key: SeriesKey, tier: Tier, cutoff: int):
+        rows = self._load(key, tier)
+        expired = bisect_left(rows['ts'], cutoff)
+        if expired == 0:
+            return
+        if expired < len(rows['ts']):
+            self._rewrite(key, tier, {column: values[expired:] for column, values in rows.items()})
+            return
+        # Timestamps last, a crash in between leaves them longer and _align trims the rest
+        for column in reversed(self._columns(tier)):
+            os.remove(self._file(key, tier, column))
+
+    async def _maintain(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.compact()
+            except Exception:
+                log.exception("Maintaining subscriber history failed")
@@ -0,0 +1,220 @@
+import json
+import logging
+import time
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from typing import Optional, Any, Callable, Dict
+
+import aiohttp
+
+from metrics import UPSTREAM_BYTES, UPSTREAM_BYTES_SAVED, UPSTREAM_RESPONSES, UPSTREAM_ERRORS
+
+log = logging.getLogger(__name__)
+
+
+class UpstreamStatusError(Exception):
+    """The upstream answered with a status that means it is overloaded or failing"""
+
+    def __init__(self, url: str, status: int, retry_after: Optional[float] = None):
+        super().__init__(f"{status} from {url.split('?')[0]}")
+        self.status = status
+        self.retry_after = retry_after
+
+
+def retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait from a Retry-After header given as seconds or an HTTP date"""
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def raise_for_unavailable(resp: aiohttp.ClientResponse):
+    if resp.status == 429 or resp.status >= 500:
+        raise UpstreamStatusError(str(resp.url), resp.status, retry_after(resp.headers.get('Retry-After')))
+
+
+class UpstreamUnauthorized(Exception):
+    """The upstream rejected the credentials the request was sent with"""
+
+    def __init__(self, url: str):
+        super().__init__(f"401 from {url.split('?')[0]}")
+
+
+class ClientClosed(RuntimeError):
+    """The client was closed and will not open a new session"""
+    pass
+
+
+class Validated:
+    """A decoded response body with the validators it was served with"""
+    __slots__ = ('etag', 'last_modified', 'data', 'size')
+
+    def __init__(self, etag: Optional[str], last_modified: Optional[str], data: Any, size: int):
+        self.etag = etag
+        self.last_modified = last_modified
+        self.data = data
+        self.size = size
+
+
+class ValidatorCache:
+    """Decoded bodies of responses that carried an ETag or Last-Modified, by URL.
+
+    Lets a GET be sent as a conditional request and a ``304 Not Modified``
+    answered from the body decoded last time. Bounded by the size of the
+    original bodies, least recently used first out.
+    """
+
+    def __init__(self, max_bytes: int = 16 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._entries: 'OrderedDict[str, Validated]' = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, url: str) -> Optional[Validated]:
+        entry = self._entries.get(url)
+        if entry is not None:
+            self._entries.move_to_end(url)
+        return entry
+
+    def put(self, url: str, entry: Validated):
+        self.invalidate(url)
+        if entry.size > self.max_bytes:
+            return
+        self._entries[url] = entry
+        self.bytes += entry.size
+        while self.bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.bytes -= evicted.size
+
+    def invalidate(self, url: str):
+        entry = self._entries.pop(url, None)
+        if entry is not None:
+            self.bytes -= entry.size
+
+
+class HttpClient:
+    """Bot-wide pooled HTTP client shared by every provider.
+
+    Holds a single ``aiohttp.ClientSession`` so that polls reuse keep-alive
+    connections and cached DNS lookups instead of paying for a fresh
+    handshake on every request. ``get_json`` and ``get_text`` send
+    ``If-None-Match``/``If-Modified-Since`` for URLs that returned validators
+    before and serve a 304 from the body decoded then. Once closed the client
+    stays closed, so a poll that outlives its owner cannot reopen the pool.
+    """
+    _default: Optional['HttpClient'] = None
+
+    def __init__(
+            self,
+            *,
+            limit: int = 100,
+            limit_per_host: int = 20,
+            ttl_dns_cache: int = 300,
+            keepalive_timeout: float = 30.0,
+            total_timeout: float = 15.0,
+            connect_timeout: float = 5.0,
+            validator_bytes: int = 16 * 2 ** 20,
+    ):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.ttl_dns_cache = ttl_dns_cache
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = aiohttp.ClientTimeout(total=total_timeout, connect=connect_timeout)
+        self.validators = ValidatorCache(validator_bytes)
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._closed = False
+
+    @classmethod
+    def default(cls) -> 'HttpClient':
+        """Fallback client for providers created outside of the ProviderCog"""
+        if cls._default is None or cls._default.closed:
+            cls._default = cls()
+        return cls._default
+
+    @property
+    def closed(self) -> bool:
+        return self._closed or (self._session is not None and self._session.closed)
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        # The session binds to the running loop so it is created on first use
+        if self._closed:
+            raise ClientClosed("HTTP client is closed")
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                ttl_dns_cache=self.ttl_dns_cache,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=self.timeout,
+                trace_configs=[self._trace_config()],
+            )
+            log.debug(f"HTTP session opened (limit={self.limit}, per host={self.limit_per_host})")
+        return self._session
+
+    @staticmethod
+    def _trace_config() -> aiohttp.TraceConfig:
+        async def on_request_end(session, context, params: aiohttp.TraceRequestEndParams):
+            UPSTREAM_RESPONSES.inc(host=params.url.host, status=str(params.response.status))
+
+        async def on_request_exception(session, context, params: aiohttp.TraceRequestExceptionParams):
+            UPSTREAM_ERRORS.inc(host=params.url.host, error=params.exception.__class__.__name__)
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_end.append(on_request_end)
+        trace_config.on_request_exception.append(on_request_exception)
+        return trace_config
+
+    def get(self, url: str, **kwargs):
+        return self.session.get(url, **kwargs)
+
+    def post(self, url: str, **kwargs):
+        return self.session.post(url, **kwargs)
+
+    async def _get_validated(self, url: str, headers: Optional[Dict[str, str]], decode: Callable[[bytes, str], Any], **kwargs) -> Any:
+        cached = self.validators.get(url)
+        if cached is not None:
+            headers = dict(headers or {})
+            if cached.etag:
+                headers['If-None-Match'] = cached.etag
+            if cached.last_modified:
+                headers['If-Modified-Since'] = cached.last_modified
+        async with self.session.get(url, headers=headers, **kwargs) as resp:
+            if resp.status == 304 and cached is not None:
+                UPSTREAM_BYTES_SAVED.inc(cached.size, host=resp.url.host)
+                return cached.data
+            if resp.status == 401:
+                raise UpstreamUnauthorized(url)
+            raise_for_unavailable(resp)
+            body = await resp.read()
+            UPSTREAM_BYTES.inc(len(body), host=resp.url.host)
+            data = decode(body, resp.get_encoding())
+            etag, last_modified = resp.headers.get('ETag'), resp.headers.get('Last-Modified')
+            if resp.status == 200 and (etag or last_modified):
+                self.validators.put(url, Validated(etag, last_modified, data, len(body)))
+            elif cached is not None:
+                self.validators.invalidate(url)
+            return data
+
+    async def get_json(self, url: str, headers: Optional[Dict[str, str]] = None, **kwargs) -> Any:
+        return await self._get_validated(url, headers, lambda body, encoding: json.loads(body.decode(encoding)), **kwargs)
+
+    async def get_text(self, url: str, headers: Optional[Dict[str, str]] = None, **kwargs) -> str:
+        return await self._get_validated(url, headers, lambda body, encoding: body.decode(encoding, errors='replace'), **kwargs)
+
+    async def close(self):
+        self._closed = True
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            log.debug("HTTP session closed")
+        self._session = None
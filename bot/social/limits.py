@@ -0,0 +1,107 @@
+import asyncio
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Hashable, List
+
+from metrics import UPSTREAM_IN_FLIGHT, UPSTREAM_QUEUE_SECONDS
+
+log = logging.getLogger(__name__)
+
+
+class Budget:
+    """A named cap on concurrent upstream requests"""
+
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = limit
+        self.active = 0
+        self.waiting = 0
+        self._semaphore = asyncio.Semaphore(limit)
+
+    async def acquire(self):
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.active += 1
+
+    def release(self):
+        self.active -= 1
+        self._semaphore.release()
+
+
+class UpstreamLimits:
+    """Concurrency budgets around every upstream subscriber count request.
+
+    A request takes a slot from its credential's budget, then its provider
+    type's, then the global one, always in that order so budgets never wait
+    on each other in a cycle. Provider types may set ``concurrency_limit`` to
+    override the per type default. Time spent waiting for slots is recorded
+    per provider type.
+    """
+
+    def __init__(self, total: int = 64, per_provider: int = 16, per_credential: int = 8):
+        self.total = Budget('global', total)
+        self.per_provider = per_provider
+        self.per_credential = per_credential
+        self._providers: Dict[str, Budget] = {}
+        self._credentials: Dict[Hashable, Budget] = {}
+
+    @classmethod
+    def from_env(cls) -> 'UpstreamLimits':
+        return cls(
+            total=int(os.environ.get('UPSTREAM_CONCURRENCY', 64)),
+            per_provider=int(os.environ.get('UPSTREAM_PROVIDER_CONCURRENCY', 16)),
+            per_credential=int(os.environ.get('UPSTREAM_CREDENTIAL_CONCURRENCY', 8)),
+        )
+
+    def budgets_for(self, provider) -> List[Budget]:
+        name = provider.__class__.__name__
+        budgets = []
+        if provider.credential_scope is not None:
+            key = (name, provider.credential_scope)
+            budget = self._credentials.get(key)
+            if budget is None:
+                budget = self._credentials[key] = Budget(f"{name} credential", self.per_credential)
+            budgets.append(budget)
+        budget = self._providers.get(name)
+        if budget is None:
+            limit = getattr(provider, 'concurrency_limit', None) or self.per_provider
+            budget = self._providers[name] = Budget(name, limit)
+        budgets.append(budget)
+        budgets.append(self.total)
+        return budgets
+
+    @asynccontextmanager
+    async def slot(self, provider):
+        name = provider.__class__.__name__
+        budgets = self.budgets_for(provider)
+        start = time.perf_counter()
+        acquired = []
+        try:
+            for budget in budgets:
+                await budget.acquire()
+                acquired.append(budget)
+            UPSTREAM_QUEUE_SECONDS.observe(time.perf_counter() - start, provider=name)
+            UPSTREAM_IN_FLIGHT.inc(provider=name)
+            try:
+                yield
+            finally:
+                UPSTREAM_IN_FLIGHT.dec(provider=name)
+        finally:
+            for budget in reversed(acquired):
+                budget.release()
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        budgets = [self.total, *self._providers.values()]
+        stats = {b.name: {'limit': b.limit, 'active': b.active, 'waiting': b.waiting} for b in budgets}
+        credentials = list(self._credentials.values())
+        stats['credentials'] = {
+            'budgets': len(credentials),
+            'saturated': sum(1 for b in credentials if b.active >= b.limit),
+            'waiting': sum(b.waiting for b in credentials),
+        }
+        return stats
@@ -0,0 +1,97 @@
+from datetime import timedelta
+from typing import Any, Dict, Optional, Tuple
+
+from services import string_timedelta, format_timedelta
+
+# (guild id, member id, provider name)
+RecordKey = Tuple[int, int, str]
+
+DEFAULT_INTERVAL = timedelta(minutes=5)
+
+
+class ProviderCredentials:
+    """A member's settings for one provider, stored as
+    ``providers[name] = {'payload': {...}}`` in the ProviderCog namespace"""
+    __slots__ = ('guild_id', 'member_id', 'provider', 'payload')
+
+    def __init__(self, guild_id: int, member_id: int, provider: str, payload: Dict[str, str]):
+        self.guild_id = guild_id
+        self.member_id = member_id
+        self.provider = provider
+        self.payload = payload
+
+    @property
+    def key(self) -> RecordKey:
+        return self.guild_id, self.member_id, self.provider
+
+    @classmethod
+    def from_config(cls, guild_id: str, member_id: str, provider: str, data: Dict[str, Any]) -> Optional['ProviderCredentials']:
+        payload = data.get('payload')
+        if payload is None:
+            return None
+        return cls(int(guild_id), int(member_id), provider, payload)
+
+    def to_config(self) -> Dict[str, Any]:
+        return {'payload': dict(self.payload)}
+
+
+class DisplaySettings:
+    """A member's subscriber display for one provider, stored as
+    ``provider_settings[name] = {...}`` in the SubscriberCog namespace"""
+    __slots__ = ('guild_id', 'member_id', 'provider', 'channel_id', 'message_id', 'text', 'banner_url', 'interval', 'max_interval', 'heartbeat')
+
+    def __init__(
+            self,
+            guild_id: int,
+            member_id: int,
+            provider: str,
+            channel_id: int,
+            message_id: Optional[int],
+            text: str,
+            banner_url: str,
+            interval: timedelta = DEFAULT_INTERVAL,
+            heartbeat: Optional[timedelta] = None,
+            max_interval: Optional[timedelta] = None,
+    ):
+        self.guild_id = guild_id
+        self.member_id = member_id
+        self.provider = provider
+        self.channel_id = channel_id
+        self.message_id = message_id
+        self.text = text
+        self.banner_url = banner_url
+        self.interval = interval
+        # Polls back off from interval up to max_interval while the count is unchanged
+        self.max_interval = max_interval
+        self.heartbeat = heartbeat
+
+    @property
+    def key(self) -> RecordKey:
+        return self.guild_id, self.member_id, self.provider
+
+    @classmethod
+    def from_config(cls, guild_id: str, member_id: str, provider: str, data: Dict[str, Any]) -> 'DisplaySettings':
+        message_id = data.get('message_id')
+        return cls(
+            int(guild_id),
+            int(member_id),
+            provider,
+            channel_id=int(data['channel_id']),
+            message_id=int(message_id) if message_id else None,
+            text=data['text'],
+            banner_url=data['banner_url'],
+            interval=string_timedelta(data.get('interval', '')) or DEFAULT_INTERVAL,
+            heartbeat=string_timedelta(data.get('heartbeat') or '') or None,
+            max_interval=string_timedelta(data.get('max_interval') or '') or None,
+        )
+
+    def to_config(self) -> Dict[str, Any]:
+        return {
+            'text': self.text,
+            'banner_url': self.banner_url,
+            'channel_id': str(self.channel_id),
+            'interval': format_timedelta(self.interval),
+            'max_interval': format_timedelta(self.max_interval) if self.max_interval else '',
+            'heartbeat': format_timedelta(self.heartbeat) if self.heartbeat else '',
+            'message_id': self.message_id,
+        }
@@ -0,0 +1,121 @@
+import asyncio
+import logging
+from datetime import datetime, timezone, timedelta
+from typing import Dict, Optional, Tuple
+
+import aiohttp
+
+from bot.social.http import HttpClient, raise_for_unavailable
+
+log = logging.getLogger(__name__)
+
+TokenKey = Tuple[str, str, str]
+
+
+class AuthenticationError(Exception):
+    pass
+
+
+class AppToken(dict):
+    def __init__(self, *args, **kwargs):
+        super(AppToken, self).__init__(*args, **kwargs)
+        self.issued_at = datetime.now(timezone.utc)
+        self.expires_at = self.issued_at + timedelta(seconds=self['expires_in'])
+
+    @property
+    def is_valid(self):
+        now = datetime.now(timezone.utc)
+        return now < self.expires_at
+
+    @property
+    def lifetime(self) -> timedelta:
+        return self.expires_at - self.issued_at
+
+    def expires_within(self, span: timedelta) -> bool:
+        return datetime.now(timezone.utc) + span >= self.expires_at
+
+    @property
+    def auth_value(self) -> str:
+        return f"{self.get('token_type', 'bearer').capitalize()} {self['access_token']}"
+
+
+class TokenCache:
+    """Shared client-credentials token cache keyed by token url, client id and secret.
+
+    Tokens are reused until ``expiry_margin`` before they expire. Once less than
+    ``refresh_ahead`` of their lifetime is left a replacement is fetched in the
+    background while the current token keeps being served. Concurrent refreshes
+    for the same key share a single request.
+    """
+
+    def __init__(self, expiry_margin: timedelta = timedelta(minutes=1), refresh_ahead: float = 0.1):
+        self.expiry_margin = expiry_margin
+        self.refresh_ahead = refresh_ahead
+        self._tokens: Dict[TokenKey, AppToken] = {}
+        self._refreshes: Dict[TokenKey, asyncio.Task] = {}
+
+    async def token(self, http: HttpClient, token_url: str, client_id: str, client_secret: str) -> AppToken:
+        key = (token_url, client_id, client_secret)
+        token = self._tokens.get(key)
+        if token is not None and not token.expires_within(self.expiry_margin):
+            if token.expires_within(token.lifetime * self.refresh_ahead):
+                self._refresh(key, http)
+            return token
+        # A caller cancelled while waiting must not cancel the refresh other callers share
+        return await asyncio.shield(self._refresh(key, http))
+
+    def invalidate(self, token_url: str, client_id: str, client_secret: str):
+        self._tokens.pop((token_url, client_id, client_secret), None)
+
+    def _refresh(self, key: TokenKey, http: HttpClient) -> asyncio.Task:
+        task = self._refreshes.get(key)
+        if task is None:
+            task = asyncio.create_task(self._request_token(key, http))
+            self._refreshes[key] = task
+            task.add_done_callback(lambda t: self._refresh_finished(key, t))
+        return task
+
+    def _refresh_finished(self, key: TokenKey, task: asyncio.Task):
+        self._refreshes.pop(key, None)
+        if not task.cancelled() and task.exception() is not None:
+            log.error(f"Token refresh for client {key[1]} failed: {task.exception()}")
+
+    async def _request_token(self, key: TokenKey, http: HttpClient) -> AppToken:
+        token_url, client_id, client_secret = key
+        fields = {
+            'client_id': client_id,
+            'client_secret': client_secret,
+            'grant_type': 'client_credentials'
+        }
+        async with http.post(token_url, data=aiohttp.FormData(fields)) as resp:
+            raise_for_unavailable(resp)
+            data = await resp.json()
+        if 'access_token' not in data:
+            raise AuthenticationError(data.get('message', f"Token request to {token_url} failed"))
+        token = AppToken(**data)
+        self._tokens[key] = token
+        log.debug(f"Fetched app token for client {client_id}, expires {token.expires_at}")
+        return token
+
+
+token_cache = TokenCache()
+
+
+class ApplicationOAuth:
+    """Client-credentials grant for a single application, backed by a shared TokenCache"""
+
+    def __init__(self, token_url: str, client_id: str, client_secret: str, cache: Optional[TokenCache] = None):
+        self.token_url = token_url
+        self.client_id = client_id
+        self._client_secret = client_secret
+        self.cache = cache if cache is not None else token_cache
+
+    async def auth_header(self, http: HttpClient) -> Dict[str, str]:
+        token = await self.cache.token(http, self.token_url, self.client_id, self._client_secret)
+        return {
+            'Authorization': token.auth_value,
+            'Client-Id': self.client_id
+        }
+
+    def invalidate(self):
+        self.cache.invalidate(self.token_url, self.client_id, self._client_secret)
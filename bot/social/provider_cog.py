@@ -1,16 +1,25 @@
-import asyncio
 from datetime import timedelta
-from typing import List, Protocol, Optional, Callable, Any, Dict, Type
+from typing import List, Protocol, Optional, Callable, Any, Dict, Type, Hashable, Sequence, Tuple
 
 import discord
 from discord.ext import commands
 from discord import app_commands, ui
 from discord.interactions import Interaction
 
+from bot.social.batching import BatchCollector
+from bot.social.cache import CountCache
+from bot.social.coalesce import SingleFlight
+from bot.social.http import HttpClient
+from bot.social.limits import UpstreamLimits
+from bot.social.quota import QuotaPlanner
+from bot.social.resilience import Resilience, UNAVAILABLE
+from bot.social.scraping import scraper
+from bot.social.models import ProviderCredentials, RecordKey
 from bot.social.providers import YouTubeProvider, RedditProvider, TwitchProvider, TwitterProvider
+from bot.social.registry import ProviderRegistry
+from bot.social.scheduler import Backoff, PollScheduler
 
 from mixins.config import ConfigMixin
-from discord.ext import tasks
 import logging
 from functools import partial
 from services import establish_member_config
@@ -18,12 +27,22 @@ from services import establish_member_config
 log = logging.getLogger(__name__)
 
 class Provider(Protocol):
+    batch_limit: int
+    target_id: str
+    batch_key: Optional[Hashable]
+    batch_target: str
+    flight_key: Hashable
+    cache_ttl: timedelta
+
     def __call__(self, *args, **kwargs):
         return self
 
     async def subscriber_count(self) -> int:
         ...
 
+    async def subscriber_counts(self, targets: Sequence[str]) -> Dict[str, int]:
+        ...
+
     async def verify_config(self) -> bool:
         ...
 
@@ -34,49 +53,84 @@ class ProviderConfig:
         self.provider = provider
         self.name = name
         self.init_kwargs = object_init_descriptions
+        self.http: Optional[HttpClient] = None
 
     def create(self, **kwargs):
-        return self.provider(**kwargs)
+        return self.provider(http=self.http, **kwargs)
 
 class ProviderTaskService:
+    """Polls one provider target through the scheduler.
+
+    ``interval`` is the shortest time between polls. With a ``ceiling`` above
+    it the service is adaptive: the callback returns the count when it was
+    fetched from upstream and the interval backs off while the count stays the
+    same, up to the ceiling.
+    """
     interval = timedelta(minutes=5)
 
-    def __init__(self, name: str, factory: Callable, callback: Callable, interval: Optional[timedelta] = None):
+    def __init__(
+            self,
+            key: Hashable,
+            name: str,
+            factory: Callable,
+            callback: Callable,
+            scheduler: PollScheduler,
+            interval: Optional[timedelta] = None,
+            ceiling: Optional[timedelta] = None,
+    ):
+        self.key = key
         self.name = name
         self.factory = factory
         self.callback = callback
-        self.task: Optional[asyncio.Task] = None
+        self.scheduler = scheduler
         if interval is not None:
             self.interval = interval
-            self.provider_task.change_interval(seconds=interval.total_seconds())
+        self.ceiling = ceiling or self.interval
+        self.backoff = Backoff(self.interval, self.ceiling)
+        self.scheduled = False
+
+    @property
+    def adaptive(self) -> bool:
+        return self.ceiling > self.interval
+
+    @property
+    def current_interval(self) -> timedelta:
+        return self.backoff.current
 
-    @tasks.loop(seconds=interval.total_seconds(), reconnect=True)
     async def provider_task(self):
+        provider = self.factory()
+        if provider is None:
+            log.warning(f"No provider instance available for {self.name} ({self.key})")
+            return
         log.debug(f"In task for {self.name}. Calling callback")
-        await self.callback(self.name, self.factory())
-
-    def start(self):
-        name = self.factory().__repr__()
-        log.debug(f"Starting {name} Task Service with interval {self.interval.total_seconds()}")
-        self.task = self.provider_task.start()
-        task_finished = partial(self._task_finished, provider=self.factory())
-        self.task.add_done_callback(task_finished)
-        return self.task
+        count = await self.callback(self.key, provider)
+        if not self.scheduled:
+            # Stopped while polling, the key may belong to another service by now
+            return
+        if self.adaptive and count is not None:
+            previous = self.backoff.current
+            interval = self.backoff.observe(count)
+            if interval != previous:
+                log.debug(f"Polling {self.key} every {interval.total_seconds()}s")
+                self.scheduler.reschedule(self.key, interval)
+
+    def start(self, jitter: bool = True):
+        provider = self.factory()
+        log.debug(f"Scheduling {provider!r} Task Service with interval {self.interval.total_seconds()}")
+        # Targets on the same credentials are polled together so their fetches share a batch
+        group = getattr(provider, 'batch_key', None)
+        self.scheduler.add(self.key, self.provider_task, self.interval, jitter=jitter, group=group)
+        self.scheduled = True
+
+    def reschedule(self, interval: timedelta, run_now: bool = False, ceiling: Optional[timedelta] = None):
+        self.interval = interval
+        self.ceiling = ceiling or interval
+        self.backoff.update(interval, self.ceiling)
+        self.scheduler.reschedule(self.key, self.backoff.current, delay=0 if run_now else None)
 
     def stop(self):
-        self.provider_task.cancel()
-
-
-    def _task_finished(self, future: asyncio.Future, *, provider: Provider):
-        name = provider.__repr__()
-        try:
-            if future.exception() and not future.cancelled():
-                log.error(str(future.exception()))
-                raise future.exception()
-        except asyncio.CancelledError:
-            log.debug(f"ProviderTaskService task for {name} was cancelled")
-            pass
-
+        self.scheduled = False
+        self.scheduler.remove(self.key)
 
 
 class ProviderCog(ConfigMixin, commands.GroupCog, name='provider'):
@@ -84,16 +138,70 @@ class ProviderCog(ConfigMixin, commands.GroupCog, name='provider'):
     def __init__(self, bot: commands.Bot, provider_definitions: List[ProviderConfig]):
         self.bot = bot
         self.provider_definitions = provider_definitions
-        self.provider_instances = {}
+        self.provider_instances: Dict[Tuple[int, int], Dict[str, Provider]] = {}
+        self.credentials: Dict[RecordKey, ProviderCredentials] = {}
+        self.registry = ProviderRegistry()
+        self.http = HttpClient()
+        self.limits = UpstreamLimits.from_env()
+        self.quota = QuotaPlanner()
+        self.resilience = Resilience()
+        self.collector = BatchCollector(limits=self.limits, quota=self.quota, resilience=self.resilience)
+        self.flights = SingleFlight(freshness=5.0)
+        self.counts = CountCache()
+        # Schedulers polling through this cog, stopped before the shared client closes
+        self.schedulers: List[PollScheduler] = []
         self.first_run = True
         super().__init__()
 
+    async def cog_load(self):
+        for definition in self.provider_definitions:
+            definition.http = self.http
+        scraper.open()
+        self.watch_settings()
+
+    async def cog_unload(self):
+        self.unwatch_settings()
+        for scheduler in self.schedulers:
+            await scheduler.stop()
+        await self.collector.close()
+        await self.http.close()
+        scraper.close()
+        await self.flush_settings()
+
+    def on_settings_changed(self, guild_id: Optional[str], member_id: Optional[str]):
+        if guild_id is None or member_id is None:
+            return
+        guild = self.bot.get_guild(int(guild_id))
+        if guild is None or guild.get_member(int(member_id)) is None:
+            return
+        for credentials in self.load_member_credentials(guild_id, member_id):
+            try:
+                self.load_provider(*credentials.key)
+            except ValueError as e:
+                log.error(e)
+
     @commands.Cog.listener()
     async def on_ready(self):
         if self.first_run:
             self.load_providers_from_settings()
             self.first_run = False
 
+    def load_member_credentials(self, guild_str: str, member_str: str) -> List[ProviderCredentials]:
+        """Refreshes the credential records of a member from the configuration"""
+        guild_id, member_id = int(guild_str), int(member_str)
+        providers = self.config_settings.get(guild_str, {}).get(member_str, {}).get('providers', {})
+        instances = self.provider_instances.get((guild_id, member_id), {})
+        for provider_name in [name for name in instances if name not in providers]:
+            self.registry.release(instances.pop(provider_name))
+            self.credentials.pop((guild_id, member_id, provider_name), None)
+        loaded = []
+        for provider_name, data in providers.items():
+            credentials = ProviderCredentials.from_config(guild_str, member_str, provider_name, data)
+            if credentials is not None:
+                self.credentials[credentials.key] = credentials
+                loaded.append(credentials)
+        return loaded
+
     def load_providers_from_settings(self):
         log.debug("Loading providers from configuration")
         for guild_string in self.config_settings.keys():
@@ -104,31 +212,74 @@ class ProviderCog(ConfigMixin, commands.GroupCog, name='provider'):
                 member = guild.get_member(int(member_string))
                 if member is None:
                     continue
-                for provider_name in self.config_settings[guild_string][member_string]['providers'].keys():
+                for credentials in self.load_member_credentials(guild_string, member_string):
                     try:
-                        self.load_provider(member, provider_name)
+                        self.load_provider(*credentials.key)
                     except ValueError as e:
                         log.error(e)
                         continue
 
-    def load_provider(self, member: discord.Member, provider_name: str):
-        guild_str = str(member.guild.id)
-        member_str = str(member.id)
-        if member not in self.provider_instances.keys():
-            self.provider_instances[member] = {}
+    def load_provider(self, guild_id: int, member_id: int, provider_name: str):
         definition = self.find_provider_definition_by_name(provider_name)
-        payload = self.config_settings.get(guild_str, {}).get(member_str, {}).get('providers', {}).get(provider_name, {}).get('payload')
+        credentials = self.credentials.get((guild_id, member_id, provider_name))
         if definition is None:
             raise ValueError(f"Could not find provider with name {provider_name}")
-        if payload is None:
+        if credentials is None:
             raise ValueError(f"No settings for provider found for user")
 
-        self.provider_instances[member][provider_name] = definition.create(**payload)
-        log.debug(f"Provider {provider_name} loaded for {member.display_name} in guild {member.guild}")
+        instances = self.provider_instances.setdefault((guild_id, member_id), {})
+        previous = instances.get(provider_name)
+        instances[provider_name] = self.registry.acquire(definition, credentials.payload)
+        if previous is not None:
+            self.registry.release(previous)
+        log.debug(f"Provider {provider_name} loaded for member {member_id} in guild {guild_id}")
+        self.bot.dispatch('provider_loaded', guild_id, member_id, provider_name)
+
+    async def fetch_count(self, provider: Provider, max_age: Optional[timedelta] = None) -> int:
+        """Fetches the subscriber count, serving it from cache when it is younger than max_age
+        (the provider's cache_ttl by default). Identical fetches in flight across guilds are shared
+        and the rest are batched with other pending requests on the same credentials. Providers with
+        a daily quota keep counts cached for as long as their budget requires, unless max_age is zero.
+        While the upstream is failing, short-circuited or out of quota the last fetched count is
+        served instead"""
+        return (await self.poll_count(provider, max_age))[0]
+
+    async def poll_count(self, provider: Provider, max_age: Optional[timedelta] = None) -> Tuple[int, bool]:
+        """fetch_count, also telling whether the count came from upstream rather than the cache"""
+        if max_age is None:
+            max_age = provider.cache_ttl
+        if max_age:
+            max_age = max(max_age, self.quota.min_age(provider))
+        count = self.counts.get(provider.flight_key, max_age)
+        if count is not None:
+            return count, False
+        try:
+            return await self.flights.do(provider.flight_key, partial(self._fetch_upstream, provider)), True
+        except UNAVAILABLE as e:
+            count = self.counts.stale(provider.flight_key)
+            if count is None:
+                raise
+            log.debug(f"Serving last count of {provider.target_id}: {e}")
+            return count, False
+
+    async def _fetch_upstream(self, provider: Provider) -> int:
+        count = await self.collector.subscriber_count(provider)
+        self.counts.put(provider.flight_key, count)
+        return count
+
+    async def verify_provider(self, provider: Provider) -> bool:
+        """Checks the configuration against upstream, seeding the count cache for the first poll"""
+        try:
+            return (await self.fetch_count(provider, max_age=timedelta(0))) >= 0
+        except Exception:
+            return False
+
+    def find_provider_instance(self, guild_id: int, member_id: int, name: str) -> Optional[Provider]:
+        providers = self.provider_instances.get((guild_id, member_id))
+        return providers and providers.get(name)
 
     def find_provider_instance_by_member_and_name(self, member: discord.Member, name: str) -> Optional[Provider]:
-        providers = self.provider_instances.get(member, {})
-        return providers.get(name)
+        return self.find_provider_instance(member.guild.id, member.id, name)
 
     def find_provider_definition_by_name(self, name: str) -> Optional[ProviderConfig]:
         for p in self.provider_definitions:
@@ -151,28 +302,28 @@ class ProviderCog(ConfigMixin, commands.GroupCog, name='provider'):
         self.establish_member_provider_config(guild_id, member_id, provider_name)
 
         self.config_settings[guild_id][member_id]['providers'][provider_name]['payload'] = payload
-        self.save_settings()
+        self.save_settings(guild_id, member_id)
 
 
 
     async def config_modal_callback(self, itx: Interaction, provider_config: ProviderConfig, payload: Dict[str, Any]):
-        key = provider_config.name
-        instance = provider_config.create(**payload)
-        success = await instance.verify_config()
+        instance = self.registry.acquire(provider_config, payload)
+        success = await self.verify_provider(instance)
         if not success:
+            self.registry.release(instance)
             await itx.followup.send("Invalid configuration settings. Changes not saved.", ephemeral=True)
             return
 
-        self.provider_instances[key] = instance
         guild_key = str(itx.guild_id)
         member_key = str(itx.user.id)
         provider_key = provider_config.name
         establish_member_config(self.config_settings, guild_key, member_key)
         self.establish_member_provider_config(guild_key, member_key, provider_key)
         self.config_settings[guild_key][member_key]['providers'][provider_key]['payload'] = payload
-        self.save_settings()
+        self.save_settings(guild_key, member_key)
+        # Saving loaded the provider for the member with its own reference to the verified instance
+        self.registry.release(instance)
         await itx.followup.send("Settings Saved!", ephemeral=True)
-        self.load_provider(itx.user, key)
 
     @app_commands.command()
     async def config(self, itx: Interaction, provider_name: str):
@@ -185,8 +336,8 @@ class ProviderCog(ConfigMixin, commands.GroupCog, name='provider'):
 
 
 
-async def setup(bot: commands.Bot):
-    provider_definitions = [
+def default_provider_definitions() -> List[ProviderConfig]:
+    return [
         ProviderConfig(
             "youtube",
             YouTubeProvider,
@@ -212,6 +363,10 @@ async def setup(bot: commands.Bot):
             app_bearer_token="Twitter Bearer Authentication Token"
         )
     ]
+
+
+async def setup(bot: commands.Bot):
+    provider_definitions = default_provider_definitions()
     provider_cog = ProviderCog(bot, provider_definitions)
     await bot.add_cog(provider_cog)
 
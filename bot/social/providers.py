@@ -1,22 +1,76 @@
-import json
-from datetime import datetime, timezone, timedelta
-from json import JSONDecodeError
-from typing import Optional, Any, Dict
-import re
-
-import aiohttp
-from bs4 import BeautifulSoup
+from datetime import timedelta
+from typing import Optional, Any, Dict, Hashable, Sequence
+
+from bot.social.http import HttpClient, UpstreamUnauthorized
+from bot.social.oauth import ApplicationOAuth, AuthenticationError
+from bot.social.scraping import instagram_followers, scraper, tiktok_followers
+
+
 class ProviderError(Exception):
     pass
 
-class AuthenticationError(Exception):
+
+class QuotaExceeded(ProviderError):
+    """The credential has no API quota left until the provider's daily reset"""
     pass
 
 class BaseProvider:
+    http: HttpClient
+
+    # Maximum number of targets a single subscriber_counts() request may carry
+    batch_limit = 1
+    # How long a fetched count may be served from cache
+    cache_ttl = timedelta(minutes=5)
+    # Concurrent upstream requests allowed for this provider type, None for the default
+    concurrency_limit: Optional[int] = None
+    # Units a credential may spend per day, None for providers without a quota
+    daily_quota: Optional[int] = None
+    # Units charged per upstream call, however many targets it carries
+    quota_cost = 1
+
+    def __init__(self, http: Optional[HttpClient] = None):
+        self.http = http if http is not None else HttpClient.default()
+
+    @classmethod
+    def canonical_payload(cls, **payload: str) -> Dict[str, str]:
+        """Normalizes user entered settings so equivalent payloads compare equal"""
+        return {key: str(value).strip() for key, value in payload.items()}
+
+    @property
+    def credential_scope(self) -> Optional[str]:
+        """Credential the upstream API call is made with, None for public endpoints"""
+        return None
+
+    @property
+    def batch_key(self) -> Optional[Hashable]:
+        """Providers with equal batch keys share credentials and can be fetched together.
+        None means this provider does not support batching."""
+        if self.batch_limit <= 1:
+            return None
+        return self.__class__.__name__, self.credential_scope
+
+    @property
+    def flight_key(self) -> Hashable:
+        """Identifies fetches that return the same count and can be shared"""
+        return self.__class__.__name__, self.target_id, self.credential_scope
+
+    @property
+    def target_id(self) -> str:
+        """Canonical id of the account whose subscribers are counted"""
+        raise NotImplementedError
+
+    @property
+    def batch_target(self) -> str:
+        return self.target_id
 
     async def subscriber_count(self):
         raise NotImplemented
 
+    async def subscriber_counts(self, targets: Sequence[str]) -> Dict[str, int]:
+        """Fetch the counts of several targets with this provider's credentials.
+        Targets missing upstream are left out of the result."""
+        raise NotImplementedError
+
     async def verify_config(self):
         try:
             return (await self.subscriber_count()) >= 0
@@ -24,76 +78,90 @@ class BaseProvider:
             return False
 
 class YouTubeProvider(BaseProvider):
-
-    def __init__(self, api_key: str, channel_id: str):
+    api_url = "https://www.googleapis.com/youtube/v3"
+    batch_limit = 50
+    # Counts are rounded to three significant figures upstream so they rarely move
+    cache_ttl = timedelta(minutes=15)
+    # channels.list costs one unit of the key's default 10,000 a day
+    daily_quota = 10_000
+
+    def __init__(self, api_key: str, channel_id: str, http: Optional[HttpClient] = None):
+        super().__init__(http)
         self._api_key = api_key
         self._channel_id = channel_id
-        self.target = f"https://www.googleapis.com/youtube/v3/channels?part=statistics&id={self._channel_id}&key={self._api_key}"
-
-    async def subscriber_count(self) -> int:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(self.target) as resp:
-                data = await resp.json()
-                return int(data['items'][0]['statistics']['subscriberCount'])
-
-
-
-class AppToken(dict):
-    def __init__(self,*args, **kwargs):
-        super(AppToken, self).__init__(*args, **kwargs)
-        self.expires_at = datetime.now(timezone.utc) + timedelta(seconds=self['expires_in'])
+        self.target = f"{self.api_url}/channels?part=statistics&id={self._channel_id}&key={self._api_key}"
 
     @property
-    def is_valid(self):
-        now = datetime.now(timezone.utc)
-        return now < self.expires_at
-
-class ApplicationOATH:
-
-
-    def __init__(self, token_url: str, request_payload: Dict[str, Any]):
-        self._payload = request_payload
-        self.token_url = token_url
-        self.app_token: Optional[AppToken] = None
+    def credential_scope(self):
+        return self._api_key
 
     @property
-    def auth_header(self):
-        if self.app_token is None:
-            raise AuthenticationError
+    def target_id(self):
+        return self._channel_id
+
+    @staticmethod
+    def _raise_for_quota(data: Dict[str, Any]):
+        reasons = {e.get('reason') for e in data.get('error', {}).get('errors', [])}
+        if reasons & {'quotaExceeded', 'dailyLimitExceeded'}:
+            raise QuotaExceeded(data['error'].get('message', 'YouTube quota exceeded'))
 
-        token_type = self.app_token['token_type'].capitalize()
+    async def subscriber_count(self) -> int:
+        data = await self.http.get_json(self.target)
+        self._raise_for_quota(data)
+        return int(data['items'][0]['statistics']['subscriberCount'])
+
+    async def subscriber_counts(self, targets: Sequence[str]) -> Dict[str, int]:
+        ids = ','.join(targets)
+        target = f"{self.api_url}/channels?part=statistics&id={ids}&key={self._api_key}"
+        data = await self.http.get_json(target)
+        self._raise_for_quota(data)
         return {
-            'Authorization': f'{token_type} {self._app_token}',
-            'Client-Id': self.client_id
+            item['id']: int(item['statistics']['subscriberCount'])
+            for item in data.get('items', [])
+            if 'subscriberCount' in item.get('statistics', {})
         }
 
 
-    def authenticate(coro):
-        async def _dec(self):
-            if self.app_token and not self.app_token.valid:
-                form_data = aiohttp.FormData(self._payload)
-                async with aiohttp.ClientSession() as session:
-                    async with session.post(self.token_url, data=form_data) as resp:
-                        data = await resp.json()
-                        self.app_token = AppToken(**data)
-
-            return await coro(self)
-        return _dec
 
 class RedditProvider(BaseProvider):
+    api_url = "https://www.reddit.com"
+    batch_limit = 100
+    cache_ttl = timedelta(minutes=1)
 
-    def __init__(self, subreddit: str):
+    def __init__(self, subreddit: str, http: Optional[HttpClient] = None):
+        super().__init__(http)
         self.subreddit = subreddit
-        self.about_url = f"https://www.reddit.com/r/{subreddit}/about.json"
+        self.about_url = f"{self.api_url}/r/{subreddit}/about.json"
 
 
     async def subscriber_count(self):
         headers = {'Content-Type': 'application/json'}
-        async with aiohttp.ClientSession() as session:
-            async with session.get(self.about_url, headers=headers) as resp:
-                data = await resp.json()
-                print(data)
-                return data['data']['subscribers']
+        data = await self.http.get_json(self.about_url, headers=headers)
+        return data['data']['subscribers']
+
+    @property
+    def target_id(self):
+        return self.subreddit.lower()
+
+    @classmethod
+    def canonical_payload(cls, **payload: str) -> Dict[str, str]:
+        payload = super().canonical_payload(**payload)
+        subreddit = payload['subreddit'].lower()
+        payload['subreddit'] = subreddit[2:] if subreddit.startswith('r/') else subreddit
+        return payload
+
+    async def subscriber_counts(self, targets: Sequence[str]) -> Dict[str, int]:
+        # /api/info resolves subreddits by name so no t5_ fullname lookup is needed
+        names = ','.join(targets)
+        target = f"{self.api_url}/api/info.json?sr_name={names}"
+        headers = {'Content-Type': 'application/json'}
+        data = await self.http.get_json(target, headers=headers)
+        found = {
+            child['data']['display_name'].lower(): child['data']['subscribers']
+            for child in data['data']['children']
+            if child.get('kind') == 't5'
+        }
+        return {t: found[t.lower()] for t in targets if t.lower() in found}
 
     async def verify_config(self):
         try:
@@ -103,147 +171,127 @@ class RedditProvider(BaseProvider):
 
 
 class TwitchProvider(BaseProvider):
+    api_url = "https://api.twitch.tv/helix"
+    token_url = "https://id.twitch.tv/oauth2/token"
 
-    def __init__(self, user_id: str, client_id: str, client_secret: str):
+    def __init__(self, user_id: str, client_id: str, client_secret: str, http: Optional[HttpClient] = None):
+        super().__init__(http)
         self.user_id = user_id
         self._client_id = client_id
-        self._client_secret = client_secret
-        self.expires: Optional[datetime] = None
-        self._app_token: Optional[str] = None
-        self._token_type = "bearer"
+        self.oauth = ApplicationOAuth(self.token_url, client_id, client_secret)
 
     @property
-    def auth_header(self):
-        if self._app_token is None:
-            raise AuthenticationError
+    def target_id(self):
+        return self.user_id
 
-        token_type = self._token_type.capitalize()
-        return {
-            'Authorization': f'{token_type} {self._app_token}',
-            'Client-Id': self._client_id
-        }
+    @property
+    def credential_scope(self):
+        return self._client_id
 
-    def _authenticate(coro):
-        async def _dec(self):
-            target = "https://id.twitch.tv/oauth2/token"
-            fields = {
-                'client_id': self._client_id,
-                'client_secret': self._client_secret,
-                'grant_type': 'client_credentials'
-            }
-            form_data = aiohttp.FormData(fields)
-            async with aiohttp.ClientSession() as session:
-                async with session.post(target, data=form_data) as resp:
-                    data = await resp.json()
-                    self._app_token = data['access_token']
-                    self.expires = datetime.now(timezone.utc) + timedelta(seconds=data['expires_in'])
-                    self._token_type = data['token_type']
-
-            return await coro(self)
-        return _dec
-
-    @_authenticate
     async def subscriber_count(self):
-        target = f"https://api.twitch.tv/helix/users/follows?to_id={self.user_id}"
-
-        async with aiohttp.ClientSession() as session:
-            async with session.get(target, headers=self.auth_header) as resp:
-                data = await resp.json()
-                return data['total']
+        target = f"{self.api_url}/users/follows?to_id={self.user_id}"
 
+        try:
+            data = await self.http.get_json(target, headers=await self.oauth.auth_header(self.http))
+        except UpstreamUnauthorized:
+            # Token was revoked upstream before its expiry, fetch a new one once
+            self.oauth.invalidate()
+            data = await self.http.get_json(target, headers=await self.oauth.auth_header(self.http))
+        return data['total']
 
 
 class TwitterProvider(BaseProvider):
-    def __init__(self, user_id: str, app_bearer_token: str):
+    api_url = "https://api.twitter.com/2"
+    batch_limit = 100
+
+    def __init__(self, user_id: str, app_bearer_token: str, http: Optional[HttpClient] = None):
+        super().__init__(http)
         self._bearer = app_bearer_token
         self._user_id = user_id
 
     async def subscriber_count(self):
-        target = f"https://api.twitter.com/2/users/{self._user_id}?user.fields=public_metrics"
+        target = f"{self.api_url}/users/{self._user_id}?user.fields=public_metrics"
         headers = {"Authorization": f"Bearer {self._bearer}"}
-        async with aiohttp.ClientSession() as session:
-            async with session.get(target, headers=headers) as resp:
-                data = await resp.json()
-                return data['data']['public_metrics']['followers_count']
+        data = await self.http.get_json(target, headers=headers)
+        return data['data']['public_metrics']['followers_count']
 
+    @property
+    def credential_scope(self):
+        return self._bearer
 
-class InstagramProvider(BaseProvider):
+    @property
+    def target_id(self):
+        return self._user_id
 
-    def __init__(self, username: str):
-        self.username = username
-        self._shared_data = {}
+    async def subscriber_counts(self, targets: Sequence[str]) -> Dict[str, int]:
+        ids = ','.join(targets)
+        target = f"{self.api_url}/users?ids={ids}&user.fields=public_metrics"
+        headers = {"Authorization": f"Bearer {self._bearer}"}
+        data = await self.http.get_json(target, headers=headers)
+        return {
+            user['id']: user['public_metrics']['followers_count']
+            for user in data.get('data', [])
+        }
 
-    @classmethod
-    async def for_username(cls, username: str) -> 'InstagramProvider':
-        o = cls(username)
-        await o.refresh()
-        return o
 
-    async def _get_html(self):
-        url = "https://www.instagram.com"
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"{url}/{self.username}") as resp:
-                self.html = await resp.text()
-                return self.html
+class InstagramProvider(BaseProvider):
+    page_url = "https://www.instagram.com"
+    cache_ttl = timedelta(minutes=15)
 
-    def _fetch_shared_data(self, html: str) -> Dict[str, Any]:
-        pattern = r'window\._sharedData = (.*);'
-        try:
-            result = re.findall(pattern, html)[0]
-            data = json.loads(result)
-            return data
-        except (IndexError, JSONDecodeError):
-            return {}
-
-    async def refresh(self):
-        html = await self._get_html()
-        self._shared_data = self._fetch_shared_data(html)
-        if not self._shared_data:
-            raise ProviderError("No User Data Found")
+    def __init__(self, username: str, http: Optional[HttpClient] = None):
+        super().__init__(http)
+        self.username = username
 
     @property
-    def user(self) -> Dict[str, Any]:
-        try:
-            print(self._shared_data)
-            return self._shared_data['entry_data']['ProfilePage'][0]['graphql']['user']
-        except (KeyError, IndexError):
-            raise ProviderError("Could not locate user object")
+    def target_id(self):
+        return self.username.lower()
+
+    @classmethod
+    async def for_username(cls, username: str, http: Optional[HttpClient] = None) -> 'InstagramProvider':
+        o = cls(username, http)
+        await o.subscriber_count()
+        return o
 
     async def subscriber_count(self):
-        try:
-            return self.user['edge_followed_by']['count']
-        except KeyError:
+        # The profile JSON sits in a script near the top of the page, the rest is never read
+        count = await scraper.scrape(
+            self.http,
+            f"{self.page_url}/{self.username}",
+            b'window._sharedData = ',
+            b';</script>',
+            instagram_followers,
+            self.__class__.__name__,
+        )
+        if count is None:
             raise ProviderError("Subscriber count not found")
+        return count
+
 
 class TikTokProvider(BaseProvider):
-    def __init__(self, username: str):
+    page_url = "https://www.tiktok.com"
+    cache_ttl = timedelta(minutes=15)
+
+    def __init__(self, username: str, http: Optional[HttpClient] = None):
+        super().__init__(http)
         self._username = username
 
-    def _soup_followers(self, html: str) -> Optional[int]:
-        print("parsing")
-        soup = BeautifulSoup(html)
-        print("parsed")
-        follower = soup("strong", {"data-e2e": "followers-count"})
-        try:
-            return int(follower[0].text)
-        except (IndexError, ValueError):
-            return
+    @property
+    def target_id(self):
+        return self._username.lower()
 
     async def subscriber_count(self):
         headers = {
             "User-Agent": "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:90.0) Gecko/20100101 Firefox/90.0"
         }
-
-        target = f"https://www.tiktok.com/{self._username}"
-        print(target)
-        async with aiohttp.ClientSession() as session:
-            print('got session')
-            async with session.get(target, headers=headers) as resp:
-                print('got resp')
-                #print(resp)
-                html = await resp.text()
-                print(html)
-                return html
-                #followers = self._soup_followers(html)
-                #return followers if followers else 0
-
+        count = await scraper.scrape(
+            self.http,
+            f"{self.page_url}/{self._username}",
+            b'data-e2e="followers-count"',
+            b'</strong>',
+            tiktok_followers,
+            self.__class__.__name__,
+            headers=headers,
+        )
+        if count is None:
+            raise ProviderError("Subscriber count not found")
+        return count
@@ -0,0 +1,129 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Deque, Dict, Hashable, Tuple
+
+import discord
+
+from metrics import ACTIVE_TASKS, DISCORD_EDIT_SECONDS, DISCORD_RATE_LIMITED, PUBLISH_LATENCY_SECONDS, PUBLISH_QUEUE_DEPTH
+
+log = logging.getLogger(__name__)
+
+PublishJob = Callable[[], Awaitable[None]]
+
+
+class EmbedPublisher:
+    """Decouples Discord writes from polling.
+
+    Every display owns one pending slot; submitting for a display that already
+    has a pending write replaces it, so Discord only ever sees the newest state.
+    Each channel is drained by its own worker that keeps to Discord's per
+    channel message bucket (``rate`` writes per ``per`` seconds) and backs off
+    on 429 responses.
+    """
+
+    def __init__(self, rate: int = 5, per: float = 5.0, latency_samples: int = 1000):
+        self.rate = rate
+        self.per = per
+        self._slots: Dict[int, 'OrderedDict[Hashable, Tuple[PublishJob, float]]'] = {}
+        self._workers: Dict[int, asyncio.Task] = {}
+        self._sent: Dict[int, Deque[float]] = {}
+        self.latencies: Deque[float] = deque(maxlen=latency_samples)
+        self.published = 0
+        self.replaced = 0
+        self.rate_limited = 0
+
+    @property
+    def depth(self) -> int:
+        return sum(len(slots) for slots in self._slots.values())
+
+    @property
+    def workers(self) -> int:
+        """Channels with a write queued or in flight"""
+        return len(self._workers)
+
+    def submit(self, channel_id: int, slot: Hashable, job: PublishJob):
+        slots = self._slots.setdefault(channel_id, OrderedDict())
+        pending = slots.get(slot)
+        if pending is not None:
+            # Latest wins, but latency is measured from when the slot first became pending
+            self.replaced += 1
+            slots[slot] = (job, pending[1])
+        else:
+            slots[slot] = (job, time.monotonic())
+            PUBLISH_QUEUE_DEPTH.inc()
+        if channel_id not in self._workers:
+            self._workers[channel_id] = asyncio.create_task(self._drain(channel_id))
+            ACTIVE_TASKS.inc(kind='publisher')
+
+    async def close(self):
+        for task in self._workers.values():
+            task.cancel()
+        await asyncio.gather(*self._workers.values(), return_exceptions=True)
+        self._workers.clear()
+        PUBLISH_QUEUE_DEPTH.dec(self.depth)
+        self._slots.clear()
+
+    def latency_percentile(self, percentile: float) -> float:
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percentile))]
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        return {
+            'depth': self.depth,
+            'published': self.published,
+            'replaced': self.replaced,
+            'rate_limited': self.rate_limited,
+            'latency_p50': self.latency_percentile(0.5),
+            'latency_p99': self.latency_percentile(0.99),
+        }
+
+    async def _wait_for_bucket(self, channel_id: int):
+        sent = self._sent.setdefault(channel_id, deque(maxlen=self.rate))
+        if len(sent) == self.rate:
+            wait = self.per - (time.monotonic() - sent[0])
+            if wait > 0:
+                await asyncio.sleep(wait)
+        sent.append(time.monotonic())
+
+    async def _drain(self, channel_id: int):
+        slots = self._slots[channel_id]
+        try:
+            while slots:
+                await self._wait_for_bucket(channel_id)
+                slot, (job, enqueued) = slots.popitem(last=False)
+                PUBLISH_QUEUE_DEPTH.dec()
+                try:
+                    with DISCORD_EDIT_SECONDS.time():
+                        await job()
+                except discord.HTTPException as e:
+                    if e.status != 429:
+                        log.error(f"Publishing {slot} to channel {channel_id} failed: {e}")
+                        continue
+                    self.rate_limited += 1
+                    DISCORD_RATE_LIMITED.inc()
+                    retry_after = getattr(e, 'retry_after', None) or self.per
+                    log.warning(f"Rate limited on channel {channel_id}, retrying in {retry_after}s")
+                    # Only retry if nothing newer was submitted for the slot meanwhile
+                    if slot not in slots:
+                        slots[slot] = (job, enqueued)
+                        PUBLISH_QUEUE_DEPTH.inc()
+                    slots.move_to_end(slot, last=False)
+                    await asyncio.sleep(retry_after)
+                    continue
+                except Exception:
+                    log.exception(f"Publishing {slot} to channel {channel_id} failed")
+                    continue
+                self.published += 1
+                latency = time.monotonic() - enqueued
+                self.latencies.append(latency)
+                PUBLISH_LATENCY_SECONDS.observe(latency)
+        finally:
+            if self._workers.pop(channel_id, None) is not None:
+                ACTIVE_TASKS.dec(kind='publisher')
+            if not slots:
+                self._slots.pop(channel_id, None)
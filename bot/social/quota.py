@@ -0,0 +1,150 @@
+import hashlib
+import logging
+import math
+import time
+from datetime import date, datetime, timedelta, timezone, tzinfo
+from typing import Dict, Optional
+
+from bot.social.providers import BaseProvider, QuotaExceeded
+from metrics import QUOTA_PROJECTED, QUOTA_USED
+
+log = logging.getLogger(__name__)
+
+
+def pacific() -> tzinfo:
+    """Time zone the YouTube quota day follows, falling back to PST without tz data"""
+    try:
+        from zoneinfo import ZoneInfo
+        return ZoneInfo('America/Los_Angeles')
+    except Exception:
+        return timezone(timedelta(hours=-8), 'PST')
+
+
+class QuotaAccount:
+    """Units spent by one credential during the current quota day"""
+    __slots__ = ('provider', 'credential', 'label', 'limit', 'day', 'spent', 'fetched', 'exhausted', 'targets', 'pruned', 'since')
+
+    def __init__(self, provider: str, credential: str, limit: int, day: date):
+        self.provider = provider
+        self.credential = credential
+        # Credentials are secrets, metrics and logs only see a digest
+        self.label = hashlib.sha1(credential.encode()).hexdigest()[:8]
+        self.limit = limit
+        self.day = day
+        self.spent = 0
+        self.fetched = 0
+        self.exhausted = False
+        # When spending was first seen this quota day
+        self.since = time.monotonic()
+        # target id -> when its count was last asked for
+        self.targets: Dict[str, float] = {}
+        self.pruned = time.monotonic()
+
+    def reset(self, day: date):
+        self.day = day
+        self.spent = 0
+        self.fetched = 0
+        self.exhausted = False
+        self.since = time.monotonic()
+
+
+class QuotaPlanner:
+    """Keeps quota limited credentials within their daily budget.
+
+    Providers with a ``daily_quota`` are charged ``quota_cost`` units per
+    upstream call. From the units left, the seconds until the quota resets and
+    the targets polled on the credential, the planner works out how old a
+    cached count may get before it is refetched, so refreshes are spread over
+    the whole day and the stalest counts are refetched first. The last
+    ``reserve`` share of the budget only goes to targets that were never
+    fetched, so new displays still get a count.
+    """
+
+    def __init__(self, reserve: float = 0.05, active_window: float = 3600.0, zone: Optional[tzinfo] = None):
+        self.reserve = reserve
+        self.active_window = active_window
+        self.zone = zone if zone is not None else pacific()
+        self._accounts: Dict[tuple, QuotaAccount] = {}
+
+    def account_for(self, provider: BaseProvider) -> Optional[QuotaAccount]:
+        if provider.daily_quota is None or provider.credential_scope is None:
+            return None
+        key = (provider.__class__.__name__, provider.credential_scope)
+        account = self._accounts.get(key)
+        today = self.today()
+        if account is None:
+            account = self._accounts[key] = QuotaAccount(key[0], key[1], provider.daily_quota, today)
+        elif account.day != today:
+            log.info(f"Quota reset for {account.provider} credential {account.label}")
+            account.reset(today)
+        return account
+
+    def today(self) -> date:
+        return datetime.now(self.zone).date()
+
+    def seconds_until_reset(self) -> float:
+        now = datetime.now(self.zone)
+        midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time(), tzinfo=self.zone)
+        return max((midnight - now).total_seconds(), 1.0)
+
+    def min_age(self, provider: BaseProvider) -> timedelta:
+        """How old a cached count of the provider's target may be before the budget allows a refetch"""
+        account = self.account_for(provider)
+        if account is None:
+            return timedelta(0)
+        now = time.monotonic()
+        account.targets[provider.target_id] = now
+        if now - account.pruned > 60:
+            account.targets = {t: seen for t, seen in account.targets.items() if now - seen < self.active_window}
+            account.pruned = now
+
+        until_reset = self.seconds_until_reset()
+        units_left = account.limit * (1 - self.reserve) - account.spent
+        if account.exhausted or units_left <= 0:
+            return timedelta(seconds=until_reset)
+        # Units a single target refresh has cost so far, starting from one full batch per call
+        cost = (account.spent + provider.quota_cost) / (account.fetched + provider.batch_limit)
+        refreshes_left = units_left / cost
+        return timedelta(seconds=min(until_reset * len(account.targets) / refreshes_left, until_reset))
+
+    def check(self, provider: BaseProvider):
+        """Raises QuotaExceeded when the credential has no units left for another call"""
+        account = self.account_for(provider)
+        if account is None:
+            return
+        if account.exhausted or account.spent + provider.quota_cost > account.limit:
+            raise QuotaExceeded(f"{account.provider} credential {account.label} is out of quota until reset")
+
+    def charge(self, provider: BaseProvider, targets: int = 1):
+        account = self.account_for(provider)
+        if account is None:
+            return
+        account.spent += provider.quota_cost
+        account.fetched += targets
+        QUOTA_USED.set(account.spent, provider=account.provider, credential=account.label)
+        QUOTA_PROJECTED.set(self.projected(account), provider=account.provider, credential=account.label)
+
+    def exhaust(self, provider: BaseProvider):
+        """Upstream refused the credential for the rest of the day"""
+        account = self.account_for(provider)
+        if account is not None and not account.exhausted:
+            log.warning(f"{account.provider} credential {account.label} exhausted its quota after {account.spent} units")
+            account.exhausted = True
+
+    def projected(self, account: QuotaAccount) -> float:
+        """Units the credential will have spent at reset if it keeps its burn rate of this quota day"""
+        until_reset = self.seconds_until_reset()
+        # The cold start fetches every target at once, so the rate is taken over at least 15 minutes
+        elapsed = max(min(time.monotonic() - account.since, 86400 - until_reset), 900.0)
+        return account.spent + account.spent / elapsed * until_reset
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        stats = {}
+        for account in self._accounts.values():
+            summary = stats.setdefault(account.provider, {'credentials': 0, 'spent': 0, 'limit': 0, 'projected': 0, 'exhausted': 0})
+            summary['credentials'] += 1
+            summary['spent'] += account.spent
+            summary['limit'] += account.limit
+            summary['projected'] += math.ceil(self.projected(account))
+            summary['exhausted'] += account.exhausted
+        return stats
@@ -0,0 +1,52 @@
+import logging
+from typing import Any, Dict, Hashable, Tuple
+
+log = logging.getLogger(__name__)
+
+
+class ProviderRegistry:
+    """Interns provider instances so members with identical settings share one.
+
+    Payloads are canonicalized by the provider class before lookup. Every
+    acquire() must be paired with a release(); an instance is dropped once its
+    last holder releases it.
+    """
+
+    def __init__(self):
+        self._instances: Dict[Hashable, Any] = {}
+        self._refs: Dict[Hashable, int] = {}
+        self._keys: Dict[int, Hashable] = {}
+
+    def __len__(self):
+        return len(self._instances)
+
+    @staticmethod
+    def canonical_key(name: str, payload: Dict[str, str]) -> Tuple[str, Tuple[Tuple[str, str], ...]]:
+        return name, tuple(sorted(payload.items()))
+
+    def acquire(self, definition, payload: Dict[str, str]):
+        payload = definition.provider.canonical_payload(**payload)
+        key = self.canonical_key(definition.name, payload)
+        instance = self._instances.get(key)
+        if instance is None:
+            instance = definition.create(**payload)
+            self._instances[key] = instance
+            self._refs[key] = 0
+            self._keys[id(instance)] = key
+        self._refs[key] += 1
+        return instance
+
+    def release(self, instance):
+        key = self._keys.get(id(instance))
+        if key is None:
+            return
+        self._refs[key] -= 1
+        if self._refs[key] <= 0:
+            del self._instances[key]
+            del self._refs[key]
+            del self._keys[id(instance)]
+            log.debug(f"Released provider instance {key[0]}")
+
+    def references(self, instance) -> int:
+        key = self._keys.get(id(instance))
+        return self._refs.get(key, 0)
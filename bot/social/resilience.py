@@ -0,0 +1,161 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Awaitable, Callable, Dict, Hashable, Optional, TypeVar
+from urllib.parse import urlparse
+
+import aiohttp
+
+from bot.social.http import UpstreamStatusError
+from bot.social.providers import BaseProvider, ProviderError, QuotaExceeded
+from metrics import CIRCUITS_OPEN, UPSTREAM_RETRIES, UPSTREAM_SHORT_CIRCUITED
+
+log = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+# Failures that say nothing about the request itself, only about the upstream's health
+RETRYABLE = (UpstreamStatusError, aiohttp.ClientError, asyncio.TimeoutError)
+
+
+class CircuitOpen(ProviderError):
+    """Calls to the upstream are short-circuited until it has had time to recover"""
+    pass
+
+
+# Failures after which a display should keep its last count rather than error
+UNAVAILABLE = RETRYABLE + (CircuitOpen, QuotaExceeded)
+
+
+class CircuitBreaker:
+    """Health of one upstream host and credential.
+
+    Opens after ``threshold`` failures in a row, or for as long as a
+    ``Retry-After`` asks, and short-circuits calls while open. Once the
+    cooldown passes a single trial call is let through: success closes the
+    circuit, failure opens it again for twice as long, up to ``max_cooldown``.
+    """
+    __slots__ = ('name', 'threshold', 'base_cooldown', 'max_cooldown', 'cooldown', 'failures', 'opened_until', 'trial')
+
+    def __init__(self, name: str, threshold: int = 5, cooldown: float = 30.0, max_cooldown: float = 600.0):
+        self.name = name
+        self.threshold = threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_until = 0.0
+        self.trial = False
+
+    @property
+    def open(self) -> bool:
+        return self.opened_until > 0
+
+    def check(self):
+        if not self.open:
+            return
+        remaining = self.opened_until - time.monotonic()
+        if remaining > 0 or self.trial:
+            UPSTREAM_SHORT_CIRCUITED.inc(upstream=self.name)
+            raise CircuitOpen(f"{self.name} is unavailable, retrying in {max(remaining, 0):.0f}s")
+        self.trial = True
+
+    def success(self):
+        if self.open:
+            log.info(f"Circuit for {self.name} closed")
+            CIRCUITS_OPEN.dec()
+        self.failures = 0
+        self.opened_until = 0.0
+        self.trial = False
+        self.cooldown = self.base_cooldown
+
+    def failure(self, retry_after: Optional[float] = None):
+        self.failures += 1
+        if retry_after is not None:
+            self._open(retry_after)
+        elif self.trial or self.failures >= self.threshold:
+            self._open(self.cooldown)
+            self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+
+    def abandon(self):
+        """The trial call ended without an answer, the next call gets to try instead"""
+        self.trial = False
+
+    def _open(self, seconds: float):
+        if not self.open:
+            log.warning(f"Circuit for {self.name} opened for {seconds:.0f}s after {self.failures} failures")
+            CIRCUITS_OPEN.inc()
+        self.opened_until = max(self.opened_until, time.monotonic() + seconds)
+        self.trial = False
+
+
+class Resilience:
+    """Retries upstream calls and keeps a circuit breaker per host and credential.
+
+    Transient failures are retried up to ``attempts`` times with full jitter
+    exponential backoff. A ``Retry-After`` no longer than ``max_delay`` is
+    slept out, a longer one opens the circuit instead. Only a call that still
+    fails after its retries counts against the circuit.
+    """
+
+    def __init__(self, attempts: int = 3, base_delay: float = 0.5, max_delay: float = 8.0, **breaker):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker_options = breaker
+        self._breakers: Dict[Hashable, CircuitBreaker] = {}
+
+    def breaker_for(self, provider: BaseProvider) -> CircuitBreaker:
+        url = getattr(provider, 'api_url', None) or getattr(provider, 'page_url', None)
+        host = urlparse(url).hostname if url else provider.__class__.__name__
+        key = (host, provider.credential_scope)
+        breaker = self._breakers.get(key)
+        if breaker is None:
+            name = host if provider.credential_scope is None else f"{host} ({provider.__class__.__name__} credential)"
+            breaker = self._breakers[key] = CircuitBreaker(name, **self.breaker_options)
+        return breaker
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    async def call(self, provider: BaseProvider, request: Callable[[], Awaitable[T]]) -> T:
+        breaker = self.breaker_for(provider)
+        name = provider.__class__.__name__
+        for attempt in range(self.attempts):
+            breaker.check()
+            trial = breaker.trial
+            try:
+                result = await request()
+            except RETRYABLE as e:
+                retry_after = getattr(e, 'retry_after', None)
+                if retry_after is not None and retry_after > self.max_delay:
+                    breaker.failure(retry_after)
+                    raise
+                if attempt + 1 >= self.attempts or breaker.trial:
+                    breaker.failure()
+                    raise
+                delay = retry_after if retry_after is not None else self.backoff(attempt)
+                log.debug(f"{name} request failed ({e!r}), retry {attempt + 1} in {delay:.2f}s")
+                UPSTREAM_RETRIES.inc(provider=name)
+                await asyncio.sleep(delay)
+                continue
+            except Exception:
+                # The upstream answered, just not with something usable
+                breaker.success()
+                raise
+            except BaseException:
+                # Cancelled, a trial that never finished would keep the circuit open for good
+                if trial:
+                    breaker.abandon()
+                raise
+            breaker.success()
+            return result
+
+    def stats(self) -> Dict[str, int]:
+        breakers = list(self._breakers.values())
+        return {
+            'breakers': len(breakers),
+            'open': sum(1 for b in breakers if b.open),
+            'failing': sum(1 for b in breakers if b.failures),
+        }
@@ -0,0 +1,226 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import time
+from datetime import timedelta
+from typing import Callable, Awaitable, Dict, Hashable, List, Optional, Set, Tuple
+
+from metrics import ACTIVE_TASKS, SCHEDULED_POLLS, SCHEDULER_LAG
+
+log = logging.getLogger(__name__)
+
+PollCallback = Callable[[], Awaitable[None]]
+
+
+class ScheduledPoll:
+    __slots__ = ('key', 'callback', 'interval', 'due', 'seq', 'running', 'group')
+
+    def __init__(self, key: Hashable, callback: PollCallback, interval: float, due: float, group: Optional[Hashable] = None):
+        self.key = key
+        self.callback = callback
+        self.interval = interval
+        self.due = due
+        self.seq = 0
+        self.running = False
+        self.group = group
+
+
+class Backoff:
+    """Poll interval that adapts to how often the polled value changes.
+
+    Starts at ``floor`` and grows by ``factor`` after every poll that observed
+    the same value as the one before, up to ``ceiling``. Any change snaps it
+    back to ``floor``.
+    """
+    __slots__ = ('floor', 'ceiling', 'factor', 'current', 'last')
+
+    def __init__(self, floor: timedelta, ceiling: timedelta, factor: float = 2.0):
+        self.floor = floor
+        self.ceiling = max(ceiling, floor)
+        self.factor = factor
+        self.current = floor
+        self.last = None
+
+    def observe(self, value) -> timedelta:
+        if self.last is not None and value == self.last:
+            self.current = min(self.current * self.factor, self.ceiling)
+        else:
+            self.current = self.floor
+        self.last = value
+        return self.current
+
+    def update(self, floor: timedelta, ceiling: timedelta):
+        self.floor = floor
+        self.ceiling = max(ceiling, floor)
+        self.current = min(max(self.current, floor), self.ceiling)
+
+
+class PollScheduler:
+    """Single timer heap that drives every poll in the bot.
+
+    Entries are ordered by their next due time. One dispatcher sleeps until the
+    earliest entry is due and hands it to a bounded pool of workers. Removing or
+    rescheduling an entry pushes a new heap item and leaves the old one to be
+    discarded lazily, so every operation is O(log n).
+
+    Entries can share a ``group``, such as the batch key of their provider.
+    When one of them is dispatched, the others in its group that are due
+    within ``align`` of their interval are dispatched along with it, so their
+    fetches land in the same batch window instead of the random spread jitter
+    gave them.
+    """
+
+    def __init__(self, workers: int = 32, align: float = 0.25):
+        self.workers = workers
+        self.align = align
+        self._heap: List[Tuple[float, int, ScheduledPoll]] = []
+        self._entries: Dict[Hashable, ScheduledPoll] = {}
+        self._groups: Dict[Hashable, Set[ScheduledPoll]] = {}
+        self._counter = itertools.count()
+        self._queue: Optional[asyncio.Queue] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable):
+        return key in self._entries
+
+    def add(
+            self,
+            key: Hashable,
+            callback: PollCallback,
+            interval: timedelta,
+            *,
+            jitter: bool = True,
+            group: Optional[Hashable] = None,
+    ):
+        """Registers a poll, replacing any existing one with the same key.
+        With jitter the first run lands randomly within one interval, otherwise it runs right away"""
+        self.remove(key)
+        seconds = interval.total_seconds()
+        delay = random.uniform(0, seconds) if jitter else 0
+        entry = ScheduledPoll(key, callback, seconds, time.monotonic() + delay, group)
+        self._entries[key] = entry
+        if group is not None:
+            self._groups.setdefault(group, set()).add(entry)
+        SCHEDULED_POLLS.set(len(self._entries))
+        self._push(entry)
+
+    def remove(self, key: Hashable):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            SCHEDULED_POLLS.set(len(self._entries))
+            if entry.group is not None:
+                members = self._groups.get(entry.group)
+                members.discard(entry)
+                if not members:
+                    del self._groups[entry.group]
+            # Invalidates the heap item so the dispatcher drops it when it surfaces
+            entry.seq = -1
+
+    def reschedule(self, key: Hashable, interval: Optional[timedelta] = None, delay: Optional[float] = None):
+        """Changes the interval of a poll and/or moves its next run to ``delay`` seconds from now"""
+        entry = self._entries.get(key)
+        if entry is None:
+            raise KeyError(key)
+        if interval is not None:
+            entry.interval = interval.total_seconds()
+        if entry.running:
+            # The worker reschedules the entry with the new interval once it finishes
+            return
+        if delay is not None:
+            entry.due = time.monotonic() + delay
+        elif interval is not None:
+            entry.due = min(entry.due, time.monotonic() + entry.interval)
+        self._push(entry)
+
+    def start(self):
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue(maxsize=self.workers)
+        self._wakeup = asyncio.Event()
+        self._tasks.append(asyncio.create_task(self._dispatch()))
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._work()))
+        log.debug(f"Poll scheduler started with {self.workers} workers")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        log.debug("Poll scheduler stopped")
+
+    def _push(self, entry: ScheduledPoll):
+        entry.seq = next(self._counter)
+        heapq.heappush(self._heap, (entry.due, entry.seq, entry))
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._compact()
+        if self._wakeup is not None and self._heap[0][2] is entry:
+            self._wakeup.set()
+
+    def _due_with(self, entry: ScheduledPoll) -> List[ScheduledPoll]:
+        """Other entries of the group that are close enough to due to run along with ``entry``"""
+        if entry.group is None:
+            return []
+        now = time.monotonic()
+        return [
+            other for other in self._groups.get(entry.group, ())
+            if other is not entry and not other.running and other.due - now <= other.interval * self.align
+        ]
+
+    def _compact(self):
+        self._heap = [item for item in self._heap if item[1] == item[2].seq]
+        heapq.heapify(self._heap)
+
+    async def _dispatch(self):
+        while True:
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            due, seq, entry = self._heap[0]
+            if seq != entry.seq:
+                heapq.heappop(self._heap)
+                continue
+            delay = due - time.monotonic()
+            if delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self._heap)
+            entry.running = True
+            await self._queue.put(entry)
+            for other in self._due_with(entry):
+                if other.running or self._entries.get(other.key) is not other:
+                    continue
+                other.running = True
+                # Drops its heap item, the worker pushes a new one once it has run
+                other.seq = next(self._counter)
+                await self._queue.put(other)
+
+    async def _work(self):
+        while True:
+            entry = await self._queue.get()
+            SCHEDULER_LAG.observe(max(0.0, time.monotonic() - entry.due))
+            ACTIVE_TASKS.inc(kind='poll')
+            try:
+                await entry.callback()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception(f"Scheduled poll {entry.key} failed")
+            finally:
+                ACTIVE_TASKS.dec(kind='poll')
+                entry.running = False
+                self._queue.task_done()
+            if self._entries.get(entry.key) is entry:
+                entry.due = max(entry.due + entry.interval, time.monotonic())
+                self._push(entry)
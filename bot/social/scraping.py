@@ -0,0 +1,183 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from bot.social.http import HttpClient, raise_for_unavailable
+from metrics import SCRAPE_BYTES, SCRAPE_LOOP_SECONDS, SCRAPE_PAGES, SCRAPE_SECONDS
+
+log = logging.getLogger(__name__)
+
+ABBREVIATED = re.compile(r'([\d.,]+)\s*([KMB]?)', re.IGNORECASE)
+MULTIPLIERS = {'': 1, 'K': 1_000, 'M': 1_000_000, 'B': 1_000_000_000}
+
+
+def abbreviated_count(text: str) -> Optional[int]:
+    """Reads counts as pages display them, 1,234 or 1.2M"""
+    match = ABBREVIATED.search(text)
+    if match is None:
+        return None
+    number, suffix = match.groups()
+    try:
+        return int(float(number.replace(',', '')) * MULTIPLIERS[suffix.upper()])
+    except ValueError:
+        return None
+
+
+def instagram_followers(fragment: bytes) -> Optional[int]:
+    """Follower count from the window._sharedData JSON of a profile page"""
+    try:
+        data = json.loads(fragment)
+        return data['entry_data']['ProfilePage'][0]['graphql']['user']['edge_followed_by']['count']
+    except (ValueError, KeyError, IndexError, TypeError):
+        return None
+
+
+def tiktok_followers(fragment: bytes) -> Optional[int]:
+    """Follower count from the followers-count element of a profile page"""
+    _, _, text = fragment.decode('utf-8', errors='replace').partition('>')
+    return abbreviated_count(text)
+
+
+def worker_context() -> multiprocessing.context.BaseContext:
+    """Start method for parser processes. Forking the bot would copy its event loop, sockets
+    and threads into every worker, so workers come from a fork server (or spawn where there is none)
+    that only has this module loaded"""
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('spawn')
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload([__name__])
+    return context
+
+
+class Scraper:
+    """Pulls one value out of large HTML pages without holding up the event loop.
+
+    The response is streamed and reading stops as soon as the text between
+    ``start`` and ``end`` has arrived, so the rest of the page is never
+    downloaded and only the unmatched tail of what was read is kept. Fragments
+    up to ``inline_bytes`` are parsed on the loop, larger ones in a process
+    pool. Pages, bytes read, wall time and the time spent on the event loop per
+    page are recorded. A closed scraper starts no workers until it is opened
+    again.
+    """
+
+    def __init__(
+            self,
+            workers: Optional[int] = None,
+            chunk_size: int = 64 * 1024,
+            max_bytes: int = 8 * 2 ** 20,
+            inline_bytes: int = 32 * 1024,
+    ):
+        self.workers = workers if workers is not None else int(os.environ.get('SCRAPE_WORKERS', 2))
+        self.chunk_size = chunk_size
+        self.max_bytes = max_bytes
+        self.inline_bytes = inline_bytes
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._closed = False
+
+    @property
+    def pool(self) -> ProcessPoolExecutor:
+        # Worker processes are only started once a page needs them
+        if self._closed:
+            raise RuntimeError("Scraper is closed")
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=worker_context())
+            log.debug(f"Scraping pool started with {self.workers} workers")
+        return self._pool
+
+    def open(self):
+        self._closed = False
+
+    def close(self):
+        self._closed = True
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    async def _stream(
+            self,
+            http: HttpClient,
+            url: str,
+            start: bytes,
+            end: bytes,
+            provider: str,
+            headers: Optional[Dict[str, str]],
+    ) -> Tuple[Optional[bytes], float]:
+        """The bytes after ``start`` and before the next ``end``, None when the page has no ``start``,
+        and the seconds spent on the event loop looking for them"""
+        buffer = bytearray()
+        begin = -1
+        scanned = 0
+        read = 0
+        on_loop = 0.0
+        outcome = 'missing'
+        wall = time.perf_counter()
+        try:
+            async with http.get(url, headers=headers) as resp:
+                raise_for_unavailable(resp)
+                async for chunk in resp.content.iter_chunked(self.chunk_size):
+                    tick = time.perf_counter()
+                    read += len(chunk)
+                    buffer += chunk
+                    if begin < 0:
+                        found = buffer.find(start, max(scanned - len(start) + 1, 0))
+                        if found < 0:
+                            # Keep only enough of the page to match a marker split over chunks
+                            scanned = len(start) - 1
+                            del buffer[:-scanned or None]
+                        else:
+                            begin = found + len(start)
+                            scanned = begin
+                    if begin >= 0:
+                        stop = buffer.find(end, max(scanned - len(end) + 1, begin))
+                        scanned = len(buffer)
+                        if stop >= 0:
+                            outcome = 'found'
+                            on_loop += time.perf_counter() - tick
+                            return bytes(buffer[begin:stop]), on_loop
+                    on_loop += time.perf_counter() - tick
+                    if read > self.max_bytes:
+                        outcome = 'oversized'
+                        return None, on_loop
+                return None, on_loop
+        except Exception:
+            outcome = 'error'
+            raise
+        finally:
+            SCRAPE_PAGES.inc(provider=provider, outcome=outcome)
+            SCRAPE_BYTES.inc(read, provider=provider)
+            SCRAPE_SECONDS.observe(time.perf_counter() - wall, provider=provider)
+
+    async def scrape(
+            self,
+            http: HttpClient,
+            url: str,
+            start: bytes,
+            end: bytes,
+            parser: Callable[[bytes], Any],
+            provider: str,
+            headers: Optional[Dict[str, str]] = None,
+    ) -> Any:
+        """Streams the page up to the marked fragment and parses it, None when it is not there"""
+        fragment, on_loop = await self._stream(http, url, start, end, provider, headers)
+        try:
+            if fragment is None:
+                return None
+            if len(fragment) <= self.inline_bytes:
+                tick = time.perf_counter()
+                try:
+                    return parser(fragment)
+                finally:
+                    on_loop += time.perf_counter() - tick
+            return await asyncio.get_running_loop().run_in_executor(self.pool, parser, fragment)
+        finally:
+            SCRAPE_LOOP_SECONDS.observe(on_loop, provider=provider)
+
+
+scraper = Scraper()
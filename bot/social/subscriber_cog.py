@@ -1,14 +1,20 @@
-import asyncio
 import logging
+import time
 from datetime import datetime, timezone, timedelta
 from functools import partial
-from typing import Optional, Callable, Any, Dict, List
+from typing import Optional, Callable, Any, Dict, List, Tuple
 
 import discord
 from discord import app_commands, Interaction, ui
 from discord.ext import commands
 
+from bot.social.history import HistoryStore
+from bot.social.models import DisplaySettings, RecordKey
 from bot.social.provider_cog import ProviderCog, Provider, ProviderTaskService
+from bot.social.publisher import EmbedPublisher
+from bot.social.resilience import UNAVAILABLE
+from bot.social.scheduler import PollScheduler
+from bot.social.subscriptions import Subscription, SubscriptionIndex, SubscriptionKey
 from mixins.config import ConfigMixin
 from services import establish_member_config, string_timedelta
 
@@ -21,7 +27,13 @@ class SubscriberCog(ConfigMixin, commands.GroupCog, name='subscriber-display'):
         self.bot = bot
         self.provider_cog = provider_cog
         self.channel: Optional[discord.TextChannel] = None
-        self.tasks: Dict[str, asyncio.Task] = {}  # Composite key guild_id + member_id + provider_name
+        self.scheduler = PollScheduler()
+        self.services: Dict[SubscriptionKey, ProviderTaskService] = {}
+        self.index = SubscriptionIndex()
+        self.displays: Dict[RecordKey, DisplaySettings] = {}
+        self.rendered: Dict[int, Tuple[int, float]] = {}  # message id -> (content digest, last edit)
+        self.publisher = EmbedPublisher()
+        self.history_store = HistoryStore()
         self.provider_choices = [pd.name
             for pd in self.provider_cog.provider_definitions
         ]
@@ -30,19 +42,93 @@ class SubscriberCog(ConfigMixin, commands.GroupCog, name='subscriber-display'):
         super(SubscriberCog, self).__init__()
         self.first_run = True
 
+    async def cog_load(self):
+        self.provider_cog.schedulers.append(self.scheduler)
+        self.scheduler.start()
+        self.history_store.start()
+        self.watch_settings()
+
+    async def cog_unload(self):
+        self.unwatch_settings()
+        await self.scheduler.stop()
+        if self.scheduler in self.provider_cog.schedulers:
+            self.provider_cog.schedulers.remove(self.scheduler)
+        await self.publisher.close()
+        await self.history_store.close()
+        await self.flush_settings()
+
     @commands.Cog.listener()
     async def on_ready(self):
         if self.first_run:
             self.start_services()
             self.first_run = False
 
-    def find_task_key(self, task: asyncio.Task):
-        for key, t in self.tasks.items():
-            if t == task:
-                return key
-
-    def provider_factory(self, member: discord.Member, name: str):
-        return self.provider_cog.find_provider_instance_by_member_and_name(member, name)
+    @commands.Cog.listener()
+    async def on_provider_loaded(self, guild_id: int, member_id: int, provider_name: str):
+        if (guild_id, member_id, provider_name) in self.displays:
+            self.register_subscription(guild_id, member_id, provider_name)
+
+    def on_settings_changed(self, guild_id: Optional[str], member_id: Optional[str]):
+        if guild_id is None:
+            for guild_str in self.config_settings.keys():
+                self.on_settings_changed(guild_str, None)
+        elif member_id is None:
+            for member_str in self.config_settings.get(guild_id, {}).keys():
+                self.load_member_displays(guild_id, member_str)
+        else:
+            self.load_member_displays(guild_id, member_id)
+
+    def load_member_displays(self, guild_str: str, member_str: str) -> List[DisplaySettings]:
+        """Refreshes the display records of a member from the configuration"""
+        guild_id, member_id = int(guild_str), int(member_str)
+        settings = self.config_settings.get(guild_str, {}).get(member_str, {}).get('provider_settings', {})
+        loaded = []
+        for provider_name in self.provider_choices:
+            key = (guild_id, member_id, provider_name)
+            if provider_name not in settings:
+                removed = self.displays.pop(key, None)
+                if removed is not None:
+                    self.forget_rendered(removed.message_id)
+                    self.unregister_subscription(Subscription(*key))
+                continue
+            try:
+                display = DisplaySettings.from_config(guild_str, member_str, provider_name, settings[provider_name])
+            except (KeyError, ValueError) as e:
+                log.error(f"Invalid display settings for {key}: {e}")
+                continue
+            previous = self.displays.get(key)
+            if previous is not None and previous.message_id != display.message_id:
+                self.forget_rendered(previous.message_id)
+            self.displays[key] = display
+            loaded.append(display)
+        return loaded
+
+    def find_member(self, subscription: Subscription) -> Optional[discord.Member]:
+        guild = self.bot.get_guild(subscription.guild_id)
+        if guild is None:
+            return None
+        return guild.get_member(subscription.member_id)
+
+    def provider_for_key(self, key: SubscriptionKey) -> Optional[Provider]:
+        for subscription in self.index.subscriptions(key):
+            provider = self.provider_cog.find_provider_instance(*subscription)
+            if provider is not None and provider.target_id == key[1]:
+                return provider
+
+    def subscription_interval(self, subscription: Subscription) -> timedelta:
+        display = self.displays.get(subscription)
+        return display.interval if display is not None else ProviderTaskService.interval
+
+    def subscription_ceiling(self, subscription: Subscription) -> timedelta:
+        """Longest the display may go without a poll. Never past its heartbeat, so a refresh
+        is not held back by a backed off poll"""
+        display = self.displays.get(subscription)
+        if display is None:
+            return ProviderTaskService.interval
+        ceiling = display.max_interval or display.interval
+        if display.heartbeat:
+            ceiling = min(ceiling, display.heartbeat)
+        return max(ceiling, display.interval)
 
     def start_services(self):
         for guild_str in self.config_settings.keys():
@@ -53,26 +139,46 @@ class SubscriberCog(ConfigMixin, commands.GroupCog, name='subscriber-display'):
                 member = guild.get_member(int(member_str))
                 if member is None:
                     continue
-                provider_names = self.config_settings[guild_str][member_str]['provider_settings'].keys()
-                for name in list(provider_names):
-                    interval = string_timedelta(self.config_settings[guild_str][member_str]['provider_settings'][name]['interval'])
-                    provider = self.provider_cog.find_provider_instance_by_member_and_name(member, name)
-                    factory = partial(self.provider_factory, member=member, name=name)
-                    if provider is not None:
-                        self.start_provider_service(guild_str, member_str, name, factory, interval)
-
-    def start_provider_service(self, guild_id: str, member_id: str, name: str, factory: Callable, interval: timedelta):
-        composite_key = f"{guild_id}{member_id}{name}"
-        if composite_key in self.tasks:
-            task = self.tasks[composite_key]
-            if task is not None:
-                log.debug("Cancelling Task")
-                task.cancel()
-        pts = ProviderTaskService(name, factory, self.task_callback, interval)
-        task = pts.start()
-        self.tasks[composite_key] = task
-        log.debug(f"Provider Service Task started for {member_id}")
-
+                for display in self.load_member_displays(guild_str, member_str):
+                    self.register_subscription(*display.key)
+
+    def register_subscription(self, guild_id: int, member_id: int, name: str, jitter: bool = True) -> bool:
+        """Indexes the member's display under its provider target and makes sure that target is polled"""
+        provider = self.provider_cog.find_provider_instance(guild_id, member_id, name)
+        if provider is None:
+            return False
+        subscription = Subscription(guild_id, member_id, name)
+        key = (name, provider.target_id)
+        emptied = self.index.add(key, subscription)
+        if emptied is not None:
+            self.stop_provider_service(emptied)
+        self.start_provider_service(key, jitter)
+        return True
+
+    def unregister_subscription(self, subscription: Subscription):
+        emptied = self.index.remove(subscription)
+        if emptied is not None:
+            self.stop_provider_service(emptied)
+
+    def start_provider_service(self, key: SubscriptionKey, jitter: bool = True):
+        subscriptions = self.index.subscriptions(key)
+        interval = min(self.subscription_interval(s) for s in subscriptions)
+        ceiling = max(interval, min(self.subscription_ceiling(s) for s in subscriptions))
+        service = self.services.get(key)
+        if service is None:
+            factory = partial(self.provider_for_key, key)
+            service = ProviderTaskService(key, key[0], factory, self.task_callback, self.scheduler, interval, ceiling)
+            service.start(jitter=jitter)
+            self.services[key] = service
+            log.debug(f"Provider Service scheduled for {key}")
+        elif service.interval != interval or service.ceiling != ceiling or not jitter:
+            service.reschedule(interval, run_now=not jitter, ceiling=ceiling)
+
+    def stop_provider_service(self, key: SubscriptionKey):
+        service = self.services.pop(key, None)
+        if service is not None:
+            log.debug(f"Stopping Provider Service for {key}")
+            service.stop()
 
     def establish_config(self, guild_id: str, member_id: str):
         establish_member_config(self.config_settings, guild_id, member_id)
@@ -97,25 +203,73 @@ class SubscriberCog(ConfigMixin, commands.GroupCog, name='subscriber-display'):
             current_config = {}
         await itx.response.send_modal(SubscriberConfigModal(provider_name, self.modal_callback, current_config))
 
-    def make_embed(self, count: int, settings) -> discord.Embed:
-        embed = discord.Embed(description=settings['text'].format(count=count))
-        embed.set_image(url=settings['banner_url'])
+    @app_commands.command()
+    async def history(self, itx: Interaction, provider_name: str, span: str = '7d'):
+        """Shows how your subscriber count changed over a span (ex 7d)"""
+        duration = string_timedelta(span)
+        if not duration:
+            await itx.response.send_message("Span not valid format. ex: 7d12h", ephemeral=True)
+            return
+        key = self.index.key_of(Subscription(itx.guild_id, itx.user.id, provider_name))
+        if key is None:
+            await itx.response.send_message(f"No active display for {provider_name}.", ephemeral=True)
+            return
+        end = int(time.time())
+        points = self.history_store.query(key, end - int(duration.total_seconds()), end)
+        if not points:
+            await itx.response.send_message(f"No history recorded for {provider_name} yet.", ephemeral=True)
+            return
+        first, last = points[0], points[-1]
+        change = last.last - first.last
+        days = max(last.timestamp - first.timestamp, 1) / 86400
+        low = min(p.min for p in points)
+        high = max(p.max for p in points)
+        await itx.response.send_message(
+            f"{provider_name}: {first.last:,} → {last.last:,} ({change:+,}, {change / days:+,.1f}/day) "
+            f"since <t:{first.timestamp}:R>, low {low:,}, high {high:,}",
+            ephemeral=True
+        )
+
+    def make_embed(self, count: int, display: DisplaySettings) -> discord.Embed:
+        embed = discord.Embed(description=display.text.format(count=count))
+        embed.set_image(url=display.banner_url)
         embed.timestamp = datetime.now(timezone.utc)
         return embed
 
-    async def update_embed(self, member: discord.Member, embed:  discord.Embed, settings):
-        channel_id = int(settings['channel_id'])
-        message_id = settings['message_id'] and int(settings['message_id'])
+    @staticmethod
+    def embed_digest(embed: discord.Embed) -> int:
+        # The timestamp is left out on purpose, it changes on every render
+        return hash((embed.description, embed.image.url))
+
+    def forget_rendered(self, message_id: Optional[int]):
+        """Drops what a display's message was last rendered with, once the message is no longer used"""
+        if message_id is not None:
+            self.rendered.pop(message_id, None)
+
+    def needs_update(self, display: DisplaySettings, embed: discord.Embed) -> bool:
+        """Whether the display shows something other than embed, or is due its heartbeat refresh"""
+        rendered = display.message_id and self.rendered.get(display.message_id)
+        if not rendered:
+            return True
+        digest, last_edit = rendered
+        if digest != self.embed_digest(embed):
+            return True
+        heartbeat = display.heartbeat
+        return bool(heartbeat) and time.monotonic() - last_edit >= heartbeat.total_seconds()
+
+    async def update_embed(self, member: discord.Member, embed:  discord.Embed, display: DisplaySettings):
+        channel_id = display.channel_id
+        message_id = display.message_id
         channel = member.guild.get_channel(channel_id)
         new_message = False
         message = None
         if channel is None:
             log.warning(f"{channel_id} on Guild {member.guild.name} No longer available")
-            return
+            return None, False
         try:
 
             if message_id is not None:
-                log.debug(f"Editing partial message for {settings['message_id']}")
+                log.debug(f"Editing partial message for {message_id}")
                 partial_message = channel.get_partial_message(message_id)
                 message = await partial_message.edit(embed=embed)
             else:
@@ -131,45 +285,87 @@ class SubscriberCog(ConfigMixin, commands.GroupCog, name='subscriber-display'):
 
         return message, new_message
 
-    async def task_callback(self, provider_name: str, provider: Provider):
-        log.debug(f"In task callback for {provider_name}")
-        for guild_str in self.config_settings.keys():
-            guild = self.bot.get_guild(int(guild_str))
-            if guild is None:
-                continue
-            for member_str in self.config_settings[guild_str].keys():
-                member = guild.get_member(int(member_str))
-                if member is None:
-                    log.debug(f"Member {member_str} does not exist in Guild {guild_str}")
-                    continue
-                log.debug(f"Found member {member}")
-                settings = self.config_settings[guild_str][member_str]['provider_settings'].get(provider_name)
-                if settings is not None:
-                    try:
-                        count = await provider.subscriber_count()
-                        embed = self.make_embed(count, settings)
-                        message, new_message = await self.update_embed(member, embed, settings)
-                        if message is not None and new_message:
-                            settings = self.config_settings[guild_str][member_str]['provider_settings'][provider_name]['message_id'] = message.id
-                            self.save_settings()
-                    except KeyError as e:
-                        log.error(f"KeyError on subscription settings: {settings}: {e}")
-                else:
-                    log.warning(f"Could not find settings for {provider_name} Guild: {guild_str} Member: {member_str}")
+    async def task_callback(self, key: SubscriptionKey, provider: Provider) -> Optional[int]:
+        """Polls the target's count and updates every display of it. Returns the count
+        when it was fetched from upstream rather than served from cache"""
+        log.debug(f"In task callback for {key}")
+        subscriptions = self.index.subscriptions(key)
+        if not subscriptions:
+            return None
+        service = self.services.get(key)
+        interval = service.current_interval if service is not None else ProviderTaskService.interval
+        try:
+            # Half an interval so the count this poll fetched last time is never served back to it
+            count, fetched = await self.provider_cog.poll_count(provider, max_age=interval / 2)
+        except UNAVAILABLE as e:
+            log.warning(f"No count for {key} while its upstream is unavailable: {e!r}")
+            return None
+        except (KeyError, IndexError, TypeError, ValueError) as e:
+            log.warning(f"Could not read a count for {key} from the upstream response: {e!r}")
+            return None
+        if fetched:
+            # A cached count was already recorded by the poll that fetched it
+            self.history_store.append(key, count)
+        for subscription in list(subscriptions):
+            await self.update_subscription(subscription, count)
         log.debug("Task callback finished")
+        return count if fetched else None
+
+    async def update_subscription(self, subscription: Subscription, count: int):
+        display = self.displays.get(subscription)
+        if display is None:
+            log.warning(f"Could not find display settings for {subscription}")
+            return
+        member = self.find_member(subscription)
+        if member is None:
+            log.debug(f"Member {subscription.member_id} does not exist in Guild {subscription.guild_id}")
+            return
+        try:
+            embed = self.make_embed(count, display)
+        except (KeyError, IndexError) as e:
+            log.error(f"Could not render display text for {subscription}: {e}")
+            return
+        if not self.needs_update(display, embed):
+            log.debug(f"Display for {subscription} unchanged, skipping edit")
+            return
+        self.publisher.submit(display.channel_id, subscription, partial(self.publish_embed, subscription, member, embed))
+
+    async def publish_embed(self, subscription: Subscription, member: discord.Member, embed: discord.Embed):
+        display = self.displays.get(subscription)
+        if display is None:
+            return
+        message, new_message = await self.update_embed(member, embed, display)
+        if message is not None:
+            self.rendered[message.id] = (self.embed_digest(embed), time.monotonic())
+        if message is not None and new_message:
+            self.forget_rendered(display.message_id)
+            display.message_id = message.id
+            guild_str, member_str = str(subscription.guild_id), str(subscription.member_id)
+            self.config_settings[guild_str][member_str]['provider_settings'][subscription.provider_name]['message_id'] = message.id
+            self.save_settings(guild_str, member_str)
 
     async def modal_callback(self, itx: Interaction, provider_name: str, payload: Dict[str, Any]):
         guild_str = str(itx.guild_id)
         member_str = str(itx.user.id)
         log.debug(payload)
         channel = itx.guild.get_channel(int(payload['channel_id']))
-        interval = string_timedelta(payload['interval'])
-        if interval is None:
-            await itx.followup.send("Interval not valid format. ex: 1d2h3m4s. Changes not saved.", ephemeral=True)
+        # "5m-1h" polls every 5m while the count moves and backs off to 1h while it does not
+        floor, _, ceiling = (part.strip() for part in payload['interval'].partition('-'))
+        interval = string_timedelta(floor)
+        max_interval = string_timedelta(ceiling) if ceiling else None
+        if interval is None or (ceiling and max_interval is None):
+            await itx.followup.send("Interval not valid format. ex: 1d2h3m4s or 5m-1h. Changes not saved.", ephemeral=True)
+            return
+        if max_interval is not None and max_interval < interval:
+            await itx.followup.send("Maximum interval is shorter than the interval. Changes not saved.", ephemeral=True)
             return
+        payload['interval'], payload['max_interval'] = floor, ceiling
         if channel is None:
             await itx.followup.send("Channel not found. Changes not saved.", ephemeral=True)
             return
+        if payload['heartbeat'] and string_timedelta(payload['heartbeat']) is None:
+            await itx.followup.send("Heartbeat not valid format. ex: 1h. Changes not saved.", ephemeral=True)
+            return
 
         self.establish_config(guild_str, member_str)
         if provider_name not in self.config_settings[guild_str][member_str]['provider_settings'].keys():
@@ -179,12 +375,8 @@ class SubscriberCog(ConfigMixin, commands.GroupCog, name='subscriber-display'):
         else:
             payload.update({'message_id': None})
             self.config_settings[guild_str][member_str]['provider_settings'][provider_name] = payload
-        self.save_settings()
-        provider = self.provider_cog.find_provider_instance_by_member_and_name(itx.user, provider_name)
-        if provider is not None:
-            factory = partial(self.provider_factory, member=itx.user, name=provider_name)
-            self.start_provider_service(guild_str, member_str, provider_name, factory, interval)
-        else:
+        self.save_settings(guild_str, member_str)
+        if not self.register_subscription(itx.guild_id, itx.user.id, provider_name, jitter=False):
             log.error(f"Could not start provider service {provider_name} for {itx.user.name} in {itx.guild.name}")
         await itx.followup.send(f"Settings for {provider_name} saved.", ephemeral=True)
 
@@ -203,7 +395,8 @@ class SubscriberConfigModal(ui.Modal):
     channel_id = ui.TextInput(label="Enter Channel ID to post to.")
     text = ui.TextInput(label="Enter message. Use {count} to substitute")
     banner_url = ui.TextInput(label="Banner Image URL")
-    interval = ui.TextInput(label="Enter the update interval (ex 1d2h3m4s)", placeholder="5m")
+    interval = ui.TextInput(label="Update interval (ex 5m, or 5m-1h to adapt)", placeholder="5m")
+    heartbeat = ui.TextInput(label="Refresh unchanged display every (optional)", placeholder="1h", required=False)
 
     def __init__(self, provider_name: str, callback: Callable, current_config: Optional[Dict[str, str]], **kwargs):
         log.debug(current_config)
@@ -211,7 +404,10 @@ class SubscriberConfigModal(ui.Modal):
             self.channel_id.default = current_config.get('channel_id', '')
             self.text.default = current_config.get('text', '')
             self.banner_url.default = current_config.get('banner_url', '')
-            self.interval.default = current_config.get('interval', '')
+            interval = current_config.get('interval', '')
+            max_interval = current_config.get('max_interval', '')
+            self.interval.default = f"{interval}-{max_interval}" if max_interval else interval
+            self.heartbeat.default = current_config.get('heartbeat', '')
         super().__init__(title=f"Configure Subscriber Alert for {provider_name}", **kwargs)
         self.provider_name = provider_name
         self.callback = callback
@@ -223,6 +419,7 @@ class SubscriberConfigModal(ui.Modal):
             'text': self.text.value,
             'banner_url': self.banner_url.value,
             'channel_id': self.channel_id.value,
-            'interval': self.interval.value
+            'interval': self.interval.value,
+            'heartbeat': self.heartbeat.value
         }
         await self.callback(itx, self.provider_name, payload)
\ No newline at end of file
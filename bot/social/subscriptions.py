@@ -0,0 +1,60 @@
+from typing import Dict, List, NamedTuple, Optional, Tuple, Iterable
+
+# (provider name, provider target id)
+SubscriptionKey = Tuple[str, str]
+
+
+class Subscription(NamedTuple):
+    guild_id: int
+    member_id: int
+    provider_name: str
+
+
+class SubscriptionIndex:
+    """Maps a provider target to every display that shows its count.
+
+    Kept up to date incrementally as display and provider settings change so a
+    poll only needs to look at the displays it affects.
+    """
+
+    def __init__(self):
+        self._by_key: Dict[SubscriptionKey, List[Subscription]] = {}
+        self._key_of: Dict[Subscription, SubscriptionKey] = {}
+
+    def __len__(self):
+        return len(self._key_of)
+
+    def __contains__(self, subscription: Subscription):
+        return subscription in self._key_of
+
+    def keys(self) -> Iterable[SubscriptionKey]:
+        return self._by_key.keys()
+
+    def key_of(self, subscription: Subscription) -> Optional[SubscriptionKey]:
+        return self._key_of.get(subscription)
+
+    def subscriptions(self, key: SubscriptionKey) -> List[Subscription]:
+        return self._by_key.get(key, [])
+
+    def add(self, key: SubscriptionKey, subscription: Subscription) -> Optional[SubscriptionKey]:
+        """Indexes the subscription under key. Returns the key it was previously
+        indexed under if that group is now empty"""
+        previous = self._key_of.get(subscription)
+        if previous == key:
+            return None
+        emptied = self.remove(subscription) if previous is not None else None
+        self._by_key.setdefault(key, []).append(subscription)
+        self._key_of[subscription] = key
+        return emptied
+
+    def remove(self, subscription: Subscription) -> Optional[SubscriptionKey]:
+        """Removes the subscription. Returns its key if no subscriptions are left under it"""
+        key = self._key_of.pop(subscription, None)
+        if key is None:
+            return None
+        group = self._by_key[key]
+        group.remove(subscription)
+        if not group:
+            del self._by_key[key]
+            return key
+        return None
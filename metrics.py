@@ -0,0 +1,332 @@
+import logging
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from aiohttp import web
+
+log = logging.getLogger(__name__)
+
+LabelValues = Tuple[str, ...]
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _label_text(self, values: LabelValues, extra: Optional[Tuple[str, str]] = None) -> str:
+        pairs = list(zip(self.labelnames, values))
+        if extra is not None:
+            pairs.append(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+    def samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+            *self.samples(),
+        ]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def total(self) -> float:
+        return sum(self.values.values())
+
+    def samples(self) -> Iterator[str]:
+        for values, value in sorted(self.values.items()):
+            yield f"{self.name}{self._label_text(values)} {_format_value(value)}"
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels: str):
+        self.values[self._key(labels)] = value
+
+    def dec(self, amount: float = 1, **labels: str):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        # label values -> (per bucket counts, sum, count)
+        self.values: Dict[LabelValues, List] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        state = self.values.get(key)
+        if state is None:
+            state = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[0][i] += 1
+                break
+        state[1] += value
+        state[2] += 1
+
+    @contextmanager
+    def time(self, **labels: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def quantile(self, q: float, **labels: str) -> float:
+        """Upper bound of the bucket holding the q-th observation, merged over labels not given"""
+        counts = [0] * len(self.buckets)
+        for values, state in self.values.items():
+            if all(values[self.labelnames.index(name)] == str(value) for name, value in labels.items()):
+                counts = [a + b for a, b in zip(counts, state[0])]
+        total = sum(counts)
+        if not total:
+            return 0.0
+        seen = 0
+        for bound, count in zip(self.buckets, counts):
+            seen += count
+            if seen >= q * total:
+                return bound
+        return self.buckets[-1]
+
+    def count(self) -> int:
+        return sum(state[2] for state in self.values.values())
+
+    def samples(self) -> Iterator[str]:
+        for values, (counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket{self._label_text(values, ('le', _format_value(bound)))} {cumulative}"
+            yield f"{self.name}_sum{self._label_text(values)} {_format_value(total)}"
+            yield f"{self.name}_count{self._label_text(values)} {count}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def _register(self, metric: Metric) -> Metric:
+        existing = self.metrics.get(metric.name)
+        if existing is not None:
+            return existing
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        """Prometheus text exposition format"""
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+FETCH_SECONDS = REGISTRY.histogram(
+    'ctcceo_provider_fetch_seconds', 'Upstream subscriber count request latency', ('provider',))
+FETCH_FAILURES = REGISTRY.counter(
+    'ctcceo_provider_fetch_failures_total', 'Upstream subscriber count requests that raised', ('provider', 'error'))
+UPSTREAM_RESPONSES = REGISTRY.counter(
+    'ctcceo_upstream_responses_total', 'HTTP responses from provider APIs', ('host', 'status'))
+UPSTREAM_ERRORS = REGISTRY.counter(
+    'ctcceo_upstream_errors_total', 'HTTP requests to provider APIs that got no response', ('host', 'error'))
+UPSTREAM_BYTES = REGISTRY.counter(
+    'ctcceo_upstream_bytes_total', 'Response body bytes downloaded from provider APIs', ('host',))
+UPSTREAM_BYTES_SAVED = REGISTRY.counter(
+    'ctcceo_upstream_bytes_saved_total', 'Response body bytes not downloaded thanks to a 304 Not Modified', ('host',))
+UPSTREAM_RETRIES = REGISTRY.counter(
+    'ctcceo_upstream_retries_total', 'Upstream requests retried after a transient failure', ('provider',))
+UPSTREAM_SHORT_CIRCUITED = REGISTRY.counter(
+    'ctcceo_upstream_short_circuited_total', 'Upstream requests not sent because the circuit was open', ('upstream',))
+CIRCUITS_OPEN = REGISTRY.gauge(
+    'ctcceo_circuits_open', 'Upstream hosts and credentials currently short-circuited')
+UPSTREAM_QUEUE_SECONDS = REGISTRY.histogram(
+    'ctcceo_upstream_queue_seconds', 'Time a request waited for a concurrency slot', ('provider',))
+UPSTREAM_IN_FLIGHT = REGISTRY.gauge(
+    'ctcceo_upstream_in_flight', 'Upstream subscriber count requests running', ('provider',))
+SCHEDULER_LAG = REGISTRY.histogram(
+    'ctcceo_scheduler_lag_seconds', 'Delay between when a poll was due and when it started')
+SCHEDULED_POLLS = REGISTRY.gauge(
+    'ctcceo_scheduled_polls', 'Polls registered with the scheduler')
+ACTIVE_TASKS = REGISTRY.gauge(
+    'ctcceo_active_tasks', 'Tasks currently running', ('kind',))
+COUNT_CACHE_HITS = REGISTRY.counter(
+    'ctcceo_count_cache_hits_total', 'Subscriber count lookups served from cache')
+COUNT_CACHE_MISSES = REGISTRY.counter(
+    'ctcceo_count_cache_misses_total', 'Subscriber count lookups with no fresh enough cached count')
+COUNT_CACHE_EVICTIONS = REGISTRY.counter(
+    'ctcceo_count_cache_evictions_total', 'Cached subscriber counts dropped to stay within the cache size')
+DISCORD_EDIT_SECONDS = REGISTRY.histogram(
+    'ctcceo_discord_edit_seconds', 'Time taken to send or edit a display message')
+DISCORD_RATE_LIMITED = REGISTRY.counter(
+    'ctcceo_discord_rate_limited_total', 'Display writes rejected with 429')
+PUBLISH_QUEUE_DEPTH = REGISTRY.gauge(
+    'ctcceo_publish_queue_depth', 'Displays with a write waiting to be published')
+PUBLISH_LATENCY_SECONDS = REGISTRY.histogram(
+    'ctcceo_publish_latency_seconds', 'Time from a display write being queued to it being published',
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0))
+CONFIG_SAVE_SECONDS = REGISTRY.histogram(
+    'ctcceo_config_save_seconds', 'Time taken to write configuration to storage', ('backend',))
+CONFIG_PENDING = REGISTRY.gauge(
+    'ctcceo_config_pending_sections', 'Configuration sections changed but not yet flushed to storage')
+QUOTA_USED = REGISTRY.gauge(
+    'ctcceo_quota_used_units', 'API quota units spent today per credential', ('provider', 'credential'))
+QUOTA_PROJECTED = REGISTRY.gauge(
+    'ctcceo_quota_projected_units', 'API quota units a credential will have spent at reset at its current burn rate',
+    ('provider', 'credential'))
+SCRAPE_PAGES = REGISTRY.counter(
+    'ctcceo_scrape_pages_total', 'HTML pages scraped, by whether the marked fragment was found', ('provider', 'outcome'))
+SCRAPE_BYTES = REGISTRY.counter(
+    'ctcceo_scrape_bytes_total', 'HTML bytes read before the scraper stopped', ('provider',))
+SCRAPE_SECONDS = REGISTRY.histogram(
+    'ctcceo_scrape_seconds', 'Time taken to stream a page up to its marked fragment', ('provider',))
+SCRAPE_LOOP_SECONDS = REGISTRY.histogram(
+    'ctcceo_scrape_loop_seconds', 'Time a scraped page kept the event loop busy',
+    ('provider',), buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5))
+
+
+def _ms(seconds: float) -> str:
+    return f"{seconds * 1000:.0f}ms" if seconds != float('inf') else f">{DEFAULT_BUCKETS[-1]:.0f}s"
+
+
+def summary() -> List[str]:
+    """One line per area of the polling pipeline, for the owner stats command"""
+    lines = []
+    for provider in sorted({values[0] for values in FETCH_SECONDS.values}):
+        lines.append(
+            f"fetch {provider}: p50 {_ms(FETCH_SECONDS.quantile(0.5, provider=provider))} "
+            f"p99 {_ms(FETCH_SECONDS.quantile(0.99, provider=provider))}"
+        )
+    lines.append(f"fetch failures: {FETCH_FAILURES.total():.0f}")
+    statuses: Dict[str, float] = {}
+    for (_, status), count in UPSTREAM_RESPONSES.values.items():
+        statuses[status] = statuses.get(status, 0) + count
+    responses = ", ".join(f"{status}={count:.0f}" for status, count in sorted(statuses.items())) or "none"
+    lines.append(f"upstream: {responses}, errors={UPSTREAM_ERRORS.total():.0f}")
+    lines.append(
+        f"upstream resilience: retries {UPSTREAM_RETRIES.total():.0f}, "
+        f"short-circuited {UPSTREAM_SHORT_CIRCUITED.total():.0f}, open circuits {CIRCUITS_OPEN.total():.0f}"
+    )
+    lines.append(
+        f"upstream bodies: {UPSTREAM_BYTES.total() / 1024:.0f} KiB downloaded, "
+        f"{UPSTREAM_BYTES_SAVED.total() / 1024:.0f} KiB saved by 304s"
+    )
+    lines.append(
+        f"upstream queue: p50 {_ms(UPSTREAM_QUEUE_SECONDS.quantile(0.5))} p99 {_ms(UPSTREAM_QUEUE_SECONDS.quantile(0.99))}, "
+        f"in flight {UPSTREAM_IN_FLIGHT.total():.0f}"
+    )
+    lines.append(
+        f"scheduler lag: p50 {_ms(SCHEDULER_LAG.quantile(0.5))} p99 {_ms(SCHEDULER_LAG.quantile(0.99))}, "
+        f"polls {SCHEDULED_POLLS.total():.0f}"
+    )
+    lookups = COUNT_CACHE_HITS.total() + COUNT_CACHE_MISSES.total()
+    hit_rate = COUNT_CACHE_HITS.total() / lookups if lookups else 0.0
+    lines.append(
+        f"count cache: hits {COUNT_CACHE_HITS.total():.0f}, misses {COUNT_CACHE_MISSES.total():.0f} "
+        f"({hit_rate:.0%} hit rate), evictions {COUNT_CACHE_EVICTIONS.total():.0f}"
+    )
+    lines.append(
+        f"discord edits: p50 {_ms(DISCORD_EDIT_SECONDS.quantile(0.5))} "
+        f"p99 {_ms(DISCORD_EDIT_SECONDS.quantile(0.99))}, 429s {DISCORD_RATE_LIMITED.total():.0f}"
+    )
+    lines.append(
+        f"publish queue: depth {PUBLISH_QUEUE_DEPTH.total():.0f}, latency p50 {_ms(PUBLISH_LATENCY_SECONDS.quantile(0.5))} "
+        f"p99 {_ms(PUBLISH_LATENCY_SECONDS.quantile(0.99))}"
+    )
+    lines.append(
+        f"config saves: {CONFIG_SAVE_SECONDS.count()} p99 {_ms(CONFIG_SAVE_SECONDS.quantile(0.99))}, "
+        f"pending {CONFIG_PENDING.total():.0f}"
+    )
+    for provider in sorted({values[0] for values in QUOTA_USED.values}):
+        used = [v for (name, _), v in QUOTA_USED.values.items() if name == provider]
+        projected = [v for (name, _), v in QUOTA_PROJECTED.values.items() if name == provider]
+        lines.append(
+            f"quota {provider}: {len(used)} credentials, used {sum(used):.0f} today, "
+            f"projected {sum(projected):.0f} by reset, busiest {max(projected):.0f}"
+        )
+    if SCRAPE_PAGES.values:
+        lines.append(
+            f"scraping: {SCRAPE_PAGES.total():.0f} pages, {SCRAPE_BYTES.total() / 2 ** 20:.1f} MiB read, "
+            f"p99 {_ms(SCRAPE_SECONDS.quantile(0.99))}, loop block p99 {_ms(SCRAPE_LOOP_SECONDS.quantile(0.99))}"
+        )
+    tasks = ", ".join(f"{kind}={count:.0f}" for (kind,), count in sorted(ACTIVE_TASKS.values.items())) or "none"
+    lines.append(f"active tasks: {tasks}")
+    return lines
+
+
+class MetricsServer:
+    """Serves the registry at ``/metrics`` for Prometheus to scrape"""
+
+    def __init__(self, registry: Registry = REGISTRY, host: str = '127.0.0.1', port: int = 9100):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._runner: Optional[web.AppRunner] = None
+
+    async def metrics(self, request: web.Request) -> web.Response:
+        return web.Response(
+            body=self.registry.render().encode(),
+            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'},
+        )
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/metrics', self.metrics)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        log.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
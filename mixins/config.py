@@ -1,31 +1,26 @@
-import collections
-import json
 import logging
-import os
+from typing import Optional
 
-from atomicwrites import atomic_write
-
-BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '../', 'static'))
-FILE_PATH = os.path.normpath(f'{BASE_DIR}/settings.json')
+from mixins.store import get_store
 
 log = logging.getLogger(__name__)
 
 class ConfigMixin:
     """Mixin that will help aid adding configuration parameters
     that can be easily serialized to disk
+
+    Settings are kept per class under ``config_settings`` shaped as
+    guild id -> member id -> member settings. The mapping is a view into the
+    process-wide ConfigStore, so any cog can look at another's namespace
+    with ``config_namespace``. With ``write_behind`` saves made from the
+    event loop are batched and written in the background.
     """
+    write_behind = True
+
     def __init__(self):
         super(ConfigMixin, self).__init__()
-        self._config = collections.defaultdict(dict)
         self.parent_key = str(self.__class__.__name__)
-        self.config_settings = collections.defaultdict(dict)
-
-        if not os.path.exists(BASE_DIR):
-            os.makedirs(BASE_DIR)
-
-        if not os.path.exists(FILE_PATH):
-            self._config[self.parent_key] = {}
-
+        self.store = get_store()
         self._load_configuration()
 
 
@@ -33,56 +28,56 @@ class ConfigMixin:
     def _load_configuration(self) -> None:
         """
         Reloads the configuration into the main dictionary object
-        Parameters
-        ----------
-        path
 
         Returns
         -------
 
         """
-        try:
-            with open(FILE_PATH, 'r') as f:
-                self._config = json.load(f)
-            if not self.config_settings:
-                self.config_settings = self._config[self.parent_key]
-
-        except KeyError:
-            pass
-
-        except IOError:
-            # File does not exist
-            with atomic_write(FILE_PATH, overwrite=True) as f:
-                self._config[self.parent_key] = {}
-                json.dump(self._config, f)
-
-    def save_settings(self):
+        self.config_settings = self.store.namespace(self.parent_key)
+
+    def config_namespace(self, name: str):
+        return self.store.namespace(name)
+
+    def on_settings_changed(self, guild_id: Optional[str], member_id: Optional[str]):
         """
-        Persists the settings to disk
+        Called after this class's settings were saved, by any instance
+        Parameters
+        ----------
+        guild_id
+            Guild that changed, None if all may have
+        member_id
+            Member that changed, None if all in the guild may have
+
         Returns
         -------
 
         """
-        # Read in the most recent contents in case another process altered.
-        self._load_configuration()
-        self._config[self.parent_key] = self.config_settings
-        log.debug(f'mixin config: {self.config_settings}')
-
-        # Write out the updated contents
-        with atomic_write(FILE_PATH, overwrite=True) as f:
-            json.dump(self._config, f)
-
-
-
-
-
-
-
-
-
+        pass
 
+    def watch_settings(self):
+        """Starts delivering on_settings_changed notifications"""
+        self.store.subscribe(self.parent_key, self.on_settings_changed)
 
+    def unwatch_settings(self):
+        self.store.unsubscribe(self.parent_key, self.on_settings_changed)
 
+    def save_settings(self, guild_id: Optional[str] = None, member_id: Optional[str] = None):
+        """
+        Persists the settings to disk
+        Parameters
+        ----------
+        guild_id
+            Only persist this guild's settings
+        member_id
+            Only persist this member's settings within guild_id
 
+        Returns
+        -------
 
+        """
+        log.debug(f'mixin config save: {self.parent_key} guild={guild_id} member={member_id}')
+        self.store.save(self.parent_key, guild_id, member_id, background=self.write_behind)
 
+    async def flush_settings(self):
+        """Writes out every pending background save"""
+        await self.store.flush()
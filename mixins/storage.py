@@ -0,0 +1,346 @@
+import json
+import logging
+import os
+import asyncio
+import atexit
+import sqlite3
+import threading
+import time
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Set, Tuple
+
+from atomicwrites import atomic_write
+
+from metrics import CONFIG_PENDING, CONFIG_SAVE_SECONDS
+
+BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '../', 'static'))
+JSON_PATH = os.path.normpath(f'{BASE_DIR}/settings.json')
+SQLITE_PATH = os.path.normpath(f'{BASE_DIR}/settings.db')
+
+log = logging.getLogger(__name__)
+
+# (guild id, member id), None standing for every guild or every member
+DirtyKey = Tuple[Optional[str], Optional[str]]
+
+
+class LazySettings(MutableMapping):
+    """Guild id -> member settings mapping that only loads a guild when it is first accessed"""
+
+    def __init__(self, loader: Callable[[str], Dict[str, Any]], guild_ids: Iterable[str]):
+        self._loader = loader
+        self._guilds: Dict[str, Optional[Dict[str, Any]]] = dict.fromkeys(guild_ids)
+
+    def __getitem__(self, guild_id: str) -> Dict[str, Any]:
+        guild = self._guilds[guild_id]
+        if guild is None:
+            guild = self._guilds[guild_id] = self._loader(guild_id)
+        return guild
+
+    def __setitem__(self, guild_id: str, value: Dict[str, Any]):
+        self._guilds[guild_id] = value
+
+    def __delitem__(self, guild_id: str):
+        del self._guilds[guild_id]
+
+    def __contains__(self, guild_id) -> bool:
+        return guild_id in self._guilds
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._guilds)
+
+    def __len__(self) -> int:
+        return len(self._guilds)
+
+    def loaded(self) -> Iterator[str]:
+        return (guild_id for guild_id, guild in self._guilds.items() if guild is not None)
+
+
+class StorageBackend:
+    """Persists the settings of each ConfigMixin namespace.
+
+    Settings are shaped guild id -> member id -> member settings. Backends that
+    can write part of a namespace use ``guild_id``/``member_id`` to narrow a save
+    down to what changed.
+    """
+    partial_saves = False
+
+    def load(self, namespace: str) -> MutableMapping:
+        raise NotImplementedError
+
+    def snapshot(self, namespace: str, settings: MutableMapping, guild_id: Optional[str] = None, member_id: Optional[str] = None) -> Any:
+        """Captures what a save has to write so that write() can run on another thread
+        while the settings keep changing"""
+        raise NotImplementedError
+
+    def write(self, namespace: str, snapshot: Any):
+        raise NotImplementedError
+
+    def save(self, namespace: str, settings: MutableMapping, guild_id: Optional[str] = None, member_id: Optional[str] = None):
+        self.write(namespace, self.snapshot(namespace, settings, guild_id, member_id))
+
+    def close(self):
+        pass
+
+
+class JsonStorage(StorageBackend):
+    """Whole-document storage in settings.json, rewritten atomically on every save.
+
+    The file is parsed once. Saves rebuild it from the last serialized form of
+    each namespace rather than reading it back in.
+    """
+
+    def __init__(self, path: str = JSON_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._config: Optional[Dict[str, Any]] = None
+        self._serialized: Dict[str, str] = {}
+
+    def _read(self) -> Dict[str, Any]:
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except IOError:
+            # File does not exist
+            with atomic_write(self.path, overwrite=True) as f:
+                json.dump({}, f)
+            return {}
+
+    def load(self, namespace: str) -> MutableMapping:
+        if self._config is None:
+            self._config = self._read()
+            self._serialized = {key: json.dumps(value) for key, value in self._config.items()}
+        return self._config.setdefault(namespace, {})
+
+    def snapshot(self, namespace: str, settings: MutableMapping, guild_id: Optional[str] = None, member_id: Optional[str] = None) -> Any:
+        return json.dumps(settings)
+
+    def write(self, namespace: str, snapshot: Any):
+        with self._lock:
+            self._serialized[namespace] = snapshot
+            document = ', '.join(f'{json.dumps(key)}: {value}' for key, value in self._serialized.items())
+            with atomic_write(self.path, overwrite=True) as f:
+                f.write(f'{{{document}}}')
+
+
+class SqliteStorage(StorageBackend):
+    """One row per member and namespace in a WAL-mode SQLite database.
+
+    Guilds are loaded lazily and saves only upsert the rows that were named.
+    Settings from an existing settings.json are imported on first use.
+    """
+    partial_saves = True
+
+    def __init__(self, path: str = SQLITE_PATH, json_path: Optional[str] = JSON_PATH):
+        self.path = path
+        # Writes may come from the write-behind thread, the lock keeps the connection to one user at a time
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS settings ("
+                "namespace TEXT NOT NULL, guild_id TEXT NOT NULL, member_id TEXT NOT NULL, data TEXT NOT NULL, "
+                "PRIMARY KEY (namespace, guild_id, member_id)) WITHOUT ROWID"
+            )
+            self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        if json_path is not None:
+            self._migrate_json(json_path)
+
+    def _migrate_json(self, json_path: str):
+        if self._db.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone() is not None:
+            return
+        try:
+            with open(json_path, 'r') as f:
+                document = json.load(f)
+        except IOError:
+            document = {}
+        rows = [
+            (namespace, guild_id, member_id, json.dumps(data))
+            for namespace, guilds in document.items()
+            for guild_id, members in guilds.items()
+            for member_id, data in members.items()
+        ]
+        with self._db:
+            self._db.executemany("INSERT OR REPLACE INTO settings VALUES (?, ?, ?, ?)", rows)
+            self._db.execute("INSERT INTO meta VALUES ('json_migrated', ?)", (json_path,))
+        if rows:
+            log.info(f"Migrated {len(rows)} member settings from {json_path}")
+
+    def load(self, namespace: str) -> MutableMapping:
+        with self._lock:
+            cursor = self._db.execute("SELECT DISTINCT guild_id FROM settings WHERE namespace = ?", (namespace,))
+            guild_ids = [row[0] for row in cursor]
+        return LazySettings(lambda guild_id: self._load_guild(namespace, guild_id), guild_ids)
+
+    def _load_guild(self, namespace: str, guild_id: str) -> Dict[str, Any]:
+        with self._lock:
+            cursor = self._db.execute(
+                "SELECT member_id, data FROM settings WHERE namespace = ? AND guild_id = ?", (namespace, guild_id)
+            )
+            return {member_id: json.loads(data) for member_id, data in cursor}
+
+    def snapshot(self, namespace: str, settings: MutableMapping, guild_id: Optional[str] = None, member_id: Optional[str] = None) -> Any:
+        """List of (guild id, member id, serialized settings) rows. A member id of None replaces
+        the whole guild and serialized settings of None delete the row"""
+        if guild_id is None:
+            guild_ids = settings.loaded() if isinstance(settings, LazySettings) else settings.keys()
+        else:
+            guild_ids = [guild_id]
+
+        rows = []
+        for gid in list(guild_ids):
+            members = settings.get(gid, {})
+            if member_id is not None:
+                data = members.get(member_id)
+                rows.append((gid, member_id, None if data is None else json.dumps(data)))
+                continue
+            rows.append((gid, None, None))
+            rows.extend((gid, mid, json.dumps(data)) for mid, data in members.items())
+        return rows
+
+    def write(self, namespace: str, snapshot: Any):
+        with self._lock, self._db:
+            for guild_id, member_id, data in snapshot:
+                if member_id is None:
+                    self._db.execute("DELETE FROM settings WHERE namespace = ? AND guild_id = ?", (namespace, guild_id))
+                elif data is None:
+                    self._db.execute(
+                        "DELETE FROM settings WHERE namespace = ? AND guild_id = ? AND member_id = ?",
+                        (namespace, guild_id, member_id)
+                    )
+                else:
+                    self._db.execute(
+                        "INSERT INTO settings VALUES (?, ?, ?, ?) "
+                        "ON CONFLICT (namespace, guild_id, member_id) DO UPDATE SET data = excluded.data",
+                        (namespace, guild_id, member_id, data)
+                    )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class WriteBehind:
+    """Debounced write-behind for a StorageBackend.
+
+    Saves only mark what changed. ``delay`` seconds after the first mark every
+    dirty section is snapshotted on the event loop and written on a background
+    thread, so bursts of saves become one flush and disk I/O stays off the loop.
+    Each backend write is atomic, a crash loses at most the unflushed marks.
+    """
+
+    def __init__(self, backend: StorageBackend, delay: float = 1.0):
+        self.backend = backend
+        self.delay = delay
+        self._dirty: Dict[str, Tuple[MutableMapping, Set[DirtyKey]]] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flush_task: Optional[asyncio.Future] = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='config-writer')
+        self.flushes = 0
+        self.last_flush_seconds = 0.0
+
+    @property
+    def pending(self) -> int:
+        return sum(len(keys) for _, keys in self._dirty.values())
+
+    def mark(self, namespace: str, settings: MutableMapping, guild_id: Optional[str] = None, member_id: Optional[str] = None):
+        keys = self._dirty.setdefault(namespace, (settings, set()))[1]
+        if (None, None) in keys:
+            pass
+        elif guild_id is None:
+            keys.clear()
+            keys.add((None, None))
+        elif member_id is None:
+            keys.difference_update([k for k in keys if k[0] == guild_id])
+            keys.add((guild_id, None))
+        elif (guild_id, None) not in keys:
+            keys.add((guild_id, member_id))
+        CONFIG_PENDING.set(self.pending)
+
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.delay, self._flush_later)
+
+    def _flush_later(self):
+        self._timer = None
+        # The loop only keeps a weak reference to the task
+        self._flush_task = asyncio.ensure_future(self.flush())
+
+    def _collect(self):
+        dirty, self._dirty = self._dirty, {}
+        CONFIG_PENDING.set(0)
+        batches = []
+        for namespace, (settings, keys) in dirty.items():
+            if not self.backend.partial_saves or (None, None) in keys:
+                batches.append((namespace, self.backend.snapshot(namespace, settings)))
+                continue
+            for guild_id, member_id in keys:
+                batches.append((namespace, self.backend.snapshot(namespace, settings, guild_id, member_id)))
+        return dirty, batches
+
+    def _write(self, batches) -> float:
+        start = time.perf_counter()
+        for namespace, snapshot in batches:
+            self.backend.write(namespace, snapshot)
+        elapsed = time.perf_counter() - start
+        CONFIG_SAVE_SECONDS.observe(elapsed, backend=self.backend.__class__.__name__)
+        return elapsed
+
+    async def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        dirty, batches = self._collect()
+        if not batches:
+            return
+        loop = asyncio.get_running_loop()
+        try:
+            self.last_flush_seconds = await loop.run_in_executor(self._executor, self._write, batches)
+        except Exception:
+            log.exception("Flushing configuration failed, will retry")
+            for namespace, (settings, keys) in dirty.items():
+                for guild_id, member_id in keys:
+                    self.mark(namespace, settings, guild_id, member_id)
+            return
+        self.flushes += 1
+        log.debug(f"Flushed {len(batches)} configuration sections in {self.last_flush_seconds:.4f}s")
+
+    def flush_sync(self):
+        """Writes everything pending on the calling thread, for use when no event loop is running"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        _, batches = self._collect()
+        if batches:
+            self.last_flush_seconds = self._write(batches)
+            self.flushes += 1
+
+
+BACKENDS = {
+    'json': JsonStorage,
+    'sqlite': SqliteStorage,
+}
+_storage: Optional[StorageBackend] = None
+_writer: Optional[WriteBehind] = None
+
+
+def get_storage() -> StorageBackend:
+    """Storage shared by every ConfigMixin, chosen with the CONFIG_BACKEND environment variable"""
+    global _storage
+    if _storage is None:
+        if not os.path.exists(BASE_DIR):
+            os.makedirs(BASE_DIR)
+        backend = os.environ.get('CONFIG_BACKEND', 'sqlite')
+        _storage = BACKENDS[backend]()
+        log.debug(f"Using {backend} configuration storage")
+    return _storage
+
+
+def get_writer() -> WriteBehind:
+    """Write-behind queue in front of the shared storage, flushed at exit as a last resort"""
+    global _writer
+    if _writer is None:
+        _writer = WriteBehind(get_storage(), delay=float(os.environ.get('CONFIG_FLUSH_DELAY', 1.0)))
+        atexit.register(_writer.flush_sync)
+    return _writer
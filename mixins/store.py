@@ -0,0 +1,74 @@
+import asyncio
+import logging
+import time
+from collections.abc import MutableMapping
+from typing import Callable, Dict, List, Optional
+
+from metrics import CONFIG_SAVE_SECONDS
+from mixins.storage import StorageBackend, WriteBehind, get_storage, get_writer
+
+log = logging.getLogger(__name__)
+
+# Called with the guild id and member id that were saved, None meaning all of them
+ChangeListener = Callable[[Optional[str], Optional[str]], None]
+
+
+class ConfigStore:
+    """Process-wide owner of every configuration namespace.
+
+    Each namespace is loaded once and handed out as the same mapping to every
+    cog that asks for it. Saves go through the store, which persists them and
+    notifies the namespace's listeners so derived state can be updated in place.
+    """
+
+    def __init__(self, storage: StorageBackend, writer: WriteBehind):
+        self.storage = storage
+        self.writer = writer
+        self._namespaces: Dict[str, MutableMapping] = {}
+        self._listeners: Dict[str, List[ChangeListener]] = {}
+
+    def namespace(self, name: str) -> MutableMapping:
+        settings = self._namespaces.get(name)
+        if settings is None:
+            settings = self._namespaces[name] = self.storage.load(name)
+        return settings
+
+    def subscribe(self, namespace: str, listener: ChangeListener):
+        self._listeners.setdefault(namespace, []).append(listener)
+
+    def unsubscribe(self, namespace: str, listener: ChangeListener):
+        listeners = self._listeners.get(namespace, [])
+        if listener in listeners:
+            listeners.remove(listener)
+
+    def save(self, namespace: str, guild_id: Optional[str] = None, member_id: Optional[str] = None, background: bool = True):
+        settings = self.namespace(namespace)
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            background = False
+        if background:
+            self.writer.mark(namespace, settings, guild_id, member_id)
+        else:
+            start = time.perf_counter()
+            self.storage.save(namespace, settings, guild_id, member_id)
+            CONFIG_SAVE_SECONDS.observe(time.perf_counter() - start, backend=self.storage.__class__.__name__)
+
+        for listener in list(self._listeners.get(namespace, [])):
+            try:
+                listener(guild_id, member_id)
+            except Exception:
+                log.exception(f"Configuration listener for {namespace} failed")
+
+    async def flush(self):
+        await self.writer.flush()
+
+
+_store: Optional[ConfigStore] = None
+
+
+def get_store() -> ConfigStore:
+    global _store
+    if _store is None:
+        _store = ConfigStore(get_storage(), get_writer())
+    return _store
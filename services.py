@@ -1,6 +1,9 @@
 from datetime import datetime, timedelta
 from typing import Optional
+import logging
 import re
+
+log = logging.getLogger(__name__)
 TIMEDELTA_PATTERN = re.compile('^(?:(?P<weeks>\d+)[w.])?(?:(?P<days>\d+)[d.])?(?:(?P<hours>\d+)[h.])?(?:(?P<minutes>\d+)[m.])?(?:(?P<seconds>\d+)[s.])?$')
 
 
@@ -25,3 +28,18 @@ def string_timedelta(span: str) -> Optional[timedelta]:
         return
     args = {k: int(v) for k, v in matches.groupdict().items() if v and v.isdigit()}
     return timedelta(**args)
+
+def format_timedelta(span: timedelta) -> str:
+    """
+           Inverse of string_timedelta, 1w2d1h18m2s
+
+           :param span:
+           :return:
+           """
+    seconds = int(span.total_seconds())
+    parts = []
+    for unit, size in (('w', 604800), ('d', 86400), ('h', 3600), ('m', 60), ('s', 1)):
+        value, seconds = divmod(seconds, size)
+        if value:
+            parts.append(f"{value}{unit}")
+    return ''.join(parts) or '0s'
@@ -0,0 +1,92 @@
+import asyncio
+from typing import Dict, Sequence
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from bot.social.batching import BatchCollector
+from bot.social.http import HttpClient
+from bot.social.providers import BaseProvider, YouTubeProvider
+
+
+class FakeProvider(BaseProvider):
+    api_url = 'https://api.example.com/v1'
+    batch_limit = 50
+
+    def __init__(self, target: str, delay: float = 0.0):
+        super().__init__(HttpClient())
+        self.target = target
+        self.delay = delay
+        self.requested = []
+
+    @property
+    def target_id(self):
+        return self.target
+
+    @property
+    def batch_target(self):
+        return self.target
+
+    async def subscriber_counts(self, targets: Sequence[str]) -> Dict[str, int]:
+        self.requested.append(list(targets))
+        await asyncio.sleep(self.delay)
+        return {target: len(target) for target in targets}
+
+
+async def test_batches_concurrent_requests():
+    collector = BatchCollector(window=0.01)
+    providers = [FakeProvider(name) for name in ('a', 'bb', 'ccc')]
+    counts = await asyncio.gather(*(collector.subscriber_count(p) for p in providers))
+    assert counts == [1, 2, 3]
+    assert providers[0].requested == [['a', 'bb', 'ccc']]
+
+
+async def test_cancelled_batch_cancels_waiters():
+    collector = BatchCollector(window=0.01)
+    providers = [FakeProvider(name, delay=10) for name in ('a', 'b')]
+    waiters = [asyncio.create_task(collector.subscriber_count(p)) for p in providers]
+    await asyncio.sleep(0.05)
+    assert providers[0].requested
+
+    await collector.close()
+    for waiter in waiters:
+        with pytest.raises(asyncio.CancelledError):
+            await asyncio.wait_for(waiter, 1)
+
+
+async def test_close_cancels_collecting_batch():
+    collector = BatchCollector(window=10)
+    provider = FakeProvider('a')
+    waiter = asyncio.create_task(collector.subscriber_count(provider))
+    await asyncio.sleep(0)
+    await collector.close()
+    with pytest.raises(asyncio.CancelledError):
+        await asyncio.wait_for(waiter, 1)
+    assert provider.requested == []
+
+
+async def test_repeated_batch_is_validated():
+    seen = []
+
+    async def channels(request):
+        seen.append((request.query['id'], request.headers.get('If-None-Match')))
+        if request.headers.get('If-None-Match') == '"v1"':
+            return web.Response(status=304)
+        items = [{'id': i, 'statistics': {'subscriberCount': '10'}} for i in request.query['id'].split(',')]
+        return web.json_response({'items': items}, headers={'ETag': '"v1"'})
+
+    app = web.Application()
+    app.router.add_get('/channels', channels)
+    http = HttpClient()
+    async with TestServer(app) as server:
+        collector = BatchCollector(window=0.01)
+        try:
+            for ids in (('UC1', 'UC2'), ('UC2', 'UC1')):
+                providers = [YouTubeProvider('key', channel_id, http) for channel_id in ids]
+                for provider in providers:
+                    provider.api_url = str(server.make_url('')).rstrip('/')
+                assert await asyncio.gather(*(collector.subscriber_count(p) for p in providers)) == [10, 10]
+        finally:
+            await http.close()
+    assert seen == [('UC1,UC2', None), ('UC1,UC2', '"v1"')]
@@ -0,0 +1,171 @@
+import os
+
+import pytest
+
+from bot.social.history import DAY, HOUR, Bucket, HistoryStore, Tier
+
+KEY = ('youtube', 'UC123')
+# Midnight, so hours and days line up with the test timestamps
+START = 1_700_006_400
+
+
+def store(tmp_path, raw_retention: int = 7 * DAY) -> HistoryStore:
+    tiers = (Tier('raw', 0, raw_retention), Tier('hourly', HOUR, 90 * DAY), Tier('daily', DAY, None))
+    return HistoryStore(str(tmp_path), tiers=tiers)
+
+
+async def test_append_and_query(tmp_path):
+    history = store(tmp_path)
+    history.append(KEY, 100, START)
+    history.append(KEY, 110, START + 60)
+    await history.flush()
+    history.append(KEY, 120, START + 120)
+    # Out of order points are dropped
+    history.append(KEY, 90, START + 30)
+
+    assert history.query_tier(KEY, history.tiers[0], START, START + 120) == [
+        Bucket(START, 100, 100, 100),
+        Bucket(START + 60, 110, 110, 110),
+        Bucket(START + 120, 120, 120, 120),
+    ]
+    assert history.series_keys() == [KEY]
+
+
+async def test_rolls_up_finished_buckets(tmp_path):
+    history = store(tmp_path)
+    for minute, count in enumerate((100, 90, 130, 120)):
+        history.append(KEY, count, START + minute * 30 * 60)
+    history.append(KEY, 140, START + 2 * HOUR)
+
+    await history.compact(now=START + 2 * HOUR + 60)
+    hourly = history.tiers[1]
+    stored = history._read(KEY, hourly, 0, START + DAY)
+    assert list(stored['ts']) == [START, START + HOUR]
+    assert list(stored['min']) == [90, 120]
+    assert list(stored['max']) == [100, 130]
+    assert list(stored['last']) == [90, 120]
+
+    # The unfinished hour is filled in from raw points
+    assert history.query_tier(KEY, hourly, START, START + 3 * HOUR) == [
+        Bucket(START, 90, 100, 90),
+        Bucket(START + HOUR, 120, 130, 120),
+        Bucket(START + 2 * HOUR, 140, 140, 140),
+    ]
+
+
+async def test_compacting_twice_does_not_duplicate(tmp_path):
+    history = store(tmp_path)
+    history.append(KEY, 100, START)
+    history.append(KEY, 200, START + HOUR)
+    await history.compact(now=START + 2 * HOUR)
+    await history.compact(now=START + 2 * HOUR)
+    stored = history._read(KEY, history.tiers[1], 0, START + DAY)
+    assert list(stored['ts']) == [START, START + HOUR]
+
+
+async def test_expires_raw_points_once_rolled_up(tmp_path):
+    history = store(tmp_path, raw_retention=HOUR)
+    for hour in range(4):
+        history.append(KEY, 100 + hour, START + hour * HOUR)
+
+    now = START + 3 * HOUR + 60
+    await history.compact(now=now)
+    raw = history._read(KEY, history.tiers[0], 0, now)
+    assert list(raw['ts']) == [START + 3 * HOUR]
+    hourly = history._read(KEY, history.tiers[1], 0, now)
+    assert list(hourly['last']) == [100, 101, 102]
+
+    # Expiring every raw point removes the files
+    await history.compact(now=START + 10 * DAY)
+    assert not (tmp_path / 'youtube.UC123.ts').exists()
+    daily = history._read(KEY, history.tiers[2], 0, START + 10 * DAY)
+    assert list(daily['ts']) == [START]
+    assert list(daily['min']) == [100]
+    assert list(daily['max']) == [103]
+
+
+async def test_pick_tier(tmp_path):
+    history = store(tmp_path)
+    for minute in range(120):
+        history.append(KEY, minute, START + minute * 60)
+    now = START + 2 * HOUR
+    assert history.pick_tier(KEY, START, now, 1000, now=now).name == 'raw'
+    assert history.pick_tier(KEY, START, now, 10, now=now).name == 'hourly'
+    assert history.pick_tier(KEY, now - 30 * DAY, now, 1000, now=now).name == 'hourly'
+    assert history.pick_tier(KEY, now - 365 * DAY, now, 1000, now=now).name == 'daily'
+
+
+async def test_torn_write_is_truncated(tmp_path):
+    history = store(tmp_path)
+    history.append(KEY, 100, START)
+    await history.flush()
+    # A crash after the counts of the next flush were written but before its timestamps
+    with open(tmp_path / 'youtube.UC123.cnt', 'ab') as f:
+        f.write((200).to_bytes(8, 'little') + b'\x01\x02')
+
+    history.append(KEY, 300, START + 60)
+    await history.flush()
+    assert history.query_tier(KEY, history.tiers[0], START, START + 60) == [
+        Bucket(START, 100, 100, 100),
+        Bucket(START + 60, 300, 300, 300),
+    ]
+
+
+async def test_interrupted_expiry_is_rolled_forward(tmp_path, monkeypatch):
+    history = store(tmp_path, raw_retention=HOUR)
+    for hour in range(6):
+        history.append(KEY, 100 + hour, START + hour * HOUR)
+    await history.flush()
+
+    replace = os.replace
+    calls = []
+
+    def crash_on_second(src, dst):
+        calls.append(dst)
+        if len(calls) == 2:
+            raise OSError("crashed")
+        replace(src, dst)
+
+    monkeypatch.setattr(os, 'replace', crash_on_second)
+    with pytest.raises(OSError):
+        await history.compact(now=START + 5 * HOUR + 60)
+    monkeypatch.setattr(os, 'replace', replace)
+
+    reopened = store(tmp_path, raw_retention=HOUR)
+    assert reopened.query_tier(KEY, reopened.tiers[0], START, START + DAY) == [
+        Bucket(START + 5 * HOUR, 105, 105, 105),
+    ]
+    assert not list(tmp_path.glob('*.tmp'))
+
+
+async def test_uncommitted_expiry_is_rolled_back(tmp_path):
+    history = store(tmp_path)
+    history.append(KEY, 100, START)
+    history.append(KEY, 101, START + 60)
+    await history.flush()
+    # A crash while the trimmed columns were still being written
+    (tmp_path / 'youtube.UC123.cnt.tmp').write_bytes((101).to_bytes(8, 'little'))
+
+    reopened = store(tmp_path)
+    assert reopened.query_tier(KEY, reopened.tiers[0], START, START + 60) == [
+        Bucket(START, 100, 100, 100),
+        Bucket(START + 60, 101, 101, 101),
+    ]
+    assert not list(tmp_path.glob('*.tmp'))
+
+
+async def test_torn_trim_drops_the_front(tmp_path):
+    history = store(tmp_path)
+    for minute in range(3):
+        history.append(KEY, 100 + minute, START + minute * 60)
+    await history.flush()
+    # Counts trimmed of their first row, timestamps not yet
+    (tmp_path / 'youtube.UC123.cnt').write_bytes(b''.join(c.to_bytes(8, 'little') for c in (101, 102)))
+
+    history.append(KEY, 103, START + 180)
+    await history.flush()
+    assert history.query_tier(KEY, history.tiers[0], START, START + 180) == [
+        Bucket(START + 60, 101, 101, 101),
+        Bucket(START + 120, 102, 102, 102),
+        Bucket(START + 180, 103, 103, 103),
+    ]
@@ -0,0 +1,107 @@
+import asyncio
+from datetime import timedelta
+
+import pytest
+
+from bot.social.oauth import AppToken, AuthenticationError, TokenCache
+
+URL = 'https://id.example.com/oauth2/token'
+
+
+class FakeTokenCache(TokenCache):
+    """Hands out numbered tokens instead of calling the token endpoint"""
+
+    def __init__(self, **kwargs):
+        super().__init__(expiry_margin=timedelta(seconds=1), **kwargs)
+        self.requests = 0
+        self.delay = 0.0
+        self.fail = False
+
+    async def _request_token(self, key, http):
+        self.requests += 1
+        await asyncio.sleep(self.delay)
+        if self.fail:
+            raise AuthenticationError("invalid client")
+        token = AppToken(access_token=f"token{self.requests}", expires_in=100, token_type='bearer')
+        self._tokens[key] = token
+        return token
+
+
+def age(token: AppToken, seconds: float):
+    token.issued_at -= timedelta(seconds=seconds)
+    token.expires_at -= timedelta(seconds=seconds)
+
+
+async def test_reuses_token():
+    cache = FakeTokenCache()
+    first = await cache.token(None, URL, 'client', 'secret')
+    second = await cache.token(None, URL, 'client', 'secret')
+    assert first is second
+    assert first.auth_value == 'Bearer token1'
+    assert cache.requests == 1
+
+
+async def test_tokens_per_client():
+    cache = FakeTokenCache()
+    await cache.token(None, URL, 'client', 'secret')
+    await cache.token(None, URL, 'other', 'secret')
+    assert cache.requests == 2
+
+
+async def test_concurrent_requests_share_a_refresh():
+    cache = FakeTokenCache()
+    cache.delay = 0.01
+    tokens = await asyncio.gather(*(cache.token(None, URL, 'client', 'secret') for _ in range(5)))
+    assert cache.requests == 1
+    assert all(token is tokens[0] for token in tokens)
+
+
+async def test_refreshes_ahead_of_expiry():
+    cache = FakeTokenCache(refresh_ahead=0.1)
+    first = await cache.token(None, URL, 'client', 'secret')
+    # Less than a tenth of its lifetime left, but still usable
+    age(first, 95)
+
+    served = await cache.token(None, URL, 'client', 'secret')
+    assert served is first
+    await asyncio.sleep(0.01)
+    assert cache.requests == 2
+
+    renewed = await cache.token(None, URL, 'client', 'secret')
+    assert renewed.auth_value == 'Bearer token2'
+
+
+async def test_waits_for_refresh_once_expired():
+    cache = FakeTokenCache()
+    first = await cache.token(None, URL, 'client', 'secret')
+    age(first, 99.5)
+    renewed = await cache.token(None, URL, 'client', 'secret')
+    assert renewed is not first
+    assert cache.requests == 2
+
+
+async def test_failed_refresh_keeps_serving_current_token():
+    cache = FakeTokenCache(refresh_ahead=0.1)
+    first = await cache.token(None, URL, 'client', 'secret')
+    age(first, 95)
+    cache.fail = True
+
+    assert await cache.token(None, URL, 'client', 'secret') is first
+    await asyncio.sleep(0.01)
+    assert await cache.token(None, URL, 'client', 'secret') is first
+    await asyncio.sleep(0.01)
+    assert cache.requests == 3
+
+
+async def test_cancelled_caller_does_not_cancel_shared_refresh():
+    cache = FakeTokenCache()
+    cache.delay = 0.02
+    cancelled = asyncio.create_task(cache.token(None, URL, 'client', 'secret'))
+    waiting = asyncio.create_task(cache.token(None, URL, 'client', 'secret'))
+    await asyncio.sleep(0.005)
+    cancelled.cancel()
+
+    token = await waiting
+    assert token.auth_value == 'Bearer token1'
+    with pytest.raises(asyncio.CancelledError):
+        await cancelled
@@ -0,0 +1,68 @@
+from datetime import timedelta
+
+from bot.social.provider_cog import ProviderTaskService
+from bot.social.scheduler import PollScheduler
+
+KEY = ('youtube', 'UC123')
+
+
+def service(scheduler: PollScheduler, counts: list) -> ProviderTaskService:
+    async def callback(key, provider):
+        return counts.pop(0)
+
+    return ProviderTaskService(
+        KEY, 'youtube', lambda: object(), callback, scheduler,
+        interval=timedelta(minutes=1), ceiling=timedelta(minutes=8),
+    )
+
+
+async def test_backs_off_while_count_is_flat():
+    scheduler = PollScheduler()
+    task = service(scheduler, [10, 10, 10, 11])
+    task.start()
+    for expected in (1, 2, 4, 1):
+        await task.provider_task()
+        assert task.current_interval == timedelta(minutes=expected)
+
+
+async def test_cached_counts_do_not_back_off():
+    scheduler = PollScheduler()
+    task = service(scheduler, [10, None, None, 10])
+    task.start()
+    for _ in range(3):
+        await task.provider_task()
+    assert task.current_interval == timedelta(minutes=1)
+    await task.provider_task()
+    assert task.current_interval == timedelta(minutes=2)
+
+
+async def test_stopped_service_leaves_replacement_alone():
+    scheduler = PollScheduler()
+    old = service(scheduler, [10])
+    old.start()
+    await old.provider_task()
+
+    replacements = []
+
+    async def replace(key, provider):
+        # The display is reconfigured while the old service is polling
+        old.stop()
+        replacements.append(service(scheduler, []))
+        replacements[0].start()
+        return 10
+
+    old.callback = replace
+    await old.provider_task()
+    # The replacement keeps its own interval instead of the old service's backed off one
+    assert scheduler._entries[KEY].callback == replacements[0].provider_task
+    assert scheduler._entries[KEY].interval == 60
+
+
+async def test_stopped_service_does_not_reschedule():
+    scheduler = PollScheduler()
+    task = service(scheduler, [10, 10])
+    task.start()
+    await task.provider_task()
+    task.stop()
+    await task.provider_task()
+    assert KEY not in scheduler
@@ -0,0 +1,45 @@
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from bot.social.http import HttpClient
+from bot.social.providers import TwitchProvider
+
+
+class FakeOAuth:
+    """Hands out a new token each time the last one is invalidated"""
+
+    def __init__(self):
+        self.tokens = 1
+
+    async def auth_header(self, http):
+        return {'Authorization': f"Bearer token{self.tokens}"}
+
+    def invalidate(self):
+        self.tokens += 1
+
+
+async def test_twitch_refreshes_revoked_token_and_validates():
+    seen = []
+
+    async def follows(request):
+        auth, validator = request.headers['Authorization'], request.headers.get('If-None-Match')
+        seen.append((auth, validator))
+        if auth == 'Bearer token1':
+            return web.json_response({'message': 'invalid token'}, status=401)
+        if validator == '"v1"':
+            return web.Response(status=304)
+        return web.json_response({'total': 42}, headers={'ETag': '"v1"'})
+
+    app = web.Application()
+    app.router.add_get('/users/follows', follows)
+    http = HttpClient()
+    async with TestServer(app) as server:
+        provider = TwitchProvider('1234', 'client', 'secret', http)
+        provider.api_url = str(server.make_url('')).rstrip('/')
+        provider.oauth = FakeOAuth()
+        try:
+            assert await provider.subscriber_count() == 42
+            assert await provider.subscriber_count() == 42
+        finally:
+            await http.close()
+    assert seen == [('Bearer token1', None), ('Bearer token2', None), ('Bearer token2', '"v1"')]
@@ -0,0 +1,112 @@
+import asyncio
+import time
+
+import pytest
+
+from bot.social.resilience import CircuitBreaker, CircuitOpen, Resilience
+
+
+def expire(breaker: CircuitBreaker):
+    """Skips the rest of the cooldown"""
+    breaker.opened_until = time.monotonic() - 1
+
+
+def test_opens_after_threshold():
+    breaker = CircuitBreaker('api.example.com', threshold=3, cooldown=30)
+    for _ in range(2):
+        breaker.failure()
+        breaker.check()
+    assert not breaker.open
+
+    breaker.failure()
+    assert breaker.open
+    with pytest.raises(CircuitOpen):
+        breaker.check()
+
+
+def test_success_resets_failures():
+    breaker = CircuitBreaker('api.example.com', threshold=2)
+    breaker.failure()
+    breaker.success()
+    breaker.failure()
+    assert not breaker.open
+    assert breaker.failures == 1
+
+
+def test_retry_after_opens_immediately():
+    breaker = CircuitBreaker('api.example.com', threshold=5)
+    breaker.failure(retry_after=120)
+    assert breaker.open
+    assert breaker.opened_until - time.monotonic() > 100
+
+
+def test_single_trial_after_cooldown():
+    breaker = CircuitBreaker('api.example.com', threshold=1, cooldown=30)
+    breaker.failure()
+    expire(breaker)
+
+    breaker.check()
+    assert breaker.trial
+    # Everyone else waits for the trial to finish
+    with pytest.raises(CircuitOpen):
+        breaker.check()
+
+
+def test_trial_success_closes():
+    breaker = CircuitBreaker('api.example.com', threshold=1, cooldown=30)
+    breaker.failure()
+    breaker.failure()
+    expire(breaker)
+    breaker.check()
+    breaker.success()
+
+    assert not breaker.open
+    assert not breaker.trial
+    assert breaker.failures == 0
+    assert breaker.cooldown == 30
+    breaker.check()
+
+
+def test_trial_failure_doubles_cooldown():
+    breaker = CircuitBreaker('api.example.com', threshold=1, cooldown=30, max_cooldown=100)
+    breaker.failure()
+    assert breaker.cooldown == 60
+
+    for expected in (100, 100):
+        expire(breaker)
+        breaker.check()
+        breaker.failure()
+        assert breaker.open
+        assert not breaker.trial
+        assert breaker.cooldown == expected
+    assert 50 < breaker.opened_until - time.monotonic() <= 100
+
+
+class FakeProvider:
+    api_url = 'https://api.example.com/v1'
+    credential_scope = None
+
+
+async def test_cancelled_trial_lets_next_call_try():
+    resilience = Resilience(threshold=1)
+    provider = FakeProvider()
+    breaker = resilience.breaker_for(provider)
+    breaker.failure()
+    expire(breaker)
+
+    async def hang():
+        await asyncio.sleep(10)
+
+    call = asyncio.create_task(resilience.call(provider, hang))
+    await asyncio.sleep(0)
+    assert breaker.trial
+    call.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await call
+    assert not breaker.trial
+
+    async def answer():
+        return 42
+
+    assert await resilience.call(provider, answer) == 42
+    assert not breaker.open
@@ -0,0 +1,145 @@
+import asyncio
+from datetime import timedelta
+
+import pytest
+
+from bot.social.scheduler import Backoff, PollScheduler
+
+
+def recorder(runs: list, key):
+    async def callback():
+        runs.append(key)
+    return callback
+
+
+async def test_add_and_remove():
+    scheduler = PollScheduler(workers=2)
+    scheduler.add('a', recorder([], 'a'), timedelta(minutes=5))
+    scheduler.add('b', recorder([], 'b'), timedelta(minutes=5))
+    assert len(scheduler) == 2
+    assert 'a' in scheduler
+
+    scheduler.remove('a')
+    scheduler.remove('missing')
+    assert len(scheduler) == 1
+    assert 'a' not in scheduler
+
+
+async def test_add_replaces_existing_key():
+    runs = []
+    scheduler = PollScheduler(workers=2)
+    scheduler.add('a', recorder(runs, 'first'), timedelta(minutes=5), jitter=False)
+    scheduler.add('a', recorder(runs, 'second'), timedelta(minutes=5), jitter=False)
+    scheduler.start()
+    try:
+        await asyncio.sleep(0.05)
+    finally:
+        await scheduler.stop()
+    assert len(scheduler) == 1
+    assert runs == ['second']
+
+
+async def test_removed_poll_does_not_run():
+    runs = []
+    scheduler = PollScheduler(workers=2)
+    scheduler.add('a', recorder(runs, 'a'), timedelta(minutes=5), jitter=False)
+    scheduler.add('b', recorder(runs, 'b'), timedelta(minutes=5), jitter=False)
+    scheduler.remove('a')
+    scheduler.start()
+    try:
+        await asyncio.sleep(0.05)
+    finally:
+        await scheduler.stop()
+    assert runs == ['b']
+
+
+async def test_poll_repeats_every_interval():
+    runs = []
+    scheduler = PollScheduler(workers=2)
+    scheduler.add('a', recorder(runs, 'a'), timedelta(seconds=0.05), jitter=False)
+    scheduler.start()
+    try:
+        await asyncio.sleep(0.18)
+    finally:
+        await scheduler.stop()
+    assert 3 <= len(runs) <= 5
+
+
+async def test_reschedule_runs_now():
+    runs = []
+    scheduler = PollScheduler(workers=2)
+    scheduler.add('a', recorder(runs, 'a'), timedelta(hours=1))
+    scheduler.start()
+    try:
+        scheduler.reschedule('a', delay=0)
+        await asyncio.sleep(0.05)
+    finally:
+        await scheduler.stop()
+    assert runs == ['a']
+
+
+async def test_reschedule_shorter_interval_brings_poll_forward():
+    runs = []
+    scheduler = PollScheduler(workers=2)
+    scheduler.add('a', recorder(runs, 'a'), timedelta(hours=1), jitter=False)
+    scheduler.start()
+    try:
+        await asyncio.sleep(0.02)
+        scheduler.reschedule('a', timedelta(seconds=0.05))
+        await asyncio.sleep(0.1)
+    finally:
+        await scheduler.stop()
+    assert len(runs) >= 2
+
+
+async def test_reschedule_unknown_key():
+    scheduler = PollScheduler()
+    with pytest.raises(KeyError):
+        scheduler.reschedule('missing', timedelta(minutes=1))
+
+
+async def test_failing_poll_keeps_its_schedule():
+    runs = []
+
+    async def callback():
+        runs.append('a')
+        raise RuntimeError("upstream exploded")
+
+    scheduler = PollScheduler(workers=1)
+    scheduler.add('a', callback, timedelta(seconds=0.05), jitter=False)
+    scheduler.start()
+    try:
+        await asyncio.sleep(0.12)
+    finally:
+        await scheduler.stop()
+    assert len(runs) >= 2
+    assert 'a' in scheduler
+
+
+async def test_group_runs_together():
+    runs = []
+    scheduler = PollScheduler(workers=4, align=0.5)
+    scheduler.add('a', recorder(runs, 'a'), timedelta(seconds=1), jitter=False, group='credential')
+    scheduler.add('b', recorder(runs, 'b'), timedelta(seconds=1), group='credential')
+    scheduler.reschedule('b', delay=0.4)
+    scheduler.add('c', recorder(runs, 'c'), timedelta(seconds=1))
+    scheduler.reschedule('c', delay=0.4)
+    scheduler.start()
+    try:
+        await asyncio.sleep(0.05)
+    finally:
+        await scheduler.stop()
+    assert sorted(runs) == ['a', 'b']
+
+
+def test_backoff():
+    backoff = Backoff(timedelta(minutes=1), timedelta(minutes=5))
+    assert backoff.observe(10) == timedelta(minutes=1)
+    assert backoff.observe(10) == timedelta(minutes=2)
+    assert backoff.observe(10) == timedelta(minutes=4)
+    assert backoff.observe(10) == timedelta(minutes=5)
+    assert backoff.observe(11) == timedelta(minutes=1)
+
+    backoff.observe(11)
+    backoff.update(timedelta(minutes=3), timedelta(minutes=4))
+    assert backoff.current == timedelta(minutes=3)
@@ -0,0 +1,128 @@
+import asyncio
+import json
+
+from metrics import CONFIG_PENDING
+from mixins.storage import SqliteStorage, StorageBackend, WriteBehind
+
+
+def sqlite(tmp_path, document=None) -> SqliteStorage:
+    json_path = tmp_path / 'settings.json'
+    if document is not None:
+        json_path.write_text(json.dumps(document))
+    return SqliteStorage(str(tmp_path / 'settings.db'), str(json_path))
+
+
+def test_migrates_json_once(tmp_path):
+    storage = sqlite(tmp_path, {'providers': {'1': {'10': {'youtube': {'channel': 'UC123'}}}}})
+    settings = storage.load('providers')
+    assert list(settings) == ['1']
+    assert settings['1'] == {'10': {'youtube': {'channel': 'UC123'}}}
+    storage.close()
+
+    # Later edits of settings.json are not imported again
+    storage = sqlite(tmp_path, {'providers': {'2': {'20': {}}}})
+    assert list(storage.load('providers')) == ['1']
+    storage.close()
+
+
+def test_missing_json(tmp_path):
+    storage = sqlite(tmp_path)
+    assert len(storage.load('providers')) == 0
+    storage.close()
+
+
+def test_upserts_member(tmp_path):
+    storage = sqlite(tmp_path)
+    settings = {'1': {'10': {'count': 1}, '11': {'count': 2}}}
+    storage.save('displays', settings)
+    settings['1']['10'] = {'count': 3}
+    storage.save('displays', settings, '1', '10')
+    storage.close()
+
+    storage = sqlite(tmp_path)
+    assert storage.load('displays')['1'] == {'10': {'count': 3}, '11': {'count': 2}}
+    storage.close()
+
+
+def test_deletes_member_and_guild(tmp_path):
+    storage = sqlite(tmp_path)
+    settings = {'1': {'10': {}, '11': {}}, '2': {'20': {}}}
+    storage.save('displays', settings)
+    del settings['1']['10']
+    storage.save('displays', settings, '1', '10')
+    del settings['2']
+    storage.save('displays', settings, '2')
+
+    loaded = storage.load('displays')
+    assert list(loaded) == ['1']
+    assert loaded['1'] == {'11': {}}
+    storage.close()
+
+
+def test_namespaces_are_separate(tmp_path):
+    storage = sqlite(tmp_path)
+    storage.save('displays', {'1': {'10': {'a': 1}}})
+    storage.save('providers', {'1': {'10': {'b': 2}}})
+    assert storage.load('displays')['1'] == {'10': {'a': 1}}
+    assert storage.load('providers')['1'] == {'10': {'b': 2}}
+    storage.close()
+
+
+class FlakyStorage(StorageBackend):
+    partial_saves = True
+
+    def __init__(self, failures: int):
+        self.failures = failures
+        self.written = []
+
+    def snapshot(self, namespace, settings, guild_id=None, member_id=None):
+        return guild_id, member_id, json.dumps(settings.get(guild_id, {}).get(member_id))
+
+    def write(self, namespace, snapshot):
+        if self.failures:
+            self.failures -= 1
+            raise OSError("disk full")
+        self.written.append((namespace, snapshot))
+
+
+async def test_write_behind_coalesces_marks():
+    backend = FlakyStorage(failures=0)
+    writer = WriteBehind(backend, delay=60)
+    settings = {'1': {'10': {'count': 1}}}
+    writer.mark('displays', settings, '1', '10')
+    settings['1']['10']['count'] = 2
+    writer.mark('displays', settings, '1', '10')
+    assert writer.pending == 1
+
+    await writer.flush()
+    assert backend.written == [('displays', ('1', '10', '{"count": 2}'))]
+    assert writer.pending == 0
+    assert writer.flushes == 1
+
+
+async def test_write_behind_flushes_after_delay():
+    backend = FlakyStorage(failures=0)
+    writer = WriteBehind(backend, delay=0.01)
+    writer.mark('displays', {'1': {'10': {}}}, '1', '10')
+    await asyncio.sleep(0.02)
+    await writer._flush_task
+    assert backend.written == [('displays', ('1', '10', '{}'))]
+    assert CONFIG_PENDING.total() == 0
+
+
+async def test_write_behind_retries_failed_flush():
+    backend = FlakyStorage(failures=1)
+    writer = WriteBehind(backend, delay=60)
+    settings = {'1': {'10': {'count': 1}}}
+    writer.mark('displays', settings, '1', '10')
+
+    await writer.flush()
+    assert backend.written == []
+    assert writer.pending == 1
+    assert CONFIG_PENDING.total() == 1
+    assert writer.flushes == 0
+
+    await writer.flush()
+    assert backend.written == [('displays', ('1', '10', '{"count": 1}'))]
+    assert writer.pending == 0
+    assert writer.flushes == 1
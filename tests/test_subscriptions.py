@@ -0,0 +1,54 @@
+from bot.social.subscriptions import Subscription, SubscriptionIndex
+
+YOUTUBE = ('youtube', 'UC123')
+TWITCH = ('twitch', 'streamer')
+
+
+def test_add_groups_by_key():
+    index = SubscriptionIndex()
+    first = Subscription(1, 10, 'youtube')
+    second = Subscription(2, 20, 'youtube')
+    assert index.add(YOUTUBE, first) is None
+    assert index.add(YOUTUBE, second) is None
+
+    assert len(index) == 2
+    assert first in index
+    assert index.subscriptions(YOUTUBE) == [first, second]
+    assert index.key_of(second) == YOUTUBE
+    assert list(index.keys()) == [YOUTUBE]
+
+
+def test_add_same_key_twice():
+    index = SubscriptionIndex()
+    subscription = Subscription(1, 10, 'youtube')
+    index.add(YOUTUBE, subscription)
+    assert index.add(YOUTUBE, subscription) is None
+    assert index.subscriptions(YOUTUBE) == [subscription]
+
+
+def test_move_returns_emptied_key():
+    index = SubscriptionIndex()
+    moving = Subscription(1, 10, 'youtube')
+    staying = Subscription(2, 20, 'youtube')
+    index.add(YOUTUBE, moving)
+    index.add(YOUTUBE, staying)
+
+    assert index.add(TWITCH, moving) is None
+    assert index.subscriptions(YOUTUBE) == [staying]
+    assert index.add(TWITCH, staying) == YOUTUBE
+    assert index.subscriptions(YOUTUBE) == []
+    assert list(index.keys()) == [TWITCH]
+
+
+def test_remove():
+    index = SubscriptionIndex()
+    first = Subscription(1, 10, 'youtube')
+    second = Subscription(2, 20, 'youtube')
+    index.add(YOUTUBE, first)
+    index.add(YOUTUBE, second)
+
+    assert index.remove(first) is None
+    assert index.remove(first) is None
+    assert index.remove(second) == YOUTUBE
+    assert len(index) == 0
+    assert index.key_of(second) is None